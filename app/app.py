@@ -1,99 +1,425 @@
 # An instance of the Flask class will be our WSGI application
-from flask import Flask, request, Response
+from flask import Flask, request, Response, g
 
 from pymongo import MongoClient  # To get a Database instance from MongoClient
+from pymongo.errors import DuplicateKeyError
 
-import json  # To decode request data and encode response data as JSON
-import time  # Used in session generation
+import time  # Used in checkout
 import uuid  # Used in session generation
 
 from bson.objectid import ObjectId
 
-from datetime import date  # To get current year in 'age' function
+from datetime import date  # To get current year in 'is_adult' function
 
 import os
+import functools  # To write the route decorators
+
+# Helper functions shared with the ASGI application (asgi.py)
+from common import (new_session_content, cart_changed,
+                    RESTRICTED_CATEGORIES, adult_from,
+                    PRODUCT_FIELDS, PRICE_ORDER, STREAM_BATCH_SIZE, product_item,
+                    ORDER_FIELDS, OLDEST_ORDER_FIRST, NEWEST_ORDER_FIRST, order_item,
+                    stream_json_array,
+                    purchase_update,
+                    mongodb_uri)
+
+# To decode request data and encode response data as JSON
+from serialization import loads, dumps, STATUS_BODIES
+
+import validation  # Request body schemas
+import catalog_io  # Bulk import and export of the catalog (NDJSON)
+import indexes  # Index migrations, applied at startup
+import search   # Product search queries and search terms
+import pagination  # Keyset pagination cursors
+import session_store  # Session stores (in-process or shared)
+import cart_store  # Carts kept apart from the sessions (optional)
+import product_cache  # Read-through cache of product documents
+import search_cache  # Cache of product-search responses
+import catalog_replica  # In-process replica of the catalog (optional)
+import reservations  # Stock reservations of the carts (optional)
+import idempotency  # Idempotency keys of signup and checkout
+import rate_limit  # Rate limiting and load shedding (optional)
+import metrics  # Request and MongoDB metrics, exported at /metrics
+import profiling  # On-demand profiling of requests
+import etags  # Entity tags, for conditional requests
+import compression  # gzip/brotli compression of responses
 
 
-mongodb_hostname = os.environ.get('MONGO_HOSTNAME','localhost')
+# Maximum number of connections to MongoDB per process,
+# should match the number of requests a process serves concurrently
+# (gunicorn.conf.py sets it from the number of threads of a worker)
+mongo_pool_size = int(os.environ.get('MONGO_POOL_SIZE', 100))
 
 
-# Get a Database instance of our MongoDB
-client = MongoClient('mongodb://' + mongodb_hostname + ':27017/')
+client = None    # MongoClient of this process
+db = None        # The 'DSPharmacy' database
+users = None     # The 'Users' collection
+products = None  # The 'Products' collection
+orders_collection = None  # The 'Orders' collection
+sessions = None  # The session store (see session_store.py)
+carts = None     # The cart store, if the carts are not kept in the sessions (see cart_store.py)
+products_cache = None  # Cache of product documents (see product_cache.py)
+search_results = None  # Cache of search responses (see search_cache.py)
+catalog = None  # Replica of the catalog, if enabled (see catalog_replica.py)
+stock_reservations = None  # Stock reservations, if enabled (see reservations.py)
+idempotency_keys = None  # Stored responses of signup and checkout (see idempotency.py)
+rate_limiter = None  # Token buckets of the clients, if enabled (see rate_limit.py)
 
+connected_pid = None  # The process that created the MongoClient
 
-# Access the 'DSPharmacy' database
-db = client['DSPharmacy']
 
-users = db['Users']        # Access the 'Users' collection
-products = db['Products']  # Access the 'Products' collection
+def connect_database():
+
+    # Creates the MongoClient, and everything that depends on it.
+    #
+    # A MongoClient must not be used in a process forked from the one
+    # that created it (its connections and monitor threads are not
+    # copied correctly by fork), so every worker process of a prefork
+    # server must call connect_database() again after the fork.
+
+    global client, db, users, products, orders_collection
+    global sessions, carts, products_cache, search_results, catalog, stock_reservations
+    global idempotency_keys, rate_limiter
+    global connected_pid
+
+    # Get a Database instance of our MongoDB
+    # (connect=False: the connections are only opened by the first operation,
+    #  the listener times every command sent to MongoDB)
+    client = MongoClient(mongodb_uri(),
+                         maxPoolSize=mongo_pool_size,
+                         connect=False,
+                         event_listeners=[metrics.command_listener])
+
+    # Access the 'DSPharmacy' database
+    db = client['DSPharmacy']
+
+    users = db['Users']        # Access the 'Users' collection
+    products = db['Products']  # Access the 'Products' collection
+    orders_collection = db['Orders']  # Access the 'Orders' collection
+
+    # Sessions are kept in an in-process or a shared store
+    sessions = session_store.create_store(db)
+
+    carts = cart_store.create_store(db)
+
+    products_cache = product_cache.ProductCache(products, db['Meta'])
+
+    search_results = search_cache.SearchCache(db['Meta'])
+
+    if catalog_replica.CATALOG_REPLICA:
+        catalog = catalog_replica.CatalogReplica(products, db['Meta'])
+        catalog.start()
+
+    if reservations.STOCK_RESERVATIONS:
+        stock_reservations = reservations.ReservationLedger(products, db['Reservations'])
+        stock_reservations.start_sweeper()
+
+    idempotency_keys = idempotency.IdempotencyStore(db['Idempotency'])
+
+    rate_limiter = rate_limit.create_limiter(db)
+
+    connected_pid = os.getpid()
+
+
+def ensure_connection():
+
+    # Connects if this process has not connected yet, or was forked
+    # after connect_database()
+    if connected_pid != os.getpid():
+        connect_database()
+
+
+# Connect ...
+# (gunicorn imports the application in its master process with
+#  WEB_PRELOAD=1, and sets CONNECT_ON_IMPORT=0: neither the MongoClient
+#  nor the background threads would survive the fork, so every worker
+#  connects after it instead, see gunicorn.conf.py)
+
+if os.environ.get('CONNECT_ON_IMPORT', '1') == '1':
+    connect_database()
+
+    # Apply any pending index migrations ...
+    # (can be disabled, e.g. when migrations are run separately
+    #  with 'python3 indexes.py migrate' before deploying)
+
+    if os.environ.get('MIGRATE_ON_STARTUP', '1') == '1':
+        indexes.migrate(db)
 
 
 # Initialize the application as an instance of the Flask class
 app = Flask(__name__)
 
+# Time every request, and attribute MongoDB commands to its route
+metrics.init_app(app, metrics.registry)
+
+# Profile sampled requests, or the ones asking for it (off by default)
+profiling.init_app(app, profiling.RequestProfiler())
+
+# Compress large responses, for the clients that accept it
+compression.init_app(app)
+
+# Shed the requests beyond MAX_IN_FLIGHT per process (off by default)
+admission = rate_limit.AdmissionControl()
+rate_limit.init_app(app, admission, lambda: status_response(503))
+
+
+def product_cache_metrics():
+
+    stats = products_cache.stats()
+
+    return [
+        ('product_cache_entries', 'gauge', 'Products in the cache.', [({}, stats['size'])]),
+        ('product_cache_hits_total', 'counter', 'Product cache hits.', [({}, stats['hits'])]),
+        ('product_cache_misses_total', 'counter', 'Product cache misses.', [({}, stats['misses'])]),
+        ('product_cache_evictions_total', 'counter', 'Product cache evictions.', [({}, stats['evictions'])])
+    ]
+
+
+metrics.registry.add_collector(product_cache_metrics)
+
+
+def search_cache_metrics():
+
+    stats = search_results.stats()
+
+    return [
+        ('search_cache_entries', 'gauge', 'Search responses in the cache.', [({}, stats['size'])]),
+        ('search_cache_hits_total', 'counter', 'Search cache hits.', [({}, stats['hits'])]),
+        ('search_cache_misses_total', 'counter', 'Search cache misses.', [({}, stats['misses'])]),
+        ('search_cache_stale_total', 'counter',
+         'Search cache misses due to a change of the catalog.', [({}, stats['stale'])]),
+        ('search_cache_evictions_total', 'counter', 'Search cache evictions.', [({}, stats['evictions'])])
+    ]
+
+
+metrics.registry.add_collector(search_cache_metrics)
+
+
+def catalog_replica_metrics():
+
+    if catalog == None:
+        return []
+
+    return [
+        ('catalog_replica_products', 'gauge', 'Products in the catalog replica.',
+         [({'mode': catalog.mode or 'loading'}, len(catalog.by_id))])
+    ]
+
+
+metrics.registry.add_collector(catalog_replica_metrics)
+
+
+def reservation_metrics():
+
+    if stock_reservations == None:
+        return []
+
+    stats = stock_reservations.stats()
+
+    return [
+        ('stock_reservations_total', 'counter', 'Stock holds made or increased by add-to-cart.',
+         [({}, stats['reserved'])]),
+        ('stock_reservations_rejected_total', 'counter', 'Stock holds refused for lack of stock.',
+         [({}, stats['rejected'])]),
+        ('stock_reservations_released_total', 'counter', 'Stock holds released.',
+         [({'reason': 'cart'}, stats['released']), ({'reason': 'expired'}, stats['expired'])])
+    ]
+
+
+metrics.registry.add_collector(reservation_metrics)
+
+
+def cart_store_metrics():
+
+    if carts == None:
+        return []
+
+    stats = carts.stats()
+
+    return [
+        ('cart_store_entries', 'gauge', 'Carts in memory.', [({}, stats['size'])]),
+        ('cart_store_dirty', 'gauge', 'Carts in memory not written yet.', [({}, stats['dirty'])]),
+        ('cart_store_loads_total', 'counter', 'Carts read from the database.', [({}, stats['loads'])]),
+        ('cart_store_writes_total', 'counter', 'Carts written to the database.', [({}, stats['writes'])]),
+        ('cart_store_flushes_total', 'counter', 'Bulk writes of carts.', [({}, stats['flushes'])])
+    ]
+
+
+metrics.registry.add_collector(cart_store_metrics)
+
 
-sessions = {}
+def idempotency_metrics():
+
+    stats = idempotency_keys.stats()
+
+    return [
+        ('idempotency_cache_entries', 'gauge', 'Stored responses in memory.', [({}, stats['size'])]),
+        ('idempotency_stored_total', 'counter', 'Responses stored for their idempotency key.',
+         [({}, stats['stored'])]),
+        ('idempotency_replays_total', 'counter', 'Retries answered with a stored response.',
+         [({'source': 'memory'}, stats['memory_hits']),
+          ({'source': 'database'}, stats['replays'] - stats['memory_hits'])]),
+        ('idempotency_conflicts_total', 'counter',
+         'Retries refused, in progress or with another body.', [({}, stats['conflicts'])])
+    ]
+
+
+metrics.registry.add_collector(idempotency_metrics)
+
+
+def rate_limit_metrics():
+
+    collected = []
+
+    if rate_limiter != None:
+        stats = rate_limiter.stats()
+
+        collected += [
+            ('rate_limit_throttled_total', 'counter', 'Requests answered 429 by the rate limiter.',
+             [({'key': kind}, count) for kind, count in stats['throttled'].items()]),
+            ('rate_limit_errors_total', 'counter', 'Requests let through, the buckets being unavailable.',
+             [({}, stats['errors'])])
+        ]
+
+    if admission.max_in_flight > 0:
+        stats = admission.stats()
+
+        collected += [
+            ('requests_in_flight', 'gauge', 'Requests being served.', [({}, stats['in_flight'])]),
+            ('requests_in_flight_limit', 'gauge', 'Requests served at once before shedding.',
+             [({}, stats['max_in_flight'])]),
+            ('requests_shed_total', 'counter', 'Requests answered 503 by load shedding.',
+             [({}, stats['shed'])])
+        ]
+
+    return collected
+
+
+metrics.registry.add_collector(rate_limit_metrics)
 
 
 # Helper Functions ...
 
-def is_ssn_valid(ssn):
+def status_response(status):
 
-    # SSN should be an integer
-    if not isinstance(ssn, int):
-        return False
+    # A response whose body is the reason phrase of its status ('OK',
+    # 'Unauthorized', ...), the same for every request
+    return Response(STATUS_BODIES[status],
+                    status=status,
+                    mimetype='application/json')
 
-    ssn = str(ssn)
 
-    # SSN should be 11-digits long
-    if len(ssn) != 11:
-        return False
+def throttled(kind, key):
 
-    #                            01234567890 (indexes)
-    # SSN must be in the format: DDMMYYNNNNN
+    # The 429 response of a client that is over its rate (see rate_limit.py),
+    # or None if the request may be served
+    if rate_limiter == None:
+        return None
 
-    # Digits at indexes 0 and 1 represent the day of birth
-    day = int(ssn[0:2])
+    wait = rate_limiter.check(kind, key)
 
-    # Digits at indexes 2 and 3 represent the month of birth
-    month = int(ssn[2:4])
+    if wait == 0:
+        return None
 
-    if not (1 <= day <= 31):
-        return False
-    if not (1 <= month <= 12):
-        return False
+    response = status_response(429)
+    response.headers['Retry-After'] = rate_limit.retry_after_header(wait)
 
-    return True
+    return response
 
 
-def generate_session(handle, category):
+def not_modified(etag):
 
-    # Generate the session's uuid
-    session_id = str(uuid.uuid4())
+    # The answer to a request whose If-None-Match holds the current tag
+    # (of the response compressed or not, see etags.py)
+    response = Response(status=304)
+    response.set_etag(etags.held_etag(request.if_none_match, etag,
+                                      compression.negotiated_encoding(request.accept_encodings)))
 
-    # Generate the session's content
+    return response
+
+
+def tagged(response, etag):
+    response.set_etag(etag)
+    return response
+
+
+def current_cart():
+
+    # The cart of the user of the request, kept in the session
+    # or in the cart store (see cart_store.py), with its version
+    if carts == None:
+        return g.session['cart']
+
+    if 'cart' not in g:
+        g.cart, g.cart_version = carts.get(g.session['email'])
+
+    return g.cart
+
+
+def cart_holder():
+
+    # The owner of the holds of the cart (see reservations.py): the session,
+    # or with a cart store the user, whose cart outlives the session
+    if carts == None:
+        return g.auth
+
+    return g.session['email']
 
-    if (category == 'administrator'):
-        handle_type = 'username'
+
+def save_cart():
+
+    # Called after the cart of the request has been changed
+    if carts == None:
+        cart_changed(g.session)
+        sessions.save(g.auth, g.session)
     else:
-        handle_type = 'email'
+        g.cart_version = carts.changed(g.session['email'], g.cart)
 
-    session_content = {
-        handle_type: handle,
-        'category':  category,
-        'timestamp': time.time()
-    }
 
-    if category == 'user':
-        session_content['cart'] = {
-            'products': {},
-            'total': 0.0
-        }
+def cart_etag():
+
+    if carts == None:
+        return etags.make_etag('cart', g.auth, g.session.get('cartVersion', 0))
+
+    return etags.make_etag('cart', g.session['email'], g.cart_version)
+
+
+# Returned by request_json when the body of the request is not valid JSON
+INVALID_JSON = object()
+
+
+def request_json():
+
+    # The body of the request is decoded once,
+    # and kept for whoever needs it again during the request
+    if 'json_body' not in g:
+        try:
+            g.json_body = loads(request.data)
+        except Exception:
+            g.json_body = INVALID_JSON
+
+    return g.json_body
+
 
-    # Add session into sessions-dictionary
-    sessions[session_id] = session_content
+def generate_session(handle, category, ssn=None):
 
-    return session_id
+    # Generate the session's uuid
+    session_id = str(uuid.uuid4())
+
+    # Generate the session's content
+    session_content = new_session_content(handle, category, ssn)
+    stored_content = session_content
+
+    # With a cart store, the cart is kept there instead of in the session
+    # (the returned content holds the user's cart, found in the store)
+    if carts != None and 'cart' in session_content:
+        stored_content = {key: value for key, value in session_content.items() if key != 'cart'}
+        session_content['cart'] = carts.get(handle)[0]
+
+    # Add session into the session store
+    sessions.create(session_id, stored_content, handle)
+
+    return session_id, session_content
 
 
 def is_authorized(category='any'):
@@ -107,134 +433,300 @@ def is_authorized(category='any'):
     except Exception:
         return 401
 
-    if auth == None or auth not in sessions:
+    if auth == None:
         return 401
 
+    # The session is read from the store once per request,
+    # and is available to the endpoint as g.session
+    session = sessions.get(auth)
+
+    if session == None:
+        return 401
+
+    g.session = session
+
     if category == 'any':
         return auth
 
     # Administrator Authorization Check ...
     if category == 'administrator':
-        if sessions[auth]['category'] != 'administrator':
+        if session['category'] != 'administrator':
             return 403
 
     # User Authorization Check ...
     if category == 'user':
-        if sessions[auth]['category'] != 'user':
+        if session['category'] != 'user':
             return 403
 
     return auth
 
 
-def age(ssn):
-    birth_year = int(str(ssn)[4:6])
-    current_year = int(str(date.today().year)[2:4])
+# Route Decorators ...
 
-    if current_year < birth_year:
-        current_year += 100
+def authorized(category='any'):
 
-    return current_year - birth_year
+    # Answers 401/403 before the route reads the body of the request.
+    # The session is available to the route as g.session,
+    # and its id (the Authorization header) as g.auth.
 
+    def decorator(route):
 
-def is_credit_valid(credit):
+        @functools.wraps(route)
+        def authorized_route(*args, **kwargs):
+            auth = is_authorized(category)
 
-    # Credit should be an integer
-    if not isinstance(credit, int):
-        return False
+            if auth == 401:
+                return status_response(401)
+            if auth == 403:
+                return status_response(403)
 
-    credit = str(credit)
+            g.auth = auth
 
-    # Credit should be 16-digits long
-    if len(credit) != 16:
-        return False
+            # Each session has its own rate limit
+            response = throttled('session', auth)
+            if response != None:
+                return response
 
-    return True
+            return route(*args, **kwargs)
 
+        return authorized_route
 
-# Endpoints (Routes and Functions) ...
+    return decorator
 
 
-# Guest Endpoints ...
+def client_rate_limited(route):
 
+    # The guest endpoints have a rate limit per client IP address
 
-# 01. Sign-Up
-@app.route('/signup', methods=['POST'])
-def signup():
+    @functools.wraps(route)
+    def client_rate_limited_route(*args, **kwargs):
+        response = throttled('client', request.remote_addr or '')
+        if response != None:
+            return response
 
-    # Request-Body-JSON-Data Validation ...
+        return route(*args, **kwargs)
 
-    data = None
+    return client_rate_limited_route
 
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
 
-    if (data == None or
-            'name' not in data or
-            'email' not in data or
-            'password' not in data or
-            'ssn' not in data or
-            not is_ssn_valid(data['ssn'])):
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+def validated(validator):
+
+    # Answers 400 if the body of the request is not JSON,
+    # and 422 if it does not satisfy the schema (see validation.py);
+    # otherwise the body is passed to the route as 'data'
+
+    def decorator(route):
+
+        @functools.wraps(route)
+        def validated_route(*args, **kwargs):
+            data = request_json()
+
+            if data is INVALID_JSON:
+                return status_response(400)
+
+            if not validator(data):
+                return status_response(422)
+
+            return route(data, *args, **kwargs)
+
+        return validated_route
+
+    return decorator
+
+
+def idempotent(scope):
+
+    # Answers a request retried with the same Idempotency-Key header with
+    # the response of the first one, without running the route again
+    # (see idempotency.py). The keys of an authorized route belong to the
+    # user of the session; those of a guest to its IP address and the
+    # email of the body, so that two guests cannot share a key.
+    # Requests without the header are served as usual.
+    # (applied below validated: the route takes the body as 'data')
+
+    def decorator(route):
+
+        @functools.wraps(route)
+        def idempotent_route(data, *args, **kwargs):
+            key = request.headers.get(idempotency.HEADER)
+
+            if key == None:
+                return route(data, *args, **kwargs)
+
+            if not idempotency.is_key_valid(key):
+                return status_response(400)
+
+            if 'session' in g:
+                owner = g.session.get('email', g.session.get('username'))
+            else:
+                owner = str(request.remote_addr) + ' ' + str(data.get('email'))
+
+            state, stored = idempotency_keys.begin(scope, owner, key,
+                                                   idempotency.fingerprint(request.get_data()))
+
+            if state == idempotency.REPLAY:
+                response = Response(stored['body'],
+                                    status=stored['status'],
+                                    mimetype=stored['mimetype'])
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            if state == idempotency.MISMATCH:
+                return status_response(422)
+
+            if state == idempotency.IN_PROGRESS:
+                response = status_response(409)
+                response.headers['Retry-After'] = '1'
+                return response
+
+            try:
+                response = route(data, *args, **kwargs)
+            except Exception:
+                idempotency_keys.abandon(scope, owner, key)
+                raise
 
-    # Conflict Detection ...
+            if response.status_code >= 500 or response.is_streamed:
+                idempotency_keys.abandon(scope, owner, key)
+            else:
+                idempotency_keys.complete(scope, owner, key, response.status_code,
+                                          response.mimetype, response.get_data())
 
-    # A conflict may occur,
-    # if a user with the provided email or ssn
-    # is already present in the database
+            return response
 
-    result = users.find_one({'$or': [
-        {'email': data['email']},
-        {'ssn': data['ssn']}
-    ]})
+        return idempotent_route
 
-    if result != None:
-        return Response('Conflict',
-                        status=409,
+    return decorator
+
+
+def is_adult(session):
+
+    # Sessions created before 'adultFrom' was kept in the session
+    # fall back to reading the user's SSN from the database
+    if 'adultFrom' not in session:
+        user = users.find_one({'email': session['email']}, {'ssn': 1})
+        session['adultFrom'] = adult_from(user['ssn'])
+
+    return date.today().year >= session['adultFrom']
+
+
+def purchase(lines, held=None):
+
+    # Subtracts the quantity of each (product_id, quantity) line
+    # from the product's stock, if the stock is sufficient,
+    # with a conditional update per line (see common.py).
+    # (held: the quantities reserved by the cart, see reservations.py)
+    # Returns the set of product_ids that could not be purchased.
+
+    failed = set()
+
+    for product_id, quantity in lines:
+        if products.update_one(*purchase_update(product_id, quantity, held)).matched_count == 0:
+            failed.add(product_id)
+
+    return failed
+
+
+def newest_order(email):
+    # (a single lookup of the email/timestamp/_id index, see orders.py)
+    return orders_collection.find_one({'email': email}, {'timestamp': 1},
+                                      sort=NEWEST_ORDER_FIRST)
+
+
+def order_history_etag(email, newest, data):
+
+    # Orders are only ever added, or all deleted with the account, so the
+    # order history only changes with its newest order (None: no orders);
+    # the page asked for (limit, before) is part of the tag
+
+    if newest != None:
+        newest = (newest['timestamp'], newest['_id'])
+
+    return etags.make_etag('order-history', email, newest,
+                           data.get('limit'), data.get('before'))
+
+
+def catalog_changed(product_ids=()):
+
+    # Called after products have been created, updated or deleted,
+    # to drop whatever this process has cached about them, to make
+    # every process drop its cached search responses, and to bring
+    # the catalog replica of this process up to date at once
+    for product_id in product_ids:
+        products_cache.invalidate(product_id)
+
+    search_results.bump()
+
+    if catalog != None:
+        catalog.refresh(product_ids)
+
+
+def search_response(status, body, next_cursor):
+
+    # A product-search response, made or cached by product_search
+    if status != 200:
+        return status_response(status)
+
+    response = Response(body,
+                        status=200,
                         mimetype='application/json')
 
+    if next_cursor != None:
+        response.headers['X-Next-Cursor'] = next_cursor
+
+    return response
+
+
+# Endpoints (Routes and Functions) ...
+
+
+# Guest Endpoints ...
+
+
+# 01. Sign-Up
+@app.route('/signup', methods=['POST'])
+@client_rate_limited
+@validated(validation.SIGNUP)
+@idempotent('signup')
+def signup(data):
+
     # Insert New User ...
 
-    users.insert_one({
-        'ssn': data['ssn'],
-        'name': data['name'],
-        'email': data['email'],
-        'password': data['password'],
-        'category': 'user',
-        'orderHistory': []
-    })
+    # A conflict occurs if a user with the provided email or ssn
+    # is already present in the database: the insert is then rejected
+    # by the unique indexes of Users (see indexes.py), so that the check
+    # and the insert are a single round trip, and two concurrent signups
+    # with the same email cannot both succeed
 
-    return Response('OK',
-                    status=200,
-                    mimetype='application/json')
+    try:
+        users.insert_one({
+            'ssn': data['ssn'],
+            'name': data['name'],
+            'email': data['email'],
+            'password': data['password'],
+            'category': 'user'
+        })
+    except DuplicateKeyError:
+        return status_response(409)
+
+    return status_response(200)
 
 
 # 02. Log-In
 @app.route('/login', methods=['POST'])
+@client_rate_limited
 def login():
 
     # Request-Body-JSON-Data Validation ...
 
-    data = None
+    data = request_json()
 
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
+    if data is INVALID_JSON:
+        return status_response(400)
 
     if (data == None or
             'password' not in data or
             'username' not in data and 'email' not in data):
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+        return status_response(422)
 
     # Authentication Check ...
 
@@ -247,20 +739,20 @@ def login():
         {handle: data[handle], 'password': data['password']})
 
     if result == None:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
+        return status_response(401)
 
     # Authorization Check ...
-    session_id = generate_session(result[handle], result['category'])
+    session_id, session_content = generate_session(result[handle],
+                                                   result['category'],
+                                                   result.get('ssn'))
 
     # Response ...
 
     response = {}
     response['Authorization'] = session_id
-    response['Session Items'] = sessions[session_id]
+    response['Session Items'] = session_content
 
-    return Response(json.dumps(response),
+    return Response(dumps(response),
                     status=200,
                     mimetype='application/json')
 
@@ -270,181 +762,199 @@ def login():
 
 # 03. Product-Search
 @app.route('/product-search', methods=['POST'])
+@authorized()
 def product_search():
 
-    # Check Authorization ...
-
-    auth = is_authorized()
-
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
-
     # Request-Body-JSON-Data Validation ...
 
-    data = None
+    data = request_json()
 
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
+    if data is INVALID_JSON:
+        return status_response(400)
 
     if data == None:
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+        return status_response(422)
 
     # Find Products ...
 
     if '_id' in data:  # Find Product By _id ...
-        results = products.find({'_id': ObjectId(data['_id'])})
+        query = {'_id': ObjectId(data['_id'])}
 
     elif 'name' in data:  # Find Products By name ...
-        results = products.find(
-            {'name': {'$regex': data['name'].lower()}}).sort('price')
+        query = search.name_filter(data['name'])
 
     elif 'category' in data:  # Find Products By category ...
-        results = products.find(
-            {'category': {'$regex': data['category'].lower()}}).sort('price')
+        query = search.category_filter(data['category'])
+
+    elif 'text' in data:  # Find Products By words in name or description ...
+        query = search.text_filter(data['text'])
 
     else:
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+        query = None
+
+    if query == None:
+        return status_response(422)
+
+    # Pagination ...
+    # (optional: 'limit' items per page, starting 'after' the cursor
+    #  returned in the X-Next-Cursor header of the previous page)
+
+    if 'limit' in data and not pagination.is_limit_valid(data['limit']):
+        return status_response(422)
+
+    after = None
+
+    if 'after' in data:
+        after = pagination.decode_cursor(data['after'])
+
+        if after == None:
+            return status_response(422)
+
+        query = {'$and': [
+            query,
+            pagination.keyset_filter('price', after[0], after[1])
+        ]}
+
+    # In-Process Catalog Replica ...
+    # (searches by _id and category, see catalog_replica.py)
+
+    results = None
+
+    if catalog != None:
+        results = catalog.search(data, after)
+
+    from_replica = results != None
+
+    key = search_cache.search_key(data)
+    cache_key = None
+    etag = None
+
+    if not from_replica and key != None:
+
+        # Conditional Request ...
+        # (the response only changes with the catalog generation, see etags.py)
+
+        generation = search_results.generation()
+        etag = etags.make_etag('product-search', generation, key)
+
+        if etags.matches(request.if_none_match, etag):
+            return not_modified(etag)
+
+        # Cached Response ...
+        # (see search_cache.py)
+
+        if search_results.enabled():
+            cache_key = key
+
+            cached = search_results.get(cache_key, generation)
+
+            if cached != None:
+                return tagged(search_response(*cached), etag)
+
+    if not from_replica:
+        results = products.find(query, PRODUCT_FIELDS).sort(PRICE_ORDER)
+
+        if 'limit' in data:
+            results.limit(data['limit'])
+        else:
+            results.batch_size(STREAM_BATCH_SIZE)
 
     # Response ...
 
-    response = []  # Initialize the response array
-    # Construct the response array
-    for result in results:
-        product = {
-            # ObjectId would be problematic in JSON encoding,
-            # so it is replaced by its string representation
-            'Product ID': str(result['_id']),
-            'Product Information': {
-                'name': result['name'],
-                'price': result['price'],
-                'category': result['category'],
-                'description': result['description']
-            }
-        }
+    if 'limit' in data or from_replica:
 
-        response.append(product)
+        # A single page is at most MAX_PAGE_SIZE products, and the results
+        # of the replica are in memory already, so the body is built at once
+        page = list(results)
 
-    if len(response) == 0:
-        return Response('Not Found',
-                        status=404,
-                        mimetype='application/json')
+        if len(page) == 0:
+            if cache_key != None:
+                search_results.put(cache_key, generation, 404)
+            return status_response(404)
 
-    return Response(json.dumps(response),
-                    status=200,
-                    mimetype='application/json')
+        body = dumps([product_item(result) for result in page])
+        next_cursor = None
 
+        if 'limit' in data and len(page) == data['limit']:
+            last = page[-1]
+            next_cursor = pagination.encode_cursor(last['price'], last['_id'])
 
-# Administrator Endpoints ...
+        if cache_key != None:
+            search_results.put(cache_key, generation, 200, body, next_cursor)
 
+        # The replica may lag behind the catalog generation,
+        # so its responses are tagged by their content instead
+        if from_replica:
+            etag = etags.make_etag('product-search', body, next_cursor)
 
-# 04. Create-Product
-@app.route('/admin/create-product', methods=['POST'])
-def create_product():
+            if etags.matches(request.if_none_match, etag):
+                return not_modified(etag)
 
-    # Check Authorization ...
+        response = search_response(200, body, next_cursor)
 
-    auth = is_authorized('administrator')
+        if etag != None:
+            response.set_etag(etag)
 
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
+        return response
 
-    # Request-Body-JSON-Data Validation ...
+    # Without a limit, all the matching products are returned,
+    # streamed one by one from the cursor, so that the whole
+    # result never has to be held in memory.
 
-    data = None
+    first = next(results, None)
 
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
+    if first == None:
+        if cache_key != None:
+            search_results.put(cache_key, generation, 404)
+        return status_response(404)
 
-    if (data == None or
-            'name' not in data or
-            'category' not in data or
-            'description' not in data or
-            'stock' not in data or
-            not isinstance(data['stock'], int) or
-            data['stock'] < 0 or
-            'price' not in data or
-            not isinstance(data['price'], (int, float)) or
-            data['price'] < 0.0):
-        return Response('Unprocessable Entity',
-                        status=422,
+    pieces = stream_json_array(first, results, product_item)
+
+    if cache_key != None:
+        pieces = search_results.caching(cache_key, generation, pieces)
+
+    response = Response(pieces,
+                        status=200,
                         mimetype='application/json')
 
+    if etag != None:
+        response.set_etag(etag)
+
+    return response
+
+
+# Administrator Endpoints ...
+
+
+# 04. Create-Product
+@app.route('/admin/create-product', methods=['POST'])
+@authorized('administrator')
+@validated(validation.CREATE_PRODUCT)
+def create_product(data):
+
     # Insert New Product ...
 
-    products.insert_one({
+    product = {
         'name': data['name'].lower(),
         'category': data['category'].lower(),
         'price': data['price'],
         'stock': data['stock'],
         'description': data['description']
-    })
-
-    return Response('OK',
-                    status=200,
-                    mimetype='application/json')
-
-
-# 05. Update-Product
-@app.route('/admin/update-product', methods=['PUT'])
-def update_product():
-
-    # Check Authorization ...
-
-    auth = is_authorized('administrator')
+    }
+    product['searchTerms'] = search.search_terms(product)
 
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
+    products.insert_one(product)
 
-    # Request-Body-JSON-Data Validation ...
+    catalog_changed([product['_id']])
 
-    data = None
+    return status_response(200)
 
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
 
-    if (data == None or
-            '_id' not in data or
-            'stock' in data and
-            (not isinstance(data['stock'], int) or data['stock'] < 0) or
-            'price' in data and
-            (not isinstance(data['price'], (int, float)) or data['price'] < 0)):
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+# 05. Update-Product
+@app.route('/admin/update-product', methods=['PUT'])
+@authorized('administrator')
+@validated(validation.UPDATE_PRODUCT)
+def update_product(data):
 
     # Update Product ...
 
@@ -457,75 +967,46 @@ def update_product():
             update_set[key] = data[key]
 
     if len(update_set.keys()) == 0:
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+        return status_response(422)
 
     try:
         if products.update_one({'_id': ObjectId(data['_id'])},
                                {'$set': update_set}).modified_count == 0:
-            return Response('Not Found',
-                            status=404,
-                            mimetype='application/json')
+            return status_response(404)
+
+        # Keep the search terms in line with the new name/category/description
+        if ('name' in update_set or
+                'category' in update_set or
+                'description' in update_set):
+            search.refresh_search_terms(products, ObjectId(data['_id']))
+
+        # (once the search terms are up to date,
+        #  so that no search can cache the old ones)
+        catalog_changed([ObjectId(data['_id'])])
     except Exception:
-        return Response('Internal Server Error',
-                        status=500,
-                        mimetype='application/json')
+        return status_response(500)
 
-    return Response('OK',
-                    status=200,
-                    mimetype='application/json')
+    return status_response(200)
 
 
 # 06. Delete-Product
 @app.route('/admin/delete-product', methods=['DELETE'])
-def delete_product():
-
-    # Check Authorization ...
-
-    auth = is_authorized('administrator')
-
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
-
-    # Request-Body-JSON-Data Validation ...
-
-    data = None
-
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
-
-    if data == None or '_id' not in data:
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+@authorized('administrator')
+@validated(validation.DELETE_PRODUCT)
+def delete_product(data):
 
     # Delete Product ...
 
     try:
         if products.delete_one(
                 {'_id': ObjectId(data['_id'])}).deleted_count == 0:
-            return Response('Not Found',
-                            status=404,
-                            mimetype='application/json')
+            return status_response(404)
+
+        catalog_changed([ObjectId(data['_id'])])
     except Exception:
-        return Response('Internal Server Error',
-                        status=500,
-                        mimetype='application/json')
+        return status_response(500)
 
-    return Response('OK',
-                    status=200,
-                    mimetype='application/json')
+    return status_response(200)
 
 
 # User Endpoints ...
@@ -533,66 +1014,41 @@ def delete_product():
 
 # 07. Add-To-Cart
 @app.route('/user/add-to-cart', methods=['POST'])
-def add_to_cart():
-
-    # Check Authorization ...
-
-    auth = is_authorized('user')
-
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
-
-    # Request-Body-JSON-Data Validation ...
-
-    data = None
-
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
-
-    if (data == None or
-            '_id' not in data or
-            'quantity' not in data or
-            (not isinstance(data['quantity'], int) or data['quantity'] < 1)):
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+@authorized('user')
+@validated(validation.ADD_TO_CART)
+def add_to_cart(data):
 
     # Retrieve Product ...
+    # (from the products cache: only the stock has to be read from the database)
 
-    result = products.find_one({'_id': ObjectId(data['_id'])})
+    result = products_cache.get(ObjectId(data['_id']))
 
     if result == None:
-        return Response('Not Found',
-                        status=404,
-                        mimetype='application/json')
+        return status_response(404)
 
     # Underage users should not be able to purchase products from the categories:
     #   - analgesic
     #   - antibiotic
     #   - antiseptic
 
-    # Retrieve user's SSN using email to calculate user's age
-    user = users.find_one({'email': sessions[auth]['email']})
+    # (the user's age is known from the session, see generate_session)
 
-    if (result['category'] in ['analgesic', 'antibiotic', 'antiseptic'] and
-            age(user['ssn']) < 18):
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
+    if (result['category'] in RESTRICTED_CATEGORIES and
+            not is_adult(g.session)):
+        return status_response(403)
+
+    # Reserve Stock ...
+    # (with stock reservations, the quantity is held for the cart,
+    #  if the stock not held by other carts is sufficient)
+
+    if stock_reservations != None:
+        if not stock_reservations.reserve(cart_holder(), g.session['email'],
+                                          result['_id'], data['quantity']):
+            return status_response(409)
 
     # Add Product To Cart ...
 
-    cart = sessions[auth]['cart']
+    cart = current_cart()
 
     product_id = str(result['_id'])
 
@@ -607,91 +1063,75 @@ def add_to_cart():
         }
 
     else:
-        quantity = cart['products'][product_id]['quantity']
+        # (already checked by the reservation, if enabled)
+        if stock_reservations == None:
+            quantity = cart['products'][product_id]['quantity']
 
-        if result['stock'] < quantity + data['quantity']:
-            return Response('Conflict',
-                            status=409,
-                            mimetype='application/json')
+            stock = products.find_one({'_id': result['_id']}, {'stock': 1})
+
+            if stock == None:
+                return status_response(404)
+
+            if stock['stock'] < quantity + data['quantity']:
+                return status_response(409)
 
         cart['products'][product_id]['quantity'] += data['quantity']
 
     cart['total'] += data['quantity'] * result['price']
 
+    save_cart()
+
     # Response ...
+    # (tagged like view-cart, whose next poll is then answered by a 304)
 
-    return Response(json.dumps(cart),
-                    status=200,
-                    mimetype='application/json')
+    return tagged(Response(dumps(cart),
+                           status=200,
+                           mimetype='application/json'), cart_etag())
 
 
 # 08. View-Cart
 @app.route('/user/view-cart', methods=['POST'])
+@authorized('user')
 def view_cart():
 
-    # Check Authorization ...
+    cart = current_cart()
 
-    auth = is_authorized('user')
+    # Conditional Request ...
+    # (the cart only changes with its version, see etags.py)
 
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
+    etag = cart_etag()
 
-    cart = sessions[auth]['cart']
+    if etags.matches(request.if_none_match, etag):
+        return not_modified(etag)
 
-    return Response(json.dumps(cart),
-                    status=200,
-                    mimetype='application/json')
+    return tagged(Response(dumps(cart),
+                           status=200,
+                           mimetype='application/json'), etag)
 
 
 # 09. Remove-From-Cart
 @app.route('/user/remove-from-cart', methods=['DELETE'])
+@authorized('user')
 def remove_from_cart():
 
-    # Check Authorization ...
-
-    auth = is_authorized('user')
-
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
-
     # Request Body JSON Data Validation ...
 
-    data = None
+    data = request_json()
 
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
+    if data is INVALID_JSON:
+        return status_response(400)
 
     if data == None or '_id' not in data:
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
+        return status_response(422)
 
     # Remove Product From Cart ...
 
-    cart = sessions[auth]['cart']
+    cart = current_cart()
 
     product_id = data['_id']
 
     if product_id not in cart['products']:
-        return Response('Not Found',
-                        status=404,
-                        mimetype='application/json')
+        return status_response(404)
 
     quantity = cart['products'][product_id]['quantity']
     price = cart['products'][product_id]['price']
@@ -706,75 +1146,60 @@ def remove_from_cart():
     if cart['total'] < 0.0:
         cart['total'] = 0.0
 
+    if stock_reservations != None:
+        stock_reservations.release(cart_holder(), ObjectId(product_id))
+
+    save_cart()
+
     # Response ...
 
-    return Response(json.dumps(cart),
-                    status=200,
-                    mimetype='application/json')
+    return tagged(Response(dumps(cart),
+                           status=200,
+                           mimetype='application/json'), cart_etag())
 
 
 # 10. Checkout
 @app.route('/user/checkout', methods=['POST'])
-def checkout():
-
-    # Check Authorization ...
-
-    auth = is_authorized('user')
-
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
-
-    # Request Body JSON Data Validation ...
-
-    data = None
+@authorized('user')
+@validated(validation.CHECKOUT)
+@idempotent('checkout')
+def checkout(data):
 
-    try:
-        data = json.loads(request.data)
-    except Exception:
-        return Response('Bad Request',
-                        status=400,
-                        mimetype='application/json')
-
-    if (data == None or
-            'credit' not in data or (not is_credit_valid(data['credit']))):
-        return Response('Unprocessable Entity',
-                        status=422,
-                        mimetype='application/json')
-
-    cart = sessions[auth]['cart']
+    cart = current_cart()
     receipt = {
         'products': {},
         'total': 0.0
     }
 
-    has_skipped = False  # flags if a product was skipped due to insufficient stock
-
-    # For each product in the cart
-    # retreive the product's stock
-    # if the stock is sufficient,
-    # update the product' stock by subtracting the quantity
-    # then remove the product from the cart, and update total
+    # Purchase every product in the cart at once,
+    # then, for each product that was purchased,
+    # remove the product from the cart, and update total
     # add the product to the receipt, and update receipt total
 
-    for product_id in list(cart['products']):
+    lines = [(product_id, cart['products'][product_id]['quantity'])
+             for product_id in cart['products']]
 
-        product = products.find_one({'_id': ObjectId(product_id)})
+    # With stock reservations, the quantities held by the cart are claimed
+    # first, and purchased along with the rest (see reservations.py)
+    held = None
 
-        price = cart['products'][product_id]['price']
-        quantity = cart['products'][product_id]['quantity']
+    if stock_reservations != None:
+        token, held = stock_reservations.claim(cart_holder())
+
+    skipped = purchase(lines, held)
+
+    if stock_reservations != None:
+        stock_reservations.settle(token, [product_id for product_id, quantity in lines
+                                          if product_id not in skipped])
+
+    has_skipped = len(skipped) > 0  # flags if a product was skipped due to insufficient stock
 
-        if product['stock'] < quantity:
-            has_skipped = True
+    for product_id, quantity in lines:
+
+        if product_id in skipped:
             continue
 
-        products.update_one({'_id': ObjectId(product_id)}, {
-                            '$inc': {'stock': - quantity}})
+        price = cart['products'][product_id]['price']
 
         cart['total'] -= quantity * price
         receipt['total'] += quantity * price
@@ -789,6 +1214,14 @@ def checkout():
     if cart['total'] < 0.0:
         cart['total'] = 0.0
 
+    if len(receipt['products']) > 0:
+        save_cart()
+
+        # The purchased products must not come back with the cart,
+        # so a cart store writes the cart at once
+        if carts != None:
+            carts.flush([g.session['email']])
+
     # If any products in the cart couldn't be purchased,
     # add a message to the receipt informing the client.
     if has_skipped:
@@ -796,75 +1229,361 @@ def checkout():
 
     receipt['timestamp'] = time.time()
 
-    # Add receipt to orderHistory
-    email = sessions[auth]['email']
-    users.update_one({'email': email}, {'$push': {'orderHistory': receipt}})
+    # Add receipt to the user's orders
+    email = g.session['email']
+    orders_collection.insert_one(dict(receipt, email=email))
 
-    return Response(json.dumps(receipt),
+    return Response(dumps(receipt),
                     status=200,
                     mimetype='application/json')
 
 
 # 11. View-Order-History
 @app.route('/user/view-order-history', methods=['POST'])
+@authorized('user')
 def view_order_history():
 
-    # Check Authorization ...
+    # Request-Body-JSON-Data Validation ...
+    # (the body is optional, it is only needed for pagination)
 
-    auth = is_authorized('user')
+    data = {}
 
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
+    if len(request.data) > 0:
+        data = request_json()
+
+        if data is INVALID_JSON:
+            return status_response(400)
+
+        if not isinstance(data, dict):
+            return status_response(422)
+
+    if 'limit' in data and not pagination.is_limit_valid(data['limit']):
+        return status_response(422)
+
+    # Retrieve user's orders using email
+
+    email = g.session['email']
+    query = {'email': email}
+
+    # Conditional Request ...
+    # (only looked up when the client holds a tag; otherwise the tag of the
+    #  response is made from the page read below, see order_history_etag)
+
+    etag = None
+
+    if request.if_none_match:
+        etag = order_history_etag(email, newest_order(email), data)
+
+        if etags.matches(request.if_none_match, etag):
+            return not_modified(etag)
+
+    if 'before' in data:
+        before = pagination.decode_cursor(data['before'])
 
-    # Retrieve user's orderHistory using email
+        if before == None:
+            return status_response(422)
 
-    user_email = sessions[auth]['email']
+        query = {'$and': [
+            query,
+            pagination.keyset_filter('timestamp', before[0], before[1], -1)
+        ]}
 
-    user = users.find_one({'email': user_email})
+    if 'limit' in data:
 
-    order_history = user['orderHistory']
+        # A page holds the 'limit' most recent orders before the cursor,
+        # listed in chronological order like the full order history.
+        # The cursor of the next (older) page is in the X-Next-Cursor header.
+
+        page = list(orders_collection.find(query, ORDER_FIELDS)
+                    .sort(NEWEST_ORDER_FIRST)
+                    .limit(data['limit']))
+        page.reverse()
+
+        if etag == None:
+            # (the first page ends with the newest order)
+            if 'before' in data:
+                newest = newest_order(email)
+            elif len(page) > 0:
+                newest = page[-1]
+            else:
+                newest = None
+
+            etag = order_history_etag(email, newest, data)
+
+        response = tagged(Response(dumps([order_item(order) for order in page]),
+                                   status=200,
+                                   mimetype='application/json'), etag)
+
+        if len(page) == data['limit']:
+            oldest = page[0]
+            response.headers['X-Next-Cursor'] = pagination.encode_cursor(
+                oldest['timestamp'], oldest['_id'])
+
+        return response
 
     # Response ...
+    # (the whole order history, streamed from the cursor)
 
-    return Response(json.dumps(order_history),
-                    status=200,
-                    mimetype='application/json')
+    if etag == None:
+        etag = order_history_etag(email, newest_order(email), data)
+
+    results = orders_collection.find(query, ORDER_FIELDS).sort(OLDEST_ORDER_FIRST)
+    results.batch_size(STREAM_BATCH_SIZE)
+
+    first = next(results, None)
+
+    if first == None:
+        return tagged(Response(dumps([]),
+                               status=200,
+                               mimetype='application/json'), etag)
+
+    return tagged(Response(stream_json_array(first, results, order_item),
+                           status=200,
+                           mimetype='application/json'), etag)
 
 
 # 12. Delete-Account
 @app.route('/user/delete-account', methods=['DELETE'])
+@authorized('user')
 def delete_account():
 
-    # Check Authorization ...
+    user_email = g.session['email']
 
-    auth = is_authorized('user')
+    # Revoke every session of the user, not only the current one
+    sessions.revoke(user_email)
 
-    if auth == 401:
-        return Response('Unauthorized',
-                        status=401,
-                        mimetype='application/json')
-    if auth == 403:
-        return Response('Forbidden',
-                        status=403,
-                        mimetype='application/json')
+    if stock_reservations != None:
+        stock_reservations.release_owner(user_email)
 
-    user_email = sessions[auth]['email']
+    if carts != None:
+        carts.delete(user_email)
 
-    del sessions[auth]
     users.delete_one({'email': user_email})
+    orders_collection.delete_many({'email': user_email})
+
+    return status_response(200)
 
-    return Response('OK',
+
+# 13. Metrics
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+
+    # Prometheus text format, see metrics.py
+    return Response(metrics.registry.render(),
+                    status=200,
+                    mimetype='text/plain; version=0.0.4')
+
+
+# Bulk Administrator Endpoints ...
+# (the body is NDJSON, one product per line, see catalog_io.py)
+
+
+# 14. Create-Products
+@app.route('/admin/create-products', methods=['POST'])
+@authorized('administrator')
+def create_products():
+
+    result = catalog_io.create_products(products, request.stream,
+                                        changed=catalog_changed)
+
+    return Response(dumps(result),
                     status=200,
                     mimetype='application/json')
 
 
+# 15. Update-Products
+@app.route('/admin/update-products', methods=['PUT'])
+@authorized('administrator')
+def update_products():
+
+    result = catalog_io.update_products(products, request.stream,
+                                        changed=catalog_changed)
+
+    return Response(dumps(result),
+                    status=200,
+                    mimetype='application/json')
+
+
+# 16. Delete-Products
+@app.route('/admin/delete-products', methods=['DELETE'])
+@authorized('administrator')
+def delete_products():
+
+    result = catalog_io.delete_products(products, request.stream,
+                                        changed=catalog_changed)
+
+    return Response(dumps(result),
+                    status=200,
+                    mimetype='application/json')
+
+
+# 17. Export-Products
+@app.route('/admin/export-products', methods=['GET'])
+@authorized('administrator')
+def export_products():
+
+    return Response(catalog_io.export_products(products),
+                    status=200,
+                    mimetype='application/x-ndjson')
+
+
+# Batch User Endpoints ...
+
+
+# 18. Update-Cart
+@app.route('/user/update-cart', methods=['POST'])
+@authorized('user')
+@validated(validation.UPDATE_CART)
+def update_cart(data):
+
+    # Several changes of the cart in a single request:
+    #
+    #     {"remove": ["<_id>", ...],
+    #      "set": [{"_id": "<_id>", "quantity": 3}, ...],   (0 removes the product)
+    #      "add": [{"_id": "<_id>", "quantity": 1}, ...]}
+    #
+    # applied in that order, all or none of them: if a change cannot be made
+    # the cart is left as it was, and the response is the status the single
+    # product endpoints would have answered (404, 403 or 409).
+
+    # Request-Body-JSON-Data Validation ...
+
+    if 'remove' not in data and 'set' not in data and 'add' not in data:
+        return status_response(422)
+
+    remove = data.get('remove', [])
+    set_changes = data.get('set', [])
+    add = data.get('add', [])
+
+    if (not all(isinstance(product_id, str) and ObjectId.is_valid(product_id)
+                for product_id in remove) or
+            not all(validation.SET_CART_QUANTITY(change) and ObjectId.is_valid(change['_id'])
+                    for change in set_changes) or
+            not all(validation.ADD_CART_QUANTITY(change) and ObjectId.is_valid(change['_id'])
+                    for change in add)):
+        return status_response(422)
+
+    # (the _ids as the cart writes them)
+    remove = [str(ObjectId(product_id)) for product_id in remove]
+    set_changes = [(str(ObjectId(change['_id'])), change['quantity']) for change in set_changes]
+    add = [(str(ObjectId(change['_id'])), change['quantity']) for change in add]
+
+    # Retrieve Products ...
+    # (every product that is set or added, with a single query)
+
+    product_ids = {ObjectId(product_id) for product_id, quantity in set_changes + add}
+    found = {}
+
+    if len(product_ids) > 0:
+        found = {str(product['_id']): product
+                 for product in products.find({'_id': {'$in': list(product_ids)}},
+                                              dict(PRODUCT_FIELDS, stock=1))}
+
+    if len(found) < len(product_ids):
+        return status_response(404)
+
+    # Underage users should not be able to purchase products from the
+    # restricted categories (checked once, for all the products)
+
+    if (any(product['category'] in RESTRICTED_CATEGORIES for product in found.values()) and
+            not is_adult(g.session)):
+        return status_response(403)
+
+    # New Quantities ...
+
+    cart = current_cart()
+
+    previous = {product_id: line['quantity'] for product_id, line in cart['products'].items()}
+    quantities = dict(previous)
+
+    for product_id in remove:
+        if product_id not in quantities:
+            return status_response(404)
+
+        del quantities[product_id]
+
+    for product_id, quantity in set_changes:
+        if quantity == 0:
+            quantities.pop(product_id, None)
+        else:
+            quantities[product_id] = quantity
+
+    for product_id, quantity in add:
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+    if quantities == previous:
+        return tagged(Response(dumps(cart),
+                               status=200,
+                               mimetype='application/json'), cart_etag())
+
+    # Stock ...
+    # (for the products whose quantity grows; with stock reservations,
+    #  the growth is held, all or nothing, see reservations.py)
+
+    grown = {product_id: quantity - previous.get(product_id, 0)
+             for product_id, quantity in quantities.items()
+             if quantity > previous.get(product_id, 0)}
+
+    if stock_reservations == None:
+        for product_id in grown:
+            if found[product_id]['stock'] < quantities[product_id]:
+                return status_response(409)
+    else:
+        failed = stock_reservations.reserve_many(
+            cart_holder(), g.session['email'],
+            {ObjectId(product_id): growth for product_id, growth in grown.items()})
+
+        if len(failed) > 0:
+            return status_response(409)
+
+        for product_id, quantity in previous.items():
+            if quantities.get(product_id, 0) < quantity:
+                stock_reservations.reduce(cart_holder(), ObjectId(product_id),
+                                          quantity - quantities.get(product_id, 0))
+
+    # Update Cart ...
+
+    for product_id in previous:
+        if product_id not in quantities:
+            line = cart['products'].pop(product_id)
+            cart['total'] -= line['quantity'] * line['price']
+
+    for product_id, quantity in quantities.items():
+        line = cart['products'].get(product_id)
+
+        if line == None:
+            product = found[product_id]
+
+            cart['products'][product_id] = {
+                'name': product['name'],
+                'price': product['price'],
+                'quantity': quantity,
+                'category': product['category'],
+                'description': product['description']
+            }
+
+            cart['total'] += quantity * product['price']
+
+        elif line['quantity'] != quantity:
+            cart['total'] += (quantity - line['quantity']) * line['price']
+            line['quantity'] = quantity
+
+    # Correct for Float arithmetic error
+    if cart['total'] < 0.0:
+        cart['total'] = 0.0
+
+    save_cart()
+
+    # Response ...
+
+    return tagged(Response(dumps(cart),
+                           status=200,
+                           mimetype='application/json'), cart_etag())
+
+
 if __name__ == '__main__':
     # run the application with a development server
     # in debug mode, on localhost, at port 5000
+    # (in production the application is served by gunicorn,
+    #  see gunicorn.conf.py)
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -0,0 +1,770 @@
+# The ASGI version of the web service.
+#
+# The same twelve endpoints as app.py, with the same responses,
+# served by Quart (the asyncio implementation of the Flask API)
+# on pymongo's asynchronous driver (AsyncMongoClient).
+#
+# A request waiting for MongoDB does not hold a thread, so a single
+# worker process can serve many concurrent connections, and database
+# operations that do not depend on each other run concurrently.
+#
+# Run with gunicorn (WEB_APP=asgi, see gunicorn.conf.py) or, for development:
+#
+#     python3 asgi.py
+#
+# Only the endpoints are ported: the products cache and the search cache of
+# app.py are not used here (the product is read from the database by
+# add-to-cart), but the catalog generation is still incremented on every
+# change of the products, for the search caches of the WSGI workers. Nor
+# are the ETags and the compression of app.py (see etags.py), but the
+# version of the cart is kept up to date, for the WSGI workers sharing
+# the session store.
+#
+# Stock reservations (see reservations.py), the cart store (see
+# cart_store.py), rate limiting and load shedding (see rate_limit.py) are
+# not supported either: the application refuses to start with any of them
+# enabled, rather than leaking held stock or losing carts next to WSGI
+# workers that use them. Nor is the Idempotency-Key header of signup and
+# checkout (see idempotency.py): a request sending it is answered with 400,
+# rather than run again when it is retried.
+#
+# The request bodies are checked by the schemas of validation.py, as in app.py.
+
+from quart import Quart, request, Response, g
+
+from pymongo import AsyncMongoClient, MongoClient
+from pymongo.errors import DuplicateKeyError
+
+import asyncio
+import time  # Used in checkout
+import uuid  # Used in session generation
+
+from bson.objectid import ObjectId
+
+from datetime import date  # To get current year in 'is_adult' function
+
+import os
+
+# To decode request data and encode response data as JSON
+from serialization import loads, dumps, dumps_items, ITEM_SEPARATOR
+
+import validation  # Request body schemas
+import indexes  # Index migrations, applied at startup
+import search   # Product search queries and search terms
+import pagination  # Keyset pagination cursors
+import session_store  # Session stores (in-process or shared)
+import search_cache  # The catalog generation, read by the search cache of app.py
+import reservations  # Only to refuse STOCK_RESERVATIONS=1
+import cart_store  # Only to refuse CART_BACKEND=mongo
+import idempotency  # Only to refuse the Idempotency-Key header
+import rate_limit  # Only to refuse RATE_LIMIT=1 and MAX_IN_FLIGHT
+
+# Helper functions shared with the WSGI application (app.py)
+from common import (new_session_content, cart_changed,
+                    RESTRICTED_CATEGORIES, adult_from,
+                    PRODUCT_FIELDS, PRICE_ORDER, STREAM_BATCH_SIZE, product_item,
+                    ORDER_FIELDS, OLDEST_ORDER_FIRST, NEWEST_ORDER_FIRST, order_item,
+                    purchase_update,
+                    mongodb_uri)
+
+
+# The options of app.py that this application does not support
+unsupported = [name for name, enabled in [
+    ('STOCK_RESERVATIONS=1', reservations.STOCK_RESERVATIONS),
+    ('CART_BACKEND=' + cart_store.CART_BACKEND, cart_store.CART_BACKEND != 'session'),
+    ('RATE_LIMIT=1', rate_limit.RATE_LIMIT),
+    ('MAX_IN_FLIGHT=%d' % rate_limit.MAX_IN_FLIGHT, rate_limit.MAX_IN_FLIGHT > 0)
+] if enabled]
+
+if len(unsupported) > 0:
+    raise RuntimeError('The ASGI application does not support ' + ', '.join(unsupported) +
+                       ': serve app.py (WEB_APP=wsgi) instead')
+
+
+# Maximum number of connections to MongoDB per process
+mongo_pool_size = int(os.environ.get('MONGO_POOL_SIZE', 100))
+
+
+client = None    # AsyncMongoClient of this process
+db = None        # The 'DSPharmacy' database
+users = None     # The 'Users' collection
+products = None  # The 'Products' collection
+orders_collection = None  # The 'Orders' collection
+sessions = None  # The session store (see session_store.py)
+
+
+# Initialize the application as an instance of the Quart class
+app = Quart(__name__)
+
+
+@app.before_serving
+async def connect_database():
+
+    # The client is created once the event loop of the worker is running
+    # (i.e. after the fork of the worker, see gunicorn.conf.py)
+
+    global client, db, users, products, orders_collection, sessions
+
+    # Apply any pending index migrations ...
+    # (with the synchronous driver, in a thread, see indexes.py)
+    if os.environ.get('MIGRATE_ON_STARTUP', '1') == '1':
+        await asyncio.to_thread(migrate)
+
+    client = AsyncMongoClient(mongodb_uri(), maxPoolSize=mongo_pool_size)
+
+    db = client['DSPharmacy']
+
+    users = db['Users']
+    products = db['Products']
+    orders_collection = db['Orders']
+
+    sessions = session_store.create_async_store(db)
+
+
+@app.after_serving
+async def disconnect_database():
+    await client.close()
+
+
+def migrate():
+    migration_client = MongoClient(mongodb_uri())
+    try:
+        indexes.migrate(migration_client['DSPharmacy'])
+    finally:
+        migration_client.close()
+
+
+# Helper Functions ...
+
+def respond(body, status):
+    return Response(body, status=status, mimetype='application/json')
+
+
+# Returned by request_json when the body of the request is not valid JSON
+INVALID_JSON = object()
+
+
+async def request_json():
+
+    try:
+        return loads(await request.get_data())
+    except Exception:
+        return INVALID_JSON
+
+
+async def generate_session(handle, category, ssn=None):
+
+    session_id = str(uuid.uuid4())
+    session_content = new_session_content(handle, category, ssn)
+
+    await sessions.create(session_id, session_content, handle)
+
+    return session_id, session_content
+
+
+async def is_authorized(category='any'):
+
+    # Same as is_authorized in app.py
+
+    auth = request.headers.get('Authorization')
+
+    if auth == None:
+        return 401
+
+    session = await sessions.get(auth)
+
+    if session == None:
+        return 401
+
+    g.session = session
+
+    if category == 'any':
+        return auth
+
+    if category != session['category']:
+        return 403
+
+    return auth
+
+
+def authorization_error(auth):
+    if auth == 401:
+        return respond('Unauthorized', 401)
+    if auth == 403:
+        return respond('Forbidden', 403)
+    return None
+
+
+async def is_adult(session):
+
+    if 'adultFrom' not in session:
+        user = await users.find_one({'email': session['email']}, {'ssn': 1})
+        session['adultFrom'] = adult_from(user['ssn'])
+
+    return date.today().year >= session['adultFrom']
+
+
+async def catalog_changed():
+
+    # Called after a product has been created, updated or deleted, so that
+    # the WSGI workers sharing the database drop their cached search responses
+    await db['Meta'].update_one(search_cache.CATALOG_GENERATION,
+                                search_cache.BUMP_GENERATION, upsert=True)
+
+
+async def stream_json_array(first, rest, to_item, batch_size=STREAM_BATCH_SIZE):
+
+    # The asynchronous version of common.stream_json_array
+
+    batch = [to_item(first)]
+    opening = '['
+
+    async for result in rest:
+        batch.append(to_item(result))
+
+        if len(batch) == batch_size:
+            yield opening + dumps_items(batch)
+            batch = []
+            opening = ITEM_SEPARATOR
+
+    if len(batch) > 0:
+        yield opening + dumps_items(batch) + ']'
+    else:
+        yield ']'
+
+
+async def purchase(lines):
+
+    # Same as purchase in app.py (see common.py),
+    # with the updates of the lines sent concurrently
+
+    results = await asyncio.gather(*[products.update_one(*purchase_update(product_id, quantity))
+                                     for product_id, quantity in lines])
+
+    return {product_id for (product_id, quantity), result in zip(lines, results)
+            if result.matched_count == 0}
+
+
+# Endpoints (Routes and Functions) ...
+
+
+# Guest Endpoints ...
+
+
+# 01. Sign-Up
+@app.route('/signup', methods=['POST'])
+async def signup():
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if not validation.SIGNUP(data):
+        return respond('Unprocessable Entity', 422)
+
+    if idempotency.HEADER in request.headers:
+        return respond('Bad Request', 400)
+
+    # A user with the same email or ssn is rejected by the unique indexes
+    try:
+        await users.insert_one({
+            'ssn': data['ssn'],
+            'name': data['name'],
+            'email': data['email'],
+            'password': data['password'],
+            'category': 'user'
+        })
+    except DuplicateKeyError:
+        return respond('Conflict', 409)
+
+    return respond('OK', 200)
+
+
+# 02. Log-In
+@app.route('/login', methods=['POST'])
+async def login():
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if (data == None or
+            'password' not in data or
+            'username' not in data and 'email' not in data):
+        return respond('Unprocessable Entity', 422)
+
+    if 'username' in data:
+        handle = 'username'
+    else:
+        handle = 'email'
+
+    result = await users.find_one(
+        {handle: data[handle], 'password': data['password']})
+
+    if result == None:
+        return respond('Unauthorized', 401)
+
+    session_id, session_content = await generate_session(result[handle],
+                                                         result['category'],
+                                                         result.get('ssn'))
+
+    response = {}
+    response['Authorization'] = session_id
+    response['Session Items'] = session_content
+
+    return respond(dumps(response), 200)
+
+
+# Endpoints Available to Administrator and User ...
+
+
+# 03. Product-Search
+@app.route('/product-search', methods=['POST'])
+async def product_search():
+
+    auth = await is_authorized()
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if data == None:
+        return respond('Unprocessable Entity', 422)
+
+    if '_id' in data:
+        query = {'_id': ObjectId(data['_id'])}
+    elif 'name' in data:
+        query = search.name_filter(data['name'])
+    elif 'category' in data:
+        query = search.category_filter(data['category'])
+    elif 'text' in data:
+        query = search.text_filter(data['text'])
+    else:
+        query = None
+
+    if query == None:
+        return respond('Unprocessable Entity', 422)
+
+    if 'limit' in data and not pagination.is_limit_valid(data['limit']):
+        return respond('Unprocessable Entity', 422)
+
+    if 'after' in data:
+        after = pagination.decode_cursor(data['after'])
+
+        if after == None:
+            return respond('Unprocessable Entity', 422)
+
+        query = {'$and': [
+            query,
+            pagination.keyset_filter('price', after[0], after[1])
+        ]}
+
+    results = products.find(query, PRODUCT_FIELDS).sort(PRICE_ORDER)
+
+    if 'limit' in data:
+        page = await results.limit(data['limit']).to_list()
+
+        if len(page) == 0:
+            return respond('Not Found', 404)
+
+        response = respond(dumps([product_item(result) for result in page]), 200)
+
+        if len(page) == data['limit']:
+            last = page[-1]
+            response.headers['X-Next-Cursor'] = pagination.encode_cursor(
+                last['price'], last['_id'])
+
+        return response
+
+    results.batch_size(STREAM_BATCH_SIZE)
+
+    first = await anext(results, None)
+
+    if first == None:
+        return respond('Not Found', 404)
+
+    return respond(stream_json_array(first, results, product_item), 200)
+
+
+# Administrator Endpoints ...
+
+
+# 04. Create-Product
+@app.route('/admin/create-product', methods=['POST'])
+async def create_product():
+
+    auth = await is_authorized('administrator')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if not validation.CREATE_PRODUCT(data):
+        return respond('Unprocessable Entity', 422)
+
+    product = {
+        'name': data['name'].lower(),
+        'category': data['category'].lower(),
+        'price': data['price'],
+        'stock': data['stock'],
+        'description': data['description']
+    }
+    product['searchTerms'] = search.search_terms(product)
+
+    await products.insert_one(product)
+
+    await catalog_changed()
+
+    return respond('OK', 200)
+
+
+# 05. Update-Product
+@app.route('/admin/update-product', methods=['PUT'])
+async def update_product():
+
+    auth = await is_authorized('administrator')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if not validation.UPDATE_PRODUCT(data):
+        return respond('Unprocessable Entity', 422)
+
+    update_set = {}
+
+    for key in ['name', 'category', 'description', 'price', 'stock']:
+        if key in data:
+            update_set[key] = data[key]
+
+    if len(update_set.keys()) == 0:
+        return respond('Unprocessable Entity', 422)
+
+    try:
+        product_id = ObjectId(data['_id'])
+
+        result = await products.update_one({'_id': product_id},
+                                           {'$set': update_set})
+        if result.modified_count == 0:
+            return respond('Not Found', 404)
+
+        if ('name' in update_set or
+                'category' in update_set or
+                'description' in update_set):
+            product = await products.find_one(
+                {'_id': product_id}, {'name': 1, 'category': 1, 'description': 1})
+
+            if product != None:
+                await products.update_one(
+                    {'_id': product_id},
+                    {'$set': {'searchTerms': search.search_terms(product)}})
+
+        await catalog_changed()
+    except Exception:
+        return respond('Internal Server Error', 500)
+
+    return respond('OK', 200)
+
+
+# 06. Delete-Product
+@app.route('/admin/delete-product', methods=['DELETE'])
+async def delete_product():
+
+    auth = await is_authorized('administrator')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if not validation.DELETE_PRODUCT(data):
+        return respond('Unprocessable Entity', 422)
+
+    try:
+        result = await products.delete_one({'_id': ObjectId(data['_id'])})
+        if result.deleted_count == 0:
+            return respond('Not Found', 404)
+
+        await catalog_changed()
+    except Exception:
+        return respond('Internal Server Error', 500)
+
+    return respond('OK', 200)
+
+
+# User Endpoints ...
+
+
+# 07. Add-To-Cart
+@app.route('/user/add-to-cart', methods=['POST'])
+async def add_to_cart():
+
+    auth = await is_authorized('user')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if not validation.ADD_TO_CART(data):
+        return respond('Unprocessable Entity', 422)
+
+    # The product and the user's age are looked up concurrently
+    # (the age only needs the database for sessions without 'adultFrom')
+    result, adult = await asyncio.gather(
+        products.find_one({'_id': ObjectId(data['_id'])}),
+        is_adult(g.session))
+
+    if result == None:
+        return respond('Not Found', 404)
+
+    if result['category'] in RESTRICTED_CATEGORIES and not adult:
+        return respond('Forbidden', 403)
+
+    cart = g.session['cart']
+
+    product_id = str(result['_id'])
+
+    if product_id not in cart['products']:
+
+        cart['products'][product_id] = {
+            'name': result['name'],
+            'price': result['price'],
+            'quantity': data['quantity'],
+            'category': result['category'],
+            'description': result['description']
+        }
+
+    else:
+        quantity = cart['products'][product_id]['quantity']
+
+        if result['stock'] < quantity + data['quantity']:
+            return respond('Conflict', 409)
+
+        cart['products'][product_id]['quantity'] += data['quantity']
+
+    cart['total'] += data['quantity'] * result['price']
+
+    cart_changed(g.session)
+    await sessions.save(auth, g.session)
+
+    return respond(dumps(cart), 200)
+
+
+# 08. View-Cart
+@app.route('/user/view-cart', methods=['POST'])
+async def view_cart():
+
+    auth = await is_authorized('user')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    return respond(dumps(g.session['cart']), 200)
+
+
+# 09. Remove-From-Cart
+@app.route('/user/remove-from-cart', methods=['DELETE'])
+async def remove_from_cart():
+
+    auth = await is_authorized('user')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if data == None or '_id' not in data:
+        return respond('Unprocessable Entity', 422)
+
+    cart = g.session['cart']
+
+    product_id = data['_id']
+
+    if product_id not in cart['products']:
+        return respond('Not Found', 404)
+
+    quantity = cart['products'][product_id]['quantity']
+    price = cart['products'][product_id]['price']
+
+    cart['total'] -= quantity * price
+
+    del cart['products'][product_id]
+
+    # Correct for Float arithmetic error
+    if cart['total'] < 0.0:
+        cart['total'] = 0.0
+
+    cart_changed(g.session)
+    await sessions.save(auth, g.session)
+
+    return respond(dumps(cart), 200)
+
+
+# 10. Checkout
+@app.route('/user/checkout', methods=['POST'])
+async def checkout():
+
+    auth = await is_authorized('user')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    data = await request_json()
+
+    if data is INVALID_JSON:
+        return respond('Bad Request', 400)
+
+    if not validation.CHECKOUT(data):
+        return respond('Unprocessable Entity', 422)
+
+    if idempotency.HEADER in request.headers:
+        return respond('Bad Request', 400)
+
+    cart = g.session['cart']
+    receipt = {
+        'products': {},
+        'total': 0.0
+    }
+
+    lines = [(product_id, cart['products'][product_id]['quantity'])
+             for product_id in cart['products']]
+
+    skipped = await purchase(lines)
+
+    for product_id, quantity in lines:
+
+        if product_id in skipped:
+            continue
+
+        price = cart['products'][product_id]['price']
+
+        cart['total'] -= quantity * price
+        receipt['total'] += quantity * price
+
+        receipt['products'][product_id] = cart['products'][product_id]
+
+        del cart['products'][product_id]
+
+    # Correct for Float arithmetic error
+    if cart['total'] < 0.0:
+        cart['total'] = 0.0
+
+    if len(receipt['products']) > 0:
+        cart_changed(g.session)
+
+    if len(skipped) > 0:
+        receipt['message'] = "Order Incomplete Due To Insufficient Stock - Check Cart"
+
+    receipt['timestamp'] = time.time()
+
+    # The receipt and the emptied cart are stored concurrently
+    await asyncio.gather(
+        orders_collection.insert_one(dict(receipt, email=g.session['email'])),
+        sessions.save(auth, g.session))
+
+    return respond(dumps(receipt), 200)
+
+
+# 11. View-Order-History
+@app.route('/user/view-order-history', methods=['POST'])
+async def view_order_history():
+
+    auth = await is_authorized('user')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    data = {}
+
+    body = await request.get_data()
+
+    if len(body) > 0:
+        try:
+            data = loads(body)
+        except Exception:
+            return respond('Bad Request', 400)
+
+        if not isinstance(data, dict):
+            return respond('Unprocessable Entity', 422)
+
+    if 'limit' in data and not pagination.is_limit_valid(data['limit']):
+        return respond('Unprocessable Entity', 422)
+
+    query = {'email': g.session['email']}
+
+    if 'before' in data:
+        before = pagination.decode_cursor(data['before'])
+
+        if before == None:
+            return respond('Unprocessable Entity', 422)
+
+        query = {'$and': [
+            query,
+            pagination.keyset_filter('timestamp', before[0], before[1], -1)
+        ]}
+
+    if 'limit' in data:
+        page = await (orders_collection.find(query, ORDER_FIELDS)
+                      .sort(NEWEST_ORDER_FIRST)
+                      .limit(data['limit'])
+                      .to_list())
+        page.reverse()
+
+        response = respond(dumps([order_item(order) for order in page]), 200)
+
+        if len(page) == data['limit']:
+            oldest = page[0]
+            response.headers['X-Next-Cursor'] = pagination.encode_cursor(
+                oldest['timestamp'], oldest['_id'])
+
+        return response
+
+    results = orders_collection.find(query, ORDER_FIELDS).sort(OLDEST_ORDER_FIRST)
+    results.batch_size(STREAM_BATCH_SIZE)
+
+    first = await anext(results, None)
+
+    if first == None:
+        return respond(dumps([]), 200)
+
+    return respond(stream_json_array(first, results, order_item), 200)
+
+
+# 12. Delete-Account
+@app.route('/user/delete-account', methods=['DELETE'])
+async def delete_account():
+
+    auth = await is_authorized('user')
+    if authorization_error(auth):
+        return authorization_error(auth)
+
+    user_email = g.session['email']
+
+    # The sessions, the account and the orders of the user
+    # are deleted concurrently
+    await asyncio.gather(
+        sessions.revoke(user_email),
+        users.delete_one({'email': user_email}),
+        orders_collection.delete_many({'email': user_email}))
+
+    return respond('OK', 200)
+
+
+if __name__ == '__main__':
+    # run the application with a development server, at port 5000
+    app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,298 @@
+# Cart store.
+#
+# CART_BACKEND selects where the carts are kept:
+#
+#   - 'session' (default): in the content of the session, as before; a cart
+#     lives as long as its session (in memory, with SESSION_BACKEND=memory).
+#   - 'mongo': in the 'Carts' collection, one document per user, under the
+#     user's email, so a cart outlives the session and the restarts of the
+#     web service: the next log-in of the user finds it again.
+#
+#         {'_id': email, 'cart': {'products': {...}, 'total': ...},
+#          'version': 12, 'updatedAt': datetime}
+#
+# With 'mongo', every process keeps a copy of the carts it serves in memory
+# (up to CART_CACHE_SIZE carts, the least recently used are dropped first),
+# and the requests read and change that copy. A change only marks the cart
+# as dirty: a background thread writes the dirty carts every
+# CART_FLUSH_INTERVAL seconds, with a single bulk write, so the clicks of a
+# user in between cost one write in all. Checkout writes the cart at once
+# (flush), and the dirty carts are written when the process exits.
+#
+# The copy in memory is only right while the requests of a user are served
+# by one process, so gunicorn.conf.py refuses to start several workers with
+# it. With several workers, set CART_FLUSH_INTERVAL=0 (write-through): every
+# request then reads the cart from the database, into a copy of its own,
+# and every change writes that copy at once, so the workers share the carts.
+# (As with the sessions, two concurrent changes of the same cart both
+# write the whole cart: the last one wins.)
+#
+# The version of a cart is incremented by every change, and tags the
+# view-cart responses (see etags.py).
+
+from collections import OrderedDict
+
+from pymongo import UpdateOne, ReturnDocument
+
+import atexit
+import copy
+import os
+import threading
+import time
+
+import session_store
+
+
+CART_BACKEND = os.environ.get('CART_BACKEND', 'session')  # 'session' or 'mongo'
+CART_CACHE_SIZE = int(os.environ.get('CART_CACHE_SIZE', 10000))
+CART_FLUSH_INTERVAL = float(os.environ.get('CART_FLUSH_INTERVAL', 1))  # seconds
+
+# Copies of a cart tried by the flush of checkout,
+# while the requests of the user keep changing it
+FLUSH_COPY_ATTEMPTS = 100
+
+
+def empty_cart():
+    return {'products': {}, 'total': 0.0}
+
+
+class CartStore:
+
+    def __init__(self, collection, max_entries=CART_CACHE_SIZE, flush_interval=CART_FLUSH_INTERVAL):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+
+        # email -> [cart, version, dirty],
+        # ordered from the least to the most recently used cart
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Held while the copies of carts are written
+        self.write_lock = threading.Lock()
+
+        self.loads = 0
+        self.writes = 0    # carts written
+        self.flushes = 0   # bulk writes
+
+    def write_through(self):
+        return self.flush_interval <= 0
+
+    def get(self, email):
+
+        # The cart of the user and its version, (cart, version): the cart
+        # is to be read or changed (then call changed with it)
+
+        if self.write_through():
+            # (a copy of the request's own, nothing is kept in memory)
+            document = self.collection.find_one({'_id': email})
+
+            with self.lock:
+                self.loads += 1
+
+            if document == None:
+                return empty_cart(), 0
+
+            return document['cart'], document['version']
+
+        with self.lock:
+            entry = self.entries.get(email)
+
+            if entry != None:
+                self.entries.move_to_end(email)
+                return entry[0], entry[1]
+
+        document = self.collection.find_one({'_id': email})
+
+        if document == None:
+            entry = [empty_cart(), 0, False]
+        else:
+            entry = [document['cart'], document['version'], False]
+
+        with self.lock:
+            self.loads += 1
+
+            # (unless another request of the user has loaded it meanwhile)
+            if email in self.entries:
+                entry = self.entries[email]
+            else:
+                self.entries[email] = entry
+                self.evict()
+
+            return entry[0], entry[1]
+
+    def changed(self, email, cart):
+
+        # The request has changed the cart it got; returns its new version
+
+        if self.write_through():
+            document = self.collection.find_one_and_update(
+                {'_id': email},
+                {'$set': {'cart': cart, 'updatedAt': session_store.utcnow()},
+                 '$inc': {'version': 1}},
+                {'version': 1}, upsert=True, return_document=ReturnDocument.AFTER)
+
+            with self.lock:
+                self.writes += 1
+
+            return document['version']
+
+        with self.lock:
+            entry = self.entries.get(email)
+
+            # (the cart has been deleted meanwhile, with the account)
+            if entry == None or entry[0] is not cart:
+                return 0
+
+            entry[1] += 1
+            entry[2] = True
+
+            return entry[1]
+
+    def delete(self, email):
+
+        # (not while a flush is writing a copy of the cart,
+        #  which would bring the cart back)
+        with self.write_lock:
+            with self.lock:
+                self.entries.pop(email, None)
+
+            self.collection.delete_one({'_id': email})
+
+    def evict(self):
+
+        # Drops the least recently used carts that have been written
+        # (a dirty cart is kept until the next flush)
+
+        if len(self.entries) <= self.max_entries:
+            return
+
+        for email in list(self.entries):
+            if len(self.entries) <= self.max_entries:
+                break
+
+            if not self.entries[email][2]:
+                del self.entries[email]
+
+    # Writing ...
+
+    def snapshot(self, email, attempts):
+
+        # A copy of the dirty cart of the user, (email, cart, version),
+        # or None if it is not dirty
+
+        for attempt in range(attempts):
+            with self.lock:
+                entry = self.entries.get(email)
+
+                if entry == None or not entry[2]:
+                    return None
+
+                try:
+                    return email, copy.deepcopy(entry[0]), entry[1]
+                except RuntimeError:
+                    # (changed by a request during the copy)
+                    pass
+
+            time.sleep(0.001)
+
+        return False
+
+    def flush(self, emails=None):
+
+        # Writes the dirty carts: those of these users, at once (raises if a
+        # cart cannot be copied), or all of them (a cart that cannot be
+        # copied now, being changed, stays dirty until the next flush)
+
+        with self.write_lock:
+            snapshots = []
+
+            if emails == None:
+                with self.lock:
+                    emails = list(self.entries)
+
+                attempts = 1
+            else:
+                attempts = FLUSH_COPY_ATTEMPTS
+
+            for email in emails:
+                snapshot = self.snapshot(email, attempts)
+
+                if snapshot == False and attempts > 1:
+                    raise RuntimeError('The cart of %s could not be copied' % email)
+
+                if snapshot:
+                    snapshots.append(snapshot)
+
+            if len(snapshots) == 0:
+                return
+
+            now = session_store.utcnow()
+
+            self.collection.bulk_write([
+                UpdateOne({'_id': email},
+                          {'$set': {'cart': cart, 'version': version, 'updatedAt': now}},
+                          upsert=True)
+                for email, cart, version in snapshots
+            ], ordered=False)
+
+        with self.lock:
+            self.writes += len(snapshots)
+            self.flushes += 1
+
+            for email, cart, version in snapshots:
+                entry = self.entries.get(email)
+
+                # (unless it has been changed again since the copy)
+                if entry != None and entry[1] == version:
+                    entry[2] = False
+
+            self.evict()
+
+    def start_flusher(self):
+
+        if self.write_through():
+            return None
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception:
+                    # (e.g. the database is briefly unavailable,
+                    #  the carts stay dirty until the next flush)
+                    pass
+
+        flusher = threading.Thread(target=run, name='cart-flusher', daemon=True)
+        flusher.start()
+
+        # The dirty carts are written when the process exits
+        atexit.register(self.flush)
+
+        return flusher
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'dirty': sum(1 for entry in self.entries.values() if entry[2]),
+                'loads': self.loads,
+                'writes': self.writes,
+                'flushes': self.flushes
+            }
+
+
+def create_store(db, backend=CART_BACKEND):
+
+    # None: the carts are kept in the sessions
+
+    if backend == 'session':
+        return None
+
+    if backend == 'mongo':
+        store = CartStore(db['Carts'])
+        store.start_flusher()
+        return store
+
+    raise ValueError('Unknown CART_BACKEND: ' + backend)
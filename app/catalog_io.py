@@ -0,0 +1,367 @@
+# Bulk import and export of the product catalog, as NDJSON.
+#
+# NDJSON is one JSON object per line. The lines are read one at a time and
+# written to the database in batches of IMPORT_BATCH_SIZE (one insert_many
+# or bulk_write per batch), so a catalog of any size is loaded with a few
+# round trips per thousand products, in constant memory.
+#
+#   create: every line is a product, as in the body of create-product
+#   update: every line is a change, as in the body of update-product
+#   delete: every line is {"_id": ...}, as in the body of delete-product
+#   export: every product, one per line, with its _id and stock
+#           (the export of a database can be loaded by 'update' into a
+#            database holding the same products, or by 'create' into
+#            another one, whose products get new _ids)
+#
+# A line that cannot be applied does not stop the others: the result of an
+# import counts the lines applied, and lists the errors of the others:
+#
+#     {"applied": 9998, "errors": [{"line": 17, "error": "Unprocessable Entity"},
+#                                  {"line": 9012, "error": "Not Found"}]}
+#
+# The web service offers these as /admin/create-products, update-products,
+# delete-products and export-products. From the command line:
+#
+#     python3 catalog_io.py create products.ndjson
+#     python3 catalog_io.py update changes.ndjson
+#     python3 catalog_io.py delete removed.ndjson
+#     python3 catalog_io.py export [catalog.ndjson]
+#
+# ('-' or no file name is the standard input/output)
+
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from bson.objectid import ObjectId
+
+import sys
+
+from serialization import loads, dumps, STATUS_TEXTS
+from common import mongo_client
+
+import search
+import search_cache
+import validation
+
+
+IMPORT_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+
+# The fields of an exported product
+EXPORT_FIELDS = {'name': 1, 'price': 1, 'category': 1, 'description': 1, 'stock': 1}
+
+# The fields update-product may change
+UPDATE_FIELDS = ['name', 'category', 'description', 'price', 'stock']
+
+SEARCHED_FIELDS = ('name', 'category', 'description')
+
+
+def new_product(data):
+
+    # The product document of a (valid) create-product body
+    product = {
+        'name': data['name'].lower(),
+        'category': data['category'].lower(),
+        'price': data['price'],
+        'stock': data['stock'],
+        'description': data['description']
+    }
+    product['searchTerms'] = search.search_terms(product)
+
+    return product
+
+
+# Import ...
+
+class ImportResult:
+
+    def __init__(self):
+        self.applied = 0
+        self.errors = []
+
+    def error(self, line, status):
+        self.errors.append({'line': line, 'error': STATUS_TEXTS[status]})
+
+    def as_dict(self):
+        self.errors.sort(key=lambda error: error['line'])
+        return {'applied': self.applied, 'errors': self.errors}
+
+
+def parse_lines(lines, validator, result):
+
+    # Yields (line number, body) of every line that satisfies the schema,
+    # and records an error for every other non-blank line
+
+    for number, line in enumerate(lines, 1):
+
+        if len(line.strip()) == 0:
+            continue
+
+        try:
+            data = loads(line)
+        except Exception:
+            result.error(number, 400)
+            continue
+
+        if not validator(data):
+            result.error(number, 422)
+            continue
+
+        yield number, data
+
+
+def batches(items, batch_size=IMPORT_BATCH_SIZE):
+
+    batch = []
+
+    for item in items:
+        batch.append(item)
+
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if len(batch) > 0:
+        yield batch
+
+
+def write_errors(error, numbers, result):
+
+    # Records the errors of a BulkWriteError, whose operations
+    # were made from the lines 'numbers' (in the same order);
+    # returns the indexes of the operations that failed
+
+    failed = set()
+
+    for failure in error.details.get('writeErrors', []):
+        if failure['code'] == 11000:  # duplicate key
+            result.error(numbers[failure['index']], 409)
+        else:
+            result.error(numbers[failure['index']], 500)
+        failed.add(failure['index'])
+
+    return failed
+
+
+def object_ids(batch, result):
+
+    # The ObjectId of every (number, data) line of the batch,
+    # without the lines whose _id is not an ObjectId
+    valid = []
+
+    for number, data in batch:
+        if not isinstance(data['_id'], str) or not ObjectId.is_valid(data['_id']):
+            result.error(number, 422)
+            continue
+        valid.append((number, data, ObjectId(data['_id'])))
+
+    return valid
+
+
+def existing(products, ids):
+    return {product['_id'] for product in products.find({'_id': {'$in': ids}}, {'_id': 1})}
+
+
+def create_products(products, lines, batch_size=IMPORT_BATCH_SIZE, changed=None):
+
+    # changed(product_ids) is called after every batch that created products
+
+    result = ImportResult()
+
+    for batch in batches(parse_lines(lines, validation.CREATE_PRODUCT, result), batch_size):
+        numbers = [number for number, data in batch]
+        documents = [new_product(data) for number, data in batch]
+
+        failed = set()
+
+        try:
+            products.insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            failed = write_errors(error, numbers, result)
+
+        result.applied += len(documents) - len(failed)
+
+        if changed != None and len(failed) < len(documents):
+            changed([document['_id'] for index, document in enumerate(documents)
+                     if index not in failed])
+
+    return result.as_dict()
+
+
+def update_products(products, lines, batch_size=IMPORT_BATCH_SIZE, changed=None):
+
+    # changed(product_ids) is called after every batch, with the products it updated
+
+    result = ImportResult()
+
+    for batch in batches(parse_lines(lines, validation.UPDATE_PRODUCT, result), batch_size):
+        batch = object_ids(batch, result)
+        found = existing(products, [product_id for number, data, product_id in batch])
+
+        numbers = []
+        operations = []
+        updated = []
+        searched = []
+
+        for number, data, product_id in batch:
+            update_set = {key: data[key] for key in UPDATE_FIELDS if key in data}
+
+            if len(update_set) == 0:
+                result.error(number, 422)
+                continue
+
+            if product_id not in found:
+                result.error(number, 404)
+                continue
+
+            numbers.append(number)
+            operations.append(UpdateOne({'_id': product_id}, {'$set': update_set}))
+            updated.append(product_id)
+
+            if any(key in update_set for key in SEARCHED_FIELDS):
+                searched.append(product_id)
+
+        if len(operations) == 0:
+            continue
+
+        failed = set()
+
+        try:
+            products.bulk_write(operations, ordered=False)
+        except BulkWriteError as error:
+            failed = write_errors(error, numbers, result)
+
+        result.applied += len(operations) - len(failed)
+
+        # Keep the search terms in line with the new name/category/description
+        search.refresh_search_terms_many(products, searched)
+
+        # (once the search terms are up to date)
+        if changed != None:
+            changed(updated)
+
+    return result.as_dict()
+
+
+def delete_products(products, lines, batch_size=IMPORT_BATCH_SIZE, changed=None):
+
+    # changed(product_ids) is called after every batch, with the products it deleted
+
+    result = ImportResult()
+
+    for batch in batches(parse_lines(lines, validation.DELETE_PRODUCT, result), batch_size):
+        batch = object_ids(batch, result)
+        found = existing(products, [product_id for number, data, product_id in batch])
+
+        numbers = []
+        deleted = []
+
+        for number, data, product_id in batch:
+            if product_id not in found:
+                result.error(number, 404)
+            else:
+                numbers.append(number)
+                deleted.append(product_id)
+
+        if len(deleted) == 0:
+            continue
+
+        failed = set()
+
+        try:
+            products.bulk_write([DeleteOne({'_id': product_id}) for product_id in deleted],
+                                ordered=False)
+        except BulkWriteError as error:
+            failed = write_errors(error, numbers, result)
+
+        result.applied += len(deleted) - len(failed)
+
+        if changed != None:
+            changed(deleted)
+
+    return result.as_dict()
+
+
+# Export ...
+
+def export_products(products, batch_size=EXPORT_BATCH_SIZE):
+
+    # Yields the catalog as NDJSON, one piece per batch of the cursor,
+    # so that only one batch of products is in memory at a time
+
+    cursor = products.find({}, EXPORT_FIELDS).sort('_id', 1)
+    cursor.batch_size(batch_size)
+
+    lines = []
+
+    for product in cursor:
+        product_id = str(product.pop('_id'))
+        lines.append(dumps(dict({'_id': product_id}, **product)))
+
+        if len(lines) == batch_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+
+    if len(lines) > 0:
+        yield '\n'.join(lines) + '\n'
+
+
+# Command Line Interface ...
+
+COMMANDS = {'create': create_products, 'update': update_products, 'delete': delete_products}
+
+
+def main(argv):
+
+    if (len(argv) not in (2, 3) or
+            argv[1] not in COMMANDS and argv[1] != 'export'):
+        print('usage: python3 catalog_io.py create|update|delete|export [file]')
+        return 2
+
+    client = mongo_client()
+    products = client['DSPharmacy']['Products']
+    meta = client['DSPharmacy']['Meta']
+
+    path = '-'
+    if len(argv) == 3:
+        path = argv[2]
+
+    if argv[1] == 'export':
+        if path == '-':
+            output = sys.stdout
+        else:
+            output = open(path, 'w')
+
+        for piece in export_products(products):
+            output.write(piece)
+
+        if output != sys.stdout:
+            output.close()
+
+        return 0
+
+    if path == '-':
+        lines = sys.stdin.buffer
+    else:
+        lines = open(path, 'rb')
+
+    # (the writes bump the catalog generation: the web service drops the
+    #  search responses it has cached (see search_cache.py) and the products
+    #  it caches for add-to-cart, within PRODUCT_CACHE_CHECK_INTERVAL
+    #  seconds (see product_cache.py))
+    result = COMMANDS[argv[1]](products, lines,
+                               changed=lambda product_ids: search_cache.bump_generation(meta))
+
+    if lines != sys.stdin.buffer:
+        lines.close()
+
+    print(dumps(result))
+
+    if len(result['errors']) > 0:
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,281 @@
+# In-process replica of the product catalog.
+#
+# With CATALOG_REPLICA=1, every worker process keeps a copy of the searchable
+# fields of the products (name, price, category, description) in memory:
+#
+#   - a map from _id to product, and
+#   - for every category, the list of its products sorted like the search
+#     results, by (price, _id),
+#
+# so product-search by _id or by category is answered without the database.
+#
+# The replica is loaded in a background thread, with one scan of the
+# Products collection; searches go to the database until it is loaded.
+# It is then kept current by a change stream of the collection (changes of
+# the stock alone are filtered out, they are not part of the replica). Change
+# streams need a replica set; on a standalone server the thread falls back to
+# polling: every CATALOG_REPLICA_POLL seconds it reads the catalog generation
+# (see search_cache.py) and loads the catalog again if it has changed. The
+# changes made by this process are applied at once in both modes (refresh),
+# so in polling mode the replicas of the other workers lag by at most the
+# polling interval, and changes made directly in the database (not by the
+# web service or catalog_io.py) are only seen with a change stream.
+#
+# Category searches are substring searches (as in search.py); with
+# SEARCH_MODE=regex the term is a regular expression, so they go to the
+# database instead.
+
+from bson.objectid import ObjectId
+
+import bisect
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import search
+import search_cache
+
+
+CATALOG_REPLICA = os.environ.get('CATALOG_REPLICA', '0') == '1'
+CATALOG_REPLICA_POLL = float(os.environ.get('CATALOG_REPLICA_POLL', 2))  # seconds
+
+REPLICA_FIELDS = {'name': 1, 'price': 1, 'category': 1, 'description': 1}
+
+# Only the changes of these fields are followed
+CHANGES = [{'$match': {'$or': [
+    {'operationType': {'$ne': 'update'}},
+    {'updateDescription.updatedFields.name': {'$exists': True}},
+    {'updateDescription.updatedFields.price': {'$exists': True}},
+    {'updateDescription.updatedFields.category': {'$exists': True}},
+    {'updateDescription.updatedFields.description': {'$exists': True}},
+    {'updateDescription.removedFields.0': {'$exists': True}}
+]}}]
+
+
+def is_searchable(product):
+
+    # Products that can be returned by product-search
+    # (not e.g. a document left in Products by an older checkout, see indexes.py)
+    return (isinstance(product.get('name'), str) and
+            isinstance(product.get('category'), str) and
+            isinstance(product.get('price'), (int, float)) and
+            'description' in product)
+
+
+class CatalogReplica:
+
+    def __init__(self, products, meta, poll_interval=CATALOG_REPLICA_POLL):
+        self.products = products
+        self.meta = meta
+        self.poll_interval = poll_interval
+
+        # _id -> product
+        self.by_id = {}
+
+        # category -> [(price, _id), ...] sorted; the lists are never modified,
+        # a change replaces the list of its category, so that a search can
+        # go through a list while the replica is being updated
+        self.by_category = {}
+
+        self.lock = threading.Lock()
+
+        self.loaded = False
+        self.mode = None  # 'change stream' or 'polling'
+        self.generation = None
+
+    # Synchronization ...
+
+    def start(self):
+        follower = threading.Thread(target=self.run, name='catalog-replica', daemon=True)
+        follower.start()
+
+        return follower
+
+    def run(self):
+
+        while True:
+            try:
+                self.follow()
+            except Exception:
+                # No change streams (standalone server), or the stream was lost
+                pass
+
+            self.mode = 'polling'
+
+            try:
+                self.poll()
+            except Exception:
+                pass
+
+            time.sleep(self.poll_interval)
+
+    def follow(self):
+
+        # The stream is opened before the scan,
+        # so that no change made during the scan is missed
+        with self.products.watch(CHANGES, full_document='updateLookup') as stream:
+            self.load()
+            self.mode = 'change stream'
+
+            for change in stream:
+                self.apply(change)
+
+    def poll(self):
+
+        generation = search_cache.read_generation(self.meta)
+
+        if not self.loaded or generation != self.generation:
+            self.load(generation)
+
+    def load(self, generation=None):
+
+        by_id = {}
+        by_category = {}
+
+        for product in self.products.find({}, REPLICA_FIELDS):
+            if is_searchable(product):
+                by_id[product['_id']] = product
+                by_category.setdefault(product['category'], []).append(
+                    (product['price'], product['_id']))
+
+        for entries in by_category.values():
+            entries.sort()
+
+        with self.lock:
+            self.by_id = by_id
+            self.by_category = by_category
+            self.generation = generation
+            self.loaded = True
+
+    def apply(self, change):
+
+        operation = change['operationType']
+
+        if operation in ('insert', 'update', 'replace'):
+            product = change.get('fullDocument')
+
+            if product == None:  # deleted since
+                self.remove(change['documentKey']['_id'])
+            else:
+                self.put(product)
+
+        elif operation == 'delete':
+            self.remove(change['documentKey']['_id'])
+
+        else:
+            # drop, rename, invalidate, ...
+            self.load()
+
+    def refresh(self, product_ids):
+
+        # Applies the changes of these products at once
+        # (or of the whole catalog, if none are given)
+
+        if not self.loaded:
+            return
+
+        if len(product_ids) == 0:
+            self.load(self.generation)
+            return
+
+        found = set()
+
+        for product in self.products.find({'_id': {'$in': list(product_ids)}}, REPLICA_FIELDS):
+            self.put(product)
+            found.add(product['_id'])
+
+        for product_id in product_ids:
+            if product_id not in found:
+                self.remove(product_id)
+
+    def put(self, product):
+
+        if not is_searchable(product):
+            self.remove(product['_id'])
+            return
+
+        product = {field: product[field] for field in ('_id', 'name', 'price', 'category', 'description')}
+
+        with self.lock:
+            self._unlist(product['_id'])
+
+            entries = list(self.by_category.get(product['category'], []))
+            bisect.insort(entries, (product['price'], product['_id']))
+            self.by_category[product['category']] = entries
+
+            self.by_id[product['_id']] = product
+
+    def remove(self, product_id):
+        with self.lock:
+            self._unlist(product_id)
+            self.by_id.pop(product_id, None)
+
+    def _unlist(self, product_id):
+
+        product = self.by_id.get(product_id)
+
+        if product == None:
+            return
+
+        entries = list(self.by_category[product['category']])
+        entries.remove((product['price'], product_id))
+
+        if len(entries) > 0:
+            self.by_category[product['category']] = entries
+        else:
+            del self.by_category[product['category']]
+
+    # Queries ...
+
+    def search(self, data, after=None):
+
+        # The products a (valid) product-search body finds, in search order,
+        # starting after the (price, _id) cursor and at most 'limit' of them;
+        # or None if the replica cannot answer the search
+
+        if not self.loaded:
+            return None
+
+        if '_id' in data:
+            product = self.by_id.get(ObjectId(data['_id']))
+
+            lists = []
+            if product != None:
+                lists.append([(product['price'], product['_id'])])
+
+        elif 'name' not in data and 'category' in data:
+            if search.SEARCH_MODE == 'regex' or not isinstance(data['category'], str):
+                return None
+
+            term = data['category'].lower()
+
+            lists = [entries
+                     for category, entries in list(self.by_category.items())
+                     if term in category]
+
+        else:
+            return None
+
+        if after != None:
+            lists = [itertools.islice(entries, bisect.bisect_right(entries, after), None)
+                     for entries in lists]
+
+        results = self.products_of(heapq.merge(*lists))
+
+        if 'limit' in data:
+            results = itertools.islice(results, data['limit'])
+
+        return results
+
+    def products_of(self, entries):
+
+        by_id = self.by_id
+
+        for price, product_id in entries:
+            product = by_id.get(product_id)
+
+            # (skip the products removed during the search)
+            if product != None:
+                yield product
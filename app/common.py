@@ -0,0 +1,227 @@
+# Helper functions shared by the WSGI application (app.py)
+# and the ASGI application (asgi.py), and the command line tools.
+#
+# Nothing in here talks to the database, so the same code
+# serves both the synchronous and the asynchronous driver.
+
+from pymongo import MongoClient
+
+from bson.objectid import ObjectId
+
+from datetime import date  # To get current year in 'age' function
+
+from serialization import dumps_items, ITEM_SEPARATOR  # To encode response data as JSON
+from reservations import available_filter  # To purchase reserved stock
+import os
+import time  # Used in session generation
+
+
+# Database ...
+
+def mongodb_uri():
+
+    # The MongoDB server of the web service and of every tool
+    # (MONGO_HOSTNAME and MONGO_PORT, read when called)
+    return ('mongodb://' + os.environ.get('MONGO_HOSTNAME', 'localhost') +
+            ':' + os.environ.get('MONGO_PORT', '27017') + '/')
+
+
+def mongo_client(**options):
+    return MongoClient(mongodb_uri(), **options)
+
+
+# Validation ...
+
+def is_ssn_valid(ssn):
+
+    # SSN should be an integer
+    if not isinstance(ssn, int):
+        return False
+
+    ssn = str(ssn)
+
+    # SSN should be 11-digits long
+    if len(ssn) != 11:
+        return False
+
+    #                            01234567890 (indexes)
+    # SSN must be in the format: DDMMYYNNNNN
+
+    # Digits at indexes 0 and 1 represent the day of birth
+    day = int(ssn[0:2])
+
+    # Digits at indexes 2 and 3 represent the month of birth
+    month = int(ssn[2:4])
+
+    if not (1 <= day <= 31):
+        return False
+    if not (1 <= month <= 12):
+        return False
+
+    return True
+
+
+def is_credit_valid(credit):
+
+    # Credit should be an integer
+    if not isinstance(credit, int):
+        return False
+
+    credit = str(credit)
+
+    # Credit should be 16-digits long
+    if len(credit) != 16:
+        return False
+
+    return True
+
+
+# Sessions ...
+
+def new_session_content(handle, category, ssn=None):
+
+    if (category == 'administrator'):
+        handle_type = 'username'
+    else:
+        handle_type = 'email'
+
+    session_content = {
+        handle_type: handle,
+        'category':  category,
+        'timestamp': time.time()
+    }
+
+    if category == 'user':
+        session_content['cart'] = {
+            'products': {},
+            'total': 0.0
+        }
+
+        # The year from which the user may buy age-restricted products,
+        # computed once here instead of on every add-to-cart
+        session_content['adultFrom'] = adult_from(ssn)
+
+    return session_content
+
+
+def cart_changed(session):
+
+    # Called whenever the cart of the session changes, before the session is
+    # saved: the version of the cart tags the view-cart responses (see etags.py)
+    session['cartVersion'] = session.get('cartVersion', 0) + 1
+
+
+# Age Restriction ...
+
+# Underage users should not be able to purchase products from these categories
+RESTRICTED_CATEGORIES = ['analgesic', 'antibiotic', 'antiseptic']
+
+
+def age(ssn):
+    birth_year = int(str(ssn)[4:6])
+    current_year = int(str(date.today().year)[2:4])
+
+    if current_year < birth_year:
+        current_year += 100
+
+    return current_year - birth_year
+
+
+def adult_from(ssn):
+    # The first year in which age(ssn) is at least 18
+    return date.today().year - age(ssn) + 18
+
+
+# Products ...
+
+# Only these fields of a product are returned by product-search
+PRODUCT_FIELDS = {'name': 1, 'price': 1, 'category': 1, 'description': 1}
+
+# Products are listed by price, and by _id among products with the same price
+PRICE_ORDER = [('price', 1), ('_id', 1)]
+
+STREAM_BATCH_SIZE = 100
+
+
+def product_item(result):
+    return {
+        # ObjectId would be problematic in JSON encoding,
+        # so it is replaced by its string representation
+        'Product ID': str(result['_id']),
+        'Product Information': {
+            'name': result['name'],
+            'price': result['price'],
+            'category': result['category'],
+            'description': result['description']
+        }
+    }
+
+
+# Orders ...
+
+# Orders are returned without the user's email
+ORDER_FIELDS = {'email': 0}
+
+OLDEST_ORDER_FIRST = [('timestamp', 1), ('_id', 1)]
+NEWEST_ORDER_FIRST = [('timestamp', -1), ('_id', -1)]
+
+
+def order_item(order):
+    # The receipt, as it was returned by checkout
+    receipt = dict(order)
+    del receipt['_id']
+    return receipt
+
+
+def stream_json_array(first, rest, to_item, batch_size=STREAM_BATCH_SIZE):
+
+    # Yields the JSON encoding of the array [first, *rest] piece by piece,
+    # one piece per batch_size items (a batch of the database cursor).
+    # The output is the same as dumps() of the whole array.
+
+    batch = [to_item(first)]
+    opening = '['
+
+    for result in rest:
+        batch.append(to_item(result))
+
+        if len(batch) == batch_size:
+            yield opening + dumps_items(batch)
+            batch = []
+            opening = ITEM_SEPARATOR
+
+    if len(batch) > 0:
+        yield opening + dumps_items(batch) + ']'
+    else:
+        yield ']'
+
+
+# Checkout ...
+#
+# Every (product_id, quantity) line of the cart is purchased by an update
+# that subtracts the quantity from the product's stock only if the stock
+# is sufficient ({'stock': {'$gte': quantity}}), so the stock check and the
+# decrement are atomic for each product, and concurrent checkouts can never
+# sell more than the available stock. A line was purchased if its update
+# matched the product: it did not if the stock was not sufficient, or if
+# the product has been deleted meanwhile.
+#
+# The lines are updated one by one, since a bulk write only counts the
+# updates that matched, not which ones did. (Nor can they be upserts, whose
+# duplicate key errors would tell: the upsert of a deleted product would
+# insert a document of its own into Products, and MongoDB refuses the
+# $expr of the stock reservations in the filter of an upsert.)
+
+def purchase_update(product_id, quantity, held=None):
+
+    # The (filter, update) of the line
+
+    if held == None:
+        return ({'_id': ObjectId(product_id), 'stock': {'$gte': quantity}},
+                {'$inc': {'stock': - quantity}})
+
+    # With stock reservations, held is {product_id: quantity held by the cart}
+    # (see reservations.py): the stock held by other carts is not available,
+    # and the held quantity is subtracted from the reserved counter too
+    return (available_filter(ObjectId(product_id), quantity, held.get(product_id, 0)),
+            {'$inc': {'stock': - quantity, 'reserved': - held.get(product_id, 0)}})
@@ -0,0 +1,176 @@
+# Compression of responses (gzip, brotli).
+#
+# A response is compressed when the client accepts it (Accept-Encoding), it
+# is JSON, NDJSON or text, and its body is at least COMPRESSION_MIN_SIZE
+# bytes (smaller bodies gain little, and still cost CPU). brotli is chosen
+# when the client accepts it and the brotli module is installed (pip install
+# brotli, it is in the Docker image), gzip otherwise.
+#
+# A streamed response (product-search, order history, export) is compressed
+# piece by piece, and every piece is flushed at once, so the client still
+# receives the items as they are read from the database. Its size is not
+# known in advance: its first pieces are read until there are
+# COMPRESSION_MIN_SIZE bytes, and if it ends before that, it is sent whole
+# and uncompressed.
+#
+# A compressed response is a different sequence of bytes, so its ETag gets
+# the encoding as a suffix ("...-gzip"); etags.py accepts either tag in
+# If-None-Match.
+#
+# COMPRESSION=0 disables compression (e.g. when a proxy in front of the
+# service compresses the responses).
+
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+COMPRESSION = os.environ.get('COMPRESSION', '1') == '1'
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))  # bytes
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+
+# Every encoding an ETag suffix may name
+# (another worker may have brotli when this one does not)
+ENCODINGS = ('br', 'gzip')
+
+# The encodings this process offers, in order of preference
+if brotli != None:
+    OFFERED_ENCODINGS = ['br', 'gzip']
+else:
+    OFFERED_ENCODINGS = ['gzip']
+
+COMPRESSED_TYPES = ('application/json', 'application/x-ndjson', 'text/plain')
+
+
+class GzipStream:
+
+    def __init__(self):
+        # (wbits 16 + 15: the gzip format)
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b''):
+        return self.compressor.compress(data) + self.compressor.flush()
+
+
+class BrotliStream:
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self, data=b''):
+        return self.compressor.process(data) + self.compressor.finish()
+
+
+STREAMS = {'gzip': GzipStream, 'br': BrotliStream}
+
+
+def compress_body(encoding, data):
+    return STREAMS[encoding]().finish(data)
+
+
+def compressed_pieces(encoding, head, pieces):
+
+    # Compresses the pieces already read (head), then the rest of them
+    stream = STREAMS[encoding]()
+
+    yield stream.compress(b''.join(head))
+
+    for piece in pieces:
+        data = stream.compress(piece)
+
+        if len(data) > 0:
+            yield data
+
+    yield stream.finish()
+
+
+def encoded_etag(etag, encoding):
+    return etag + '-' + encoding
+
+
+def negotiated_encoding(accept_encodings):
+
+    # The encoding a (large enough) response to the request would be
+    # compressed with, or None
+    if not COMPRESSION:
+        return None
+
+    return accept_encodings.best_match(OFFERED_ENCODINGS)
+
+
+def init_app(app):
+
+    # Compresses the responses of the Flask application
+
+    from flask import request
+
+    if not COMPRESSION:
+        return
+
+    @app.after_request
+    def compress_response(response):
+
+        # (a 304 stands for a response that may have been compressed)
+        if response.status_code == 304:
+            response.vary.add('Accept-Encoding')
+            return response
+
+        if (response.status_code != 200 or
+                'Content-Encoding' in response.headers or
+                response.mimetype not in COMPRESSED_TYPES):
+            return response
+
+        response.vary.add('Accept-Encoding')
+
+        encoding = negotiated_encoding(request.accept_encodings)
+
+        if encoding == None:
+            return response
+
+        if response.is_streamed:
+            pieces = response.iter_encoded()
+
+            head = []
+            size = 0
+
+            for piece in pieces:
+                head.append(piece)
+                size += len(piece)
+
+                if size >= COMPRESSION_MIN_SIZE:
+                    break
+
+            if size < COMPRESSION_MIN_SIZE:
+                # The whole (short) stream has been read
+                response.set_data(b''.join(head))
+                return response
+
+            response.response = compressed_pieces(encoding, head, pieces)
+
+        else:
+            data = response.get_data()
+
+            if len(data) < COMPRESSION_MIN_SIZE:
+                return response
+
+            response.set_data(compress_body(encoding, data))
+
+        response.headers['Content-Encoding'] = encoding
+
+        etag, weak = response.get_etag()
+
+        if etag != None:
+            response.set_etag(encoded_etag(etag, encoding), weak)
+
+        return response
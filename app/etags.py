@@ -0,0 +1,66 @@
+# Entity tags, for conditional requests.
+#
+# A client polling an endpoint sends the ETag of the response it already
+# holds in If-None-Match; while the tag still matches, the endpoint answers
+# 304 Not Modified, with no body, and skips building the response.
+#
+# The tags are strong, and computed from a few values that change whenever
+# the response would, rather than from the body, so that a 304 costs no more
+# than reading those values:
+#
+#   product-search       the catalog generation (see search_cache.py)
+#                        and the normalized query
+#   view-cart            the session and the version of its cart
+#                        (see cart_changed in common.py)
+#   view-order-history   the user and the newest of their orders (orders
+#                        are only added, or all deleted at once), and
+#                        the page asked for
+#
+# These endpoints are POSTs that only read, so If-None-Match is answered
+# as it would be for a GET.
+
+import hashlib
+
+import compression
+
+
+def make_etag(*parts):
+
+    # The tag (without its quotes) of the response made from these values
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+
+
+def held_etag(if_none_match, etag, encoding=None):
+
+    # The tag of the 304 answering a request whose If-None-Match matches
+    # etag: the tag of the representation the client holds (its cache looks
+    # the stored response up by it), compressed with the encoding negotiated
+    # for the request if the client holds that one
+
+    if encoding != None and if_none_match.contains_weak(compression.encoded_etag(etag, encoding)):
+        return compression.encoded_etag(etag, encoding)
+
+    if if_none_match.contains_weak(etag):
+        return etag
+
+    for encoding in compression.ENCODINGS:
+        if if_none_match.contains_weak(compression.encoded_etag(etag, encoding)):
+            return compression.encoded_etag(etag, encoding)
+
+    return etag
+
+
+def matches(if_none_match, etag):
+
+    # Does the client hold the response tagged etag? (if_none_match is the
+    # parsed If-None-Match header; the tag of the response compressed with
+    # any encoding matches too, see compression.py)
+
+    if if_none_match.contains_weak(etag):
+        return True
+
+    for encoding in compression.ENCODINGS:
+        if if_none_match.contains_weak(compression.encoded_etag(etag, encoding)):
+            return True
+
+    return False
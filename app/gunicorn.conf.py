@@ -0,0 +1,133 @@
+# Production server configuration.
+#
+# Run with:
+#
+#     gunicorn -c gunicorn.conf.py
+#
+# Settings (environment variables):
+#
+#   WEB_APP           'wsgi' (default): the Flask application of app.py,
+#                     'asgi': the asyncio application of asgi.py, on uvicorn workers
+#   WEB_WORKERS       number of worker processes (default: number of CPU cores,
+#                     or 1 with SESSION_BACKEND=memory)
+#   WEB_THREADS       threads per worker, for the 'gthread' worker class (default: 4)
+#   WEB_WORKER_CLASS  'gthread' (default) or 'gevent'
+#   WEB_CONNECTIONS   concurrent requests per worker, for 'gevent' and
+#                     the ASGI application (default: 100)
+#   WEB_PRELOAD       '1' to import the application once in the master process
+#                     before forking the workers (default: '0')
+#   WEB_PORT          port to listen on (default: 5000)
+#   METRICS_DIR       directory where the workers write their metrics, to be
+#                     added up by /metrics (default: a temporary directory)
+#
+# Sessions must be shared by the workers, so with more than one worker
+# the web service should run with SESSION_BACKEND=mongo (sessions kept
+# in memory get a single worker by default, and a warning otherwise).
+# So must the carts: CART_BACKEND=mongo with more than one worker
+# needs CART_FLUSH_INTERVAL=0, or the server does not start.
+
+import multiprocessing
+import os
+import tempfile
+
+
+bind = '0.0.0.0:' + os.environ.get('WEB_PORT', '5000')
+
+web_app = os.environ.get('WEB_APP', 'wsgi')
+
+session_backend = os.environ.get('SESSION_BACKEND', 'memory')
+
+if session_backend == 'mongo':
+    workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+else:
+    workers = int(os.environ.get('WEB_WORKERS', 1))
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_connections = int(os.environ.get('WEB_CONNECTIONS', 100))
+
+preload_app = os.environ.get('WEB_PRELOAD', '0') == '1'
+
+if web_app == 'asgi':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+
+    # (asgi.py creates its client when the worker starts serving)
+    preload_app = False
+else:
+    wsgi_app = 'app:app'
+
+# With preload_app, the application is imported in the master process
+# before on_starting, and must not connect to MongoDB there (see app.py):
+# the workers connect, and start their background threads, in post_fork
+if preload_app:
+    os.environ['CONNECT_ON_IMPORT'] = '0'
+
+
+# The MongoDB connection pool of each worker is sized
+# to the number of requests the worker serves concurrently
+if worker_class != 'gthread':
+    concurrency = worker_connections
+else:
+    concurrency = threads
+
+os.environ.setdefault('MONGO_POOL_SIZE', str(concurrency))
+
+
+def on_starting(server):
+
+    # The workers add up their metrics through a shared directory
+    # (see metrics.py), emptied of the snapshots of a previous run
+    if workers > 1:
+        import metrics
+
+        metrics_dir = os.environ.get('METRICS_DIR')
+
+        if metrics_dir == None:
+            metrics_dir = tempfile.mkdtemp(prefix='metrics-')
+            os.environ['METRICS_DIR'] = metrics_dir
+        else:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+        metrics.clear_directory(metrics_dir)
+
+    if workers > 1 and session_backend != 'mongo':
+        server.log.warning('%d workers with SESSION_BACKEND=memory: '
+                           'sessions will not be shared by the workers', workers)
+
+    # The carts kept in the memory of each worker would differ from
+    # worker to worker (see cart_store.py)
+    import cart_store
+
+    if workers > 1 and cart_store.CART_BACKEND == 'mongo' and cart_store.CART_FLUSH_INTERVAL > 0:
+        raise RuntimeError('%d workers with CART_BACKEND=mongo need CART_FLUSH_INTERVAL=0, '
+                           'or the workers will not share the carts' % workers)
+
+    # Apply the index migrations once, in the master process,
+    # instead of in every worker (see indexes.py)
+    # (with preload_app, the application imported by then has not applied them)
+
+    if os.environ.get('MIGRATE_ON_STARTUP', '1') != '1':
+        return
+
+    from common import mongo_client
+    import indexes
+
+    client = mongo_client()
+
+    try:
+        indexes.migrate(client['DSPharmacy'])
+    finally:
+        client.close()
+
+    # (the workers inherit the environment of the master)
+    os.environ['MIGRATE_ON_STARTUP'] = '0'
+
+
+def post_fork(server, worker):
+
+    # With preload_app, the application was imported in the master
+    # without connecting: the worker creates its MongoClient, and starts
+    # the background threads of the application
+    if preload_app:
+        import app
+        app.ensure_connection()
@@ -0,0 +1,238 @@
+# Idempotency keys.
+#
+# A client retrying /signup or /user/checkout (e.g. after a timeout, not
+# knowing whether the first attempt went through) sends the same
+# Idempotency-Key header with every attempt, a value of its own choosing
+# (a UUID, say) for each operation. The first request with a key is served
+# as usual and its response is stored; the retries get the stored response
+# again, without running the endpoint: the stock is not purchased twice,
+# no second order is recorded, and neither Products nor Users is touched.
+#
+# The responses are kept in the 'Idempotency' collection, one document
+# per key:
+#
+#     {'scope': 'checkout', 'owner': email, 'key': ...,
+#      'fingerprint': ..., 'status': 200, 'mimetype': ..., 'body': b'...',
+#      'expiresAt': datetime}
+#
+# The keys of checkout belong to the user (owner), the keys of signup to
+# the client's IP address and the email signing up (owner: 'address email'),
+# so that a key chosen by two guests is two keys. A key used again by its
+# owner with a different request body is
+# answered with 422 (the fingerprint is a hash of the body). MongoDB
+# removes the documents IDEMPOTENCY_TTL seconds (default: a day) after
+# the response was stored, with a TTL index.
+#
+# The first request claims the key by inserting the document without a
+# response, so that concurrent retries cannot both run the endpoint: while
+# the first one is in progress the others are answered with 409. A claim
+# whose request failed (500, or the process died) is given up, and a later
+# retry runs the endpoint again; a claim outlives its request by
+# IDEMPOTENCY_LOCK_TIMEOUT seconds at most.
+#
+# Retries come in bursts shortly after the first request, so the stored
+# responses are also kept in memory (up to IDEMPOTENCY_CACHE_SIZE, the
+# least recently used are dropped first), and answered without a database
+# read in that window.
+
+from collections import OrderedDict
+from datetime import timedelta, timezone
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+import hashlib
+import os
+import threading
+import time
+
+import session_store
+
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))  # seconds
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', 60))  # seconds
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+
+# What begin() found
+NEW = 'new'                  # the key is claimed, the endpoint must run
+REPLAY = 'replay'            # the stored response must be returned
+IN_PROGRESS = 'in-progress'  # another request with the key is running
+MISMATCH = 'mismatch'        # the key was used with another request body
+
+
+def is_key_valid(key):
+    return 0 < len(key) <= MAX_KEY_LENGTH
+
+
+def fingerprint(body):
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def expiry_time(expires_at):
+
+    # time.time() of a datetime read from MongoDB (naive, in UTC)
+    if expires_at.tzinfo == None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+
+    return expires_at.timestamp()
+
+
+class IdempotencyStore:
+
+    def __init__(self, collection, ttl=IDEMPOTENCY_TTL,
+                 lock_timeout=IDEMPOTENCY_LOCK_TIMEOUT, max_entries=IDEMPOTENCY_CACHE_SIZE):
+        self.collection = collection
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.max_entries = max_entries
+
+        # (scope, owner, key) -> stored document, with 'expires' (time.time()),
+        # ordered from the least to the most recently used
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.stored = 0       # responses stored
+        self.replays = 0      # retries answered with a stored response
+        self.memory_hits = 0  # ... of which without a database read
+        self.conflicts = 0    # retries answered 409 or 422
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def cached(self, handle):
+        with self.lock:
+            document = self.entries.get(handle)
+
+            if document == None:
+                return None
+
+            if document['expires'] < time.time():
+                del self.entries[handle]
+                return None
+
+            self.entries.move_to_end(handle)
+
+            return document
+
+    def remember(self, handle, document):
+        with self.lock:
+            self.entries[handle] = document
+            self.entries.move_to_end(handle)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stored_result(self, document, request_fingerprint, in_memory):
+
+        if document['fingerprint'] != request_fingerprint:
+            self.count('conflicts')
+            return MISMATCH, None
+
+        self.count('replays')
+
+        if in_memory:
+            self.count('memory_hits')
+
+        return REPLAY, document
+
+    def begin(self, scope, owner, key, request_fingerprint):
+
+        # Returns (NEW, None), (REPLAY, stored document),
+        # (IN_PROGRESS, None) or (MISMATCH, None)
+
+        handle = (scope, owner, key)
+        document = self.cached(handle)
+
+        if document != None:
+            return self.stored_result(document, request_fingerprint, True)
+
+        query = {'scope': scope, 'owner': owner, 'key': key}
+        now = session_store.utcnow()
+        claim = {'fingerprint': request_fingerprint,
+                 'expiresAt': now + timedelta(seconds=self.lock_timeout)}
+
+        # (twice: a document found missing may have expired meanwhile)
+        for attempt in range(2):
+            try:
+                self.collection.insert_one(dict(query, **claim))
+                return NEW, None
+            except DuplicateKeyError:
+                pass
+
+            document = self.collection.find_one(query)
+
+            if document == None:
+                continue
+
+            if 'status' in document:
+                document['expires'] = expiry_time(document['expiresAt'])
+                self.remember(handle, document)
+
+                return self.stored_result(document, request_fingerprint, False)
+
+            # The claim of a request that did not complete is taken over
+            # once it has timed out
+            if self.collection.update_one(dict(query, status={'$exists': False},
+                                               expiresAt={'$lt': now}),
+                                          {'$set': claim}).modified_count == 1:
+                return NEW, None
+
+            break
+
+        self.count('conflicts')
+
+        return IN_PROGRESS, None
+
+    def complete(self, scope, owner, key, status, mimetype, body):
+
+        # Stores the response of the request that claimed the key
+
+        expires_at = session_store.utcnow() + timedelta(seconds=self.ttl)
+
+        result = {'status': status, 'mimetype': mimetype, 'body': body, 'expiresAt': expires_at}
+
+        document = self.collection.find_one_and_update(
+            {'scope': scope, 'owner': owner, 'key': key},
+            {'$set': result},
+            {'fingerprint': 1})
+
+        if document == None:
+            return
+
+        self.remember((scope, owner, key),
+                      dict(result, fingerprint=document['fingerprint'],
+                           expires=expiry_time(expires_at)))
+
+        self.count('stored')
+
+    def abandon(self, scope, owner, key):
+
+        # Gives up the claim, so that a retry runs the endpoint again
+        self.collection.delete_one({'scope': scope, 'owner': owner, 'key': key,
+                                    'status': {'$exists': False}})
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'stored': self.stored,
+                'replays': self.replays,
+                'memory_hits': self.memory_hits,
+                'conflicts': self.conflicts
+            }
+
+
+def create_idempotency_indexes(db):
+
+    # One document per key (the insert of a second claim fails)
+    db['Idempotency'].create_index([('scope', ASCENDING), ('owner', ASCENDING), ('key', ASCENDING)],
+                                   name='scope_owner_key', unique=True)
+
+    # MongoDB removes a stored response (or an abandoned claim)
+    # once its expiresAt has passed
+    db['Idempotency'].create_index([('expiresAt', ASCENDING)],
+                                   name='expires_ttl', expireAfterSeconds=0)
@@ -0,0 +1,219 @@
+# Index management for the DSPharmacy database.
+#
+# Every change to the indexes of the database is written as a numbered
+# migration and appended to the MIGRATIONS list below. The number of the
+# last migration that was applied is kept in the 'Migrations' collection,
+# so running migrate() repeatedly (at every start of the web service)
+# only applies the migrations that are still pending.
+#
+# Usage (from the command line):
+#
+#     python3 indexes.py migrate   # apply pending migrations
+#     python3 indexes.py status    # show applied / pending migrations
+#     python3 indexes.py stats     # show index usage ($indexStats)
+
+from pymongo import ASCENDING
+
+import sys
+import time
+
+import search
+import session_store
+import orders
+import reservations
+import idempotency
+import rate_limit
+
+from common import mongo_client
+
+
+# Migrations ...
+
+
+# 001. Initial indexes for the Users and Products collections
+def initial_indexes(db):
+
+    users = db['Users']
+    products = db['Products']
+
+    # The administrator account has no email or ssn,
+    # and the user accounts have no username,
+    # so the unique indexes are sparse: documents that
+    # do not contain the field are not indexed at all.
+
+    users.create_index([('email', ASCENDING)],
+                       name='email_unique', unique=True, sparse=True)
+    users.create_index([('ssn', ASCENDING)],
+                       name='ssn_unique', unique=True, sparse=True)
+    users.create_index([('username', ASCENDING)],
+                       name='username_unique', unique=True, sparse=True)
+
+    # product-search filters by category or name
+    # and sorts the results by price
+
+    products.create_index([('category', ASCENDING), ('price', ASCENDING)],
+                          name='category_price')
+    products.create_index([('name', ASCENDING), ('price', ASCENDING)],
+                          name='name_price')
+
+
+# 002. Search terms index for product-search (see search.py)
+def search_terms_index(db):
+    search.create_search_index(db)
+
+
+# 003. Sessions collection, for the shared session store (see session_store.py)
+def sessions_indexes(db):
+    session_store.create_session_indexes(db)
+
+
+# 004. Orders collection, for the order history (see orders.py)
+def orders_indexes(db):
+    orders.create_orders_indexes(db)
+
+
+# 005. Reservations collection, for the stock reservations (see reservations.py)
+def reservations_indexes(db):
+    reservations.create_reservation_indexes(db)
+
+
+# 006. Idempotency collection, for the stored responses (see idempotency.py)
+def idempotency_indexes(db):
+    idempotency.create_idempotency_indexes(db)
+
+
+# 007. RateLimits collection, for the shared token buckets (see rate_limit.py)
+def rate_limit_indexes(db):
+    rate_limit.create_rate_limit_indexes(db)
+
+
+# 008. Products inserted by checkout
+# (checkout used to purchase with upserts, which inserted a document with
+#  only an _id and a stock for a product deleted meanwhile, and removed it
+#  afterwards; a worker that died in between left it in Products for good)
+def purchase_leftovers(db):
+    db['Products'].delete_many({'name': {'$exists': False}})
+
+
+# 009. Orders index that sorts the order history (see orders.py)
+def orders_sort_index(db):
+    orders.create_orders_sort_index(db)
+
+
+# The list of all migrations, in the order they must be applied.
+# Each entry is (version, description, function) and
+# new migrations must only ever be appended to the end of the list.
+MIGRATIONS = [
+    (1, 'Initial Users and Products indexes', initial_indexes),
+    (2, 'Products search terms index', search_terms_index),
+    (3, 'Sessions TTL and handle indexes', sessions_indexes),
+    (4, 'Orders email/timestamp index', orders_indexes),
+    (5, 'Reservations session/product, expiry and email indexes', reservations_indexes),
+    (6, 'Idempotency key and TTL indexes', idempotency_indexes),
+    (7, 'RateLimits TTL index', rate_limit_indexes),
+    (8, 'Remove the Products documents left by checkout', purchase_leftovers),
+    (9, 'Orders email/timestamp/_id index', orders_sort_index),
+]
+
+
+# Migration Runner ...
+
+def current_version(db):
+    state = db['Migrations'].find_one({'_id': 'indexes'})
+
+    if state == None:
+        return 0
+
+    return state['version']
+
+
+def pending_migrations(db):
+    version = current_version(db)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+
+def migrate(db):
+
+    applied = []
+
+    for version, description, function in pending_migrations(db):
+
+        function(db)
+
+        # Record the migration only after it has been applied,
+        # so a failed migration is retried on the next run.
+        # (create_index and delete_many are idempotent, so retrying is safe)
+        db['Migrations'].update_one({'_id': 'indexes'}, {
+            '$set': {'version': version, 'appliedAt': time.time()},
+            '$push': {'history': {'version': version,
+                                  'description': description,
+                                  'appliedAt': time.time()}}
+        }, upsert=True)
+
+        applied.append(version)
+
+    return applied
+
+
+# Index Usage Report ...
+
+def index_stats(db, collections=('Users', 'Products')):
+
+    report = {}
+
+    for name in collections:
+        report[name] = []
+
+        for stat in db[name].aggregate([{'$indexStats': {}}]):
+            report[name].append({
+                'name': stat['name'],
+                'key': dict(stat['key']),
+                'ops': stat['accesses']['ops'],
+                'since': stat['accesses']['since'].isoformat()
+            })
+
+        # Most used indexes first,
+        # unused indexes (ops == 0) are candidates for removal
+        report[name].sort(key=lambda stat: stat['ops'], reverse=True)
+
+    return report
+
+
+# Command Line Interface ...
+
+def main(argv):
+
+    if len(argv) != 2 or argv[1] not in ['migrate', 'status', 'stats']:
+        print('usage: python3 indexes.py migrate|status|stats')
+        return 2
+
+    client = mongo_client()
+    db = client['DSPharmacy']
+
+    command = argv[1]
+
+    if command == 'migrate':
+        applied = migrate(db)
+        if len(applied) == 0:
+            print('Nothing to migrate (version %d)' % current_version(db))
+        for version in applied:
+            print('Applied migration %03d' % version)
+
+    elif command == 'status':
+        version = current_version(db)
+        for number, description, _ in MIGRATIONS:
+            state = 'applied' if number <= version else 'pending'
+            print('%03d  %-8s %s' % (number, state, description))
+
+    elif command == 'stats':
+        for name, stats in index_stats(db).items():
+            print(name)
+            for stat in stats:
+                print('    %-24s %10d ops  since %s' %
+                      (stat['name'], stat['ops'], stat['since']))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,404 @@
+# Request and MongoDB metrics, in the Prometheus text format.
+#
+#   http_requests_total{route,method,status}           requests served
+#   http_request_duration_seconds{route}               request time (histogram)
+#   mongodb_commands_total{route,collection,command}   MongoDB commands sent
+#   mongodb_command_duration_seconds{...}              MongoDB time (sum and count)
+#   mongodb_command_failures_total{...}                failed MongoDB commands
+#
+# The MongoDB commands are attributed to the route of the request that sent
+# them (commands sent outside of a request have route="background"), so the
+# time of a route can be split between MongoDB and the rest of the handler.
+#
+# Recording a request or a command only takes a lock and a few dictionary
+# updates, so the metrics can stay on in production.
+#
+# The metrics are kept per process. With several workers (METRICS_DIR set,
+# as gunicorn.conf.py does), every worker also writes a snapshot of its
+# metrics to a file of that directory, named after its pid, every
+# METRICS_WRITE_INTERVAL seconds, and a scrape of /metrics, whatever
+# worker serves it, adds up the snapshots of all the workers (its own
+# figures are taken live):
+#
+#   - the counters, histograms and summaries are summed over every worker
+#     that has served since the server started, including the workers that
+#     have exited since (their files stay), so the series never go down
+#     when a worker is restarted, and rate() and histogram_quantile() over
+#     them are right
+#   - the gauges of the collectors (cache sizes, requests in flight, ...)
+#     are reported per live worker, with a pid label
+#
+# The directory is emptied when the server starts.
+
+from pymongo import monitoring
+
+import atexit
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+
+
+# Request duration histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Snapshots are written every this many seconds, when METRICS_DIR is set
+METRICS_WRITE_INTERVAL = float(os.environ.get('METRICS_WRITE_INTERVAL', 1))  # seconds
+
+# The route of the request being served by the current thread (or greenlet)
+current_route = contextvars.ContextVar('current_route', default='background')
+
+
+class Registry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # (route, method, status) -> count
+        self.requests = {}
+
+        # route -> [count of each bucket..., count of +Inf, sum]
+        self.durations = {}
+
+        # (route, collection, command) -> [count, seconds, failures]
+        self.commands = {}
+
+        # Functions returning more metrics, see add_collector
+        self.collectors = []
+
+        # The process whose snapshots are being written (see start_writer)
+        self.writer_pid = None
+
+    def observe_request(self, route, method, status, seconds):
+
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+
+        with self.lock:
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            histogram = self.durations.get(route)
+            if histogram == None:
+                histogram = self.durations[route] = [0] * (len(BUCKETS) + 1) + [0.0]
+
+            histogram[bucket] += 1
+            histogram[-1] += seconds
+
+    def observe_command(self, route, collection, command, seconds, failed):
+
+        with self.lock:
+            key = (route, collection, command)
+
+            stats = self.commands.get(key)
+            if stats == None:
+                stats = self.commands[key] = [0, 0.0, 0]
+
+            stats[0] += 1
+            stats[1] += seconds
+            if failed:
+                stats[2] += 1
+
+    def add_collector(self, collector):
+
+        # collector() returns a list of (name, type, help, samples),
+        # where samples is a list of ({label: value}, value)
+        self.collectors.append(collector)
+
+    def snapshot(self):
+
+        # The metrics of this process, as written to METRICS_DIR
+
+        with self.lock:
+            requests = [list(key) + [count] for key, count in self.requests.items()]
+            durations = {route: list(histogram) for route, histogram in self.durations.items()}
+            commands = [list(key) + [list(stats)] for key, stats in self.commands.items()]
+
+        collected = []
+        for collector in self.collectors:
+            for name, metric_type, help_text, samples in collector():
+                collected.append([name, metric_type, help_text,
+                                  [[list(sample_labels.items()), value]
+                                   for sample_labels, value in samples]])
+
+        return {
+            'pid': os.getpid(),
+            'requests': requests,
+            'durations': durations,
+            'commands': commands,
+            'collected': collected
+        }
+
+    # Several Processes ...
+
+    def write_snapshot(self, directory):
+
+        # Written to a temporary file first, so a scrape never reads half of it
+        path = os.path.join(directory, 'metrics-%d.json' % os.getpid())
+
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self.snapshot(), file)
+
+        os.replace(path + '.tmp', path)
+
+    def start_writer(self):
+
+        # Starts writing the snapshots of this process, if METRICS_DIR is set
+        # (called on every request, only does something in a new process)
+
+        if self.writer_pid == os.getpid():
+            return
+
+        self.writer_pid = os.getpid()
+
+        directory = os.environ.get('METRICS_DIR')
+
+        if directory == None:
+            return
+
+        def run():
+            while True:
+                time.sleep(METRICS_WRITE_INTERVAL)
+                try:
+                    self.write_snapshot(directory)
+                except Exception:
+                    # (e.g. the directory has been removed)
+                    pass
+
+        writer = threading.Thread(target=run, name='metrics-writer', daemon=True)
+        writer.start()
+
+        # The last figures of the process are written when it exits
+        atexit.register(self.write_snapshot, directory)
+
+    def snapshots(self):
+
+        # The snapshot of this process, and the ones the other processes wrote
+
+        snapshots = [self.snapshot()]
+        directory = os.environ.get('METRICS_DIR')
+
+        if directory == None:
+            return snapshots
+
+        for file_name in os.listdir(directory):
+            if not (file_name.startswith('metrics-') and file_name.endswith('.json')):
+                continue
+
+            try:
+                with open(os.path.join(directory, file_name)) as file:
+                    snapshot = json.load(file)
+            except (OSError, ValueError):
+                continue
+
+            if snapshot['pid'] != os.getpid():
+                snapshots.append(snapshot)
+
+        return snapshots
+
+    def render(self):
+
+        requests = {}
+        durations = {}
+        commands = {}
+
+        # name -> (type, help, {labels: value})
+        collected = {}
+
+        for snapshot in self.snapshots():
+
+            for route, method, status, count in snapshot['requests']:
+                key = (route, method, status)
+                requests[key] = requests.get(key, 0) + count
+
+            for route, histogram in snapshot['durations'].items():
+                total = durations.setdefault(route, [0] * (len(BUCKETS) + 1) + [0.0])
+                for index, count in enumerate(histogram):
+                    total[index] += count
+
+            for route, collection, command, stats in snapshot['commands']:
+                total = commands.setdefault((route, collection, command), [0, 0.0, 0])
+                for index, value in enumerate(stats):
+                    total[index] += value
+
+            alive = is_alive(snapshot['pid'])
+
+            for name, metric_type, help_text, samples in snapshot['collected']:
+                values = collected.setdefault(name, (metric_type, help_text, {}))[2]
+
+                for sample_labels, value in samples:
+                    if metric_type == 'gauge':
+                        # (the gauges of the processes that have exited are left out)
+                        if not alive:
+                            continue
+                        sample_labels = sample_labels + [['pid', snapshot['pid']]]
+
+                    key = tuple(tuple(label) for label in sample_labels)
+                    values[key] = values.get(key, 0) + value
+
+        lines = []
+
+        lines.append('# HELP http_requests_total Requests served.')
+        lines.append('# TYPE http_requests_total counter')
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append('http_requests_total%s %d' % (
+                labels(route=route, method=method, status=status), count))
+
+        lines.append('# HELP http_request_duration_seconds Time to serve a request.')
+        lines.append('# TYPE http_request_duration_seconds histogram')
+        for route, histogram in sorted(durations.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram):
+                cumulative += count
+                lines.append('http_request_duration_seconds_bucket%s %d' % (
+                    labels(route=route, le=repr(bound)), cumulative))
+            cumulative += histogram[len(BUCKETS)]
+            lines.append('http_request_duration_seconds_bucket%s %d' % (
+                labels(route=route, le='+Inf'), cumulative))
+            lines.append('http_request_duration_seconds_sum%s %r' % (
+                labels(route=route), histogram[-1]))
+            lines.append('http_request_duration_seconds_count%s %d' % (
+                labels(route=route), cumulative))
+
+        lines.append('# HELP mongodb_commands_total MongoDB commands sent.')
+        lines.append('# TYPE mongodb_commands_total counter')
+        for (route, collection, command), stats in sorted(commands.items()):
+            lines.append('mongodb_commands_total%s %d' % (
+                labels(route=route, collection=collection, command=command), stats[0]))
+
+        lines.append('# HELP mongodb_command_duration_seconds Time spent in MongoDB commands.')
+        lines.append('# TYPE mongodb_command_duration_seconds summary')
+        for (route, collection, command), stats in sorted(commands.items()):
+            label_text = labels(route=route, collection=collection, command=command)
+            lines.append('mongodb_command_duration_seconds_sum%s %r' % (label_text, stats[1]))
+            lines.append('mongodb_command_duration_seconds_count%s %d' % (label_text, stats[0]))
+
+        lines.append('# HELP mongodb_command_failures_total Failed MongoDB commands.')
+        lines.append('# TYPE mongodb_command_failures_total counter')
+        for (route, collection, command), stats in sorted(commands.items()):
+            lines.append('mongodb_command_failures_total%s %d' % (
+                labels(route=route, collection=collection, command=command), stats[2]))
+
+        for name, (metric_type, help_text, values) in collected.items():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for key, value in values.items():
+                lines.append('%s%s %r' % (name, labels(**dict(key)), value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def is_alive(pid):
+
+    if pid == os.getpid():
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def clear_directory(directory):
+
+    # Removes the snapshots of a previous run of the server
+    for file_name in os.listdir(directory):
+        if file_name.startswith('metrics-'):
+            os.remove(os.path.join(directory, file_name))
+
+
+def labels(**values):
+
+    if len(values) == 0:
+        return ''
+
+    return '{' + ','.join('%s="%s"' % (name, escape(str(value)))
+                          for name, value in values.items()) + '}'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# MongoDB Commands ...
+
+class CommandListener(monitoring.CommandListener):
+
+    # pymongo calls the listener in the thread that sends the command,
+    # so the route of the current request is known when the command starts
+
+    def __init__(self, registry):
+        self.registry = registry
+
+        # request_id -> (route, collection), of the commands in flight
+        self.pending = {}
+
+    def started(self, event):
+        self.pending[event.request_id] = (current_route.get(), collection_of(event))
+
+    def succeeded(self, event):
+        self.finish(event, False)
+
+    def failed(self, event):
+        self.finish(event, True)
+
+    def finish(self, event, failed):
+        route, collection = self.pending.pop(event.request_id, ('background', ''))
+        self.registry.observe_command(route, collection, event.command_name,
+                                      event.duration_micros / 1e6, failed)
+
+
+def collection_of(event):
+
+    # The collection is the value of the command's first field
+    # (e.g. {'find': 'Products', ...}), except for getMore
+    # ({'getMore': <cursor id>, 'collection': 'Products'})
+
+    target = event.command.get(event.command_name)
+
+    if isinstance(target, str):
+        return target
+
+    return event.command.get('collection', '')
+
+
+# Flask ...
+
+def init_app(app, registry):
+
+    # Times every request of the Flask application
+
+    from flask import request, g
+
+    @app.before_request
+    def start_timer():
+        registry.start_writer()
+
+        g.metrics_start = time.perf_counter()
+
+        if request.url_rule != None:
+            route = request.url_rule.rule
+        else:
+            route = 'unmatched'
+
+        g.metrics_route = route
+        current_route.set(route)
+
+    @app.after_request
+    def stop_timer(response):
+        # (for a streamed response, this is the time to the first byte)
+        if 'metrics_start' in g:
+            registry.observe_request(g.metrics_route, request.method, response.status_code,
+                                     time.perf_counter() - g.metrics_start)
+        current_route.set('background')
+        return response
+
+
+# The registry and the MongoDB listener of this process
+registry = Registry()
+command_listener = CommandListener(registry)
@@ -0,0 +1,110 @@
+# Orders collection.
+#
+# The receipts of the checkouts are kept in the 'Orders' collection,
+# one document per receipt, with the email of the user who made the order:
+#
+#     {'email': ..., 'products': {...}, 'total': ..., 'timestamp': ...}
+#
+# (they used to be pushed into the 'orderHistory' array of the user's document)
+#
+# Usage (from the command line):
+#
+#     python3 orders.py migrate   # move the orderHistory arrays into Orders
+
+from pymongo import ASCENDING, UpdateOne
+
+import sys
+
+from common import mongo_client
+
+
+def create_orders_indexes(db):
+
+    # A user's orders, in chronological order
+    db['Orders'].create_index([('email', ASCENDING), ('timestamp', ASCENDING)],
+                              name='email_timestamp')
+
+
+def create_orders_sort_index(db):
+
+    # A user's orders, in the order of the order history (OLDEST_ORDER_FIRST
+    # in common.py, read backwards for NEWEST_ORDER_FIRST): the index gives
+    # the pages, the newest order and the whole history already sorted,
+    # instead of sorting the user's orders in memory. It replaces
+    # email_timestamp, a prefix of it.
+    db['Orders'].create_index([('email', ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)],
+                              name='email_timestamp_id')
+
+    if 'email_timestamp' in db['Orders'].index_information():
+        db['Orders'].drop_index('email_timestamp')
+
+
+def migrate_order_history(db, batch_size=1000):
+
+    # Moves every receipt found in an 'orderHistory' array into Orders.
+    #
+    # The receipts are streamed out of the Users collection one by one
+    # ($unwind), and written to Orders in batches, so that neither the
+    # users nor their order histories have to be held in memory at once.
+    #
+    # Each receipt is upserted by (email, timestamp), so running the
+    # migration again after an interruption does not duplicate orders.
+
+    users = db['Users']
+    orders = db['Orders']
+
+    receipts = users.aggregate([
+        {'$match': {'orderHistory.0': {'$exists': True}}},
+        {'$project': {'_id': 0, 'email': 1, 'orderHistory': 1}},
+        {'$unwind': '$orderHistory'}
+    ], allowDiskUse=True, batchSize=batch_size)
+
+    migrated = 0
+    batch = []
+
+    for receipt in receipts:
+        order = dict(receipt['orderHistory'])
+        order['email'] = receipt['email']
+
+        batch.append(UpdateOne({'email': order['email'],
+                                'timestamp': order['timestamp']},
+                               {'$setOnInsert': order},
+                               upsert=True))
+
+        if len(batch) == batch_size:
+            orders.bulk_write(batch, ordered=False)
+            migrated += len(batch)
+            batch = []
+
+    if len(batch) > 0:
+        orders.bulk_write(batch, ordered=False)
+        migrated += len(batch)
+
+    # Only once every receipt is in Orders,
+    # the arrays are removed from the user documents
+    users.update_many({'orderHistory': {'$exists': True}},
+                      {'$unset': {'orderHistory': ''}})
+
+    return migrated
+
+
+# Command Line Interface ...
+
+def main(argv):
+
+    if len(argv) != 2 or argv[1] != 'migrate':
+        print('usage: python3 orders.py migrate')
+        return 2
+
+    client = mongo_client()
+    db = client['DSPharmacy']
+
+    create_orders_indexes(db)
+
+    print('Migrated %d orders' % migrate_order_history(db))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,53 @@
+# Keyset (cursor based) pagination helpers.
+#
+# A page is requested with a 'limit' and, after the first page,
+# with the cursor of the last item of the previous page.
+# The cursor is the pair (sort value, _id) of that item,
+# encoded as the string '<value>:<_id>' (e.g. '3.5:614a75044fd25d678e9cd212').
+#
+# Because the _id breaks the ties between items with the same sort value,
+# the next page can be found with an index seek, instead of skipping over
+# all the items of the previous pages (as skip/offset pagination would do).
+
+from bson.objectid import ObjectId
+
+
+MAX_PAGE_SIZE = 1000
+
+
+def is_limit_valid(limit):
+    return (isinstance(limit, int) and
+            not isinstance(limit, bool) and
+            1 <= limit <= MAX_PAGE_SIZE)
+
+
+def encode_cursor(value, object_id):
+    return repr(value) + ':' + str(object_id)
+
+
+def decode_cursor(cursor):
+
+    # Returns (value, ObjectId) or None if the cursor is malformed
+
+    if not isinstance(cursor, str):
+        return None
+
+    value, _, object_id = cursor.rpartition(':')
+
+    try:
+        return float(value), ObjectId(object_id)
+    except Exception:
+        return None
+
+
+def keyset_filter(field, value, object_id, direction=1):
+
+    # Items strictly after (direction=1) or before (direction=-1)
+    # the item (value, object_id), in (field, _id) order
+
+    operator = '$gt' if direction == 1 else '$lt'
+
+    return {'$or': [
+        {field: {operator: value}},
+        {field: value, '_id': {operator: object_id}}
+    ]}
@@ -0,0 +1,135 @@
+# Read-through cache of product documents.
+#
+# Only the fields of a product that rarely change are cached
+# (name, price, category, description). The stock is NOT cached:
+# it changes with every checkout, so it is always read from the database.
+#
+# Entries are evicted when the cache is full (least recently used first),
+# and expire PRODUCT_CACHE_TTL seconds after they were loaded.
+# update-product and delete-product invalidate the entry of the product
+# at once in the process that served them. The other worker processes
+# learn of the change from the catalog generation (see search_cache.py),
+# which every change of the products increments: the cache reads it at
+# most every PRODUCT_CACHE_CHECK_INTERVAL seconds (0: on every get), and
+# drops all its entries when it has changed, so a product is served stale
+# for that long at most, whatever worker changed it.
+
+from collections import OrderedDict
+
+import os
+import threading
+import time
+
+import search_cache
+
+
+PRODUCT_CACHE_SIZE = int(os.environ.get('PRODUCT_CACHE_SIZE', 1024))
+PRODUCT_CACHE_TTL = int(os.environ.get('PRODUCT_CACHE_TTL', 60))  # seconds
+PRODUCT_CACHE_CHECK_INTERVAL = float(os.environ.get('PRODUCT_CACHE_CHECK_INTERVAL', 0.1))  # seconds
+
+CACHED_FIELDS = {'name': 1, 'price': 1, 'category': 1, 'description': 1}
+
+
+class ProductCache:
+
+    def __init__(self, products, meta, max_entries=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL,
+                 check_interval=PRODUCT_CACHE_CHECK_INTERVAL):
+        self.products = products
+        self.meta = meta
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        # _id -> (product, expires),
+        # ordered from the least to the most recently used product
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Incremented by every invalidation, so that a product read from
+        # the database before an invalidation is not put in the cache after it
+        self.generation = 0
+
+        # The catalog generation the entries were loaded in,
+        # and when to read it again
+        self.catalog_generation = None
+        self.next_check = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, product_id):
+
+        # Returns the cached fields (and the _id) of the product,
+        # or None if there is no such product
+
+        now = time.time()
+
+        self.check_catalog(now)
+
+        with self.lock:
+            entry = self.entries.get(product_id)
+
+            if entry != None and entry[1] > now:
+                self.hits += 1
+                self.entries.move_to_end(product_id)
+                return entry[0]
+
+            self.misses += 1
+            generation = self.generation
+
+        product = self.products.find_one({'_id': product_id}, CACHED_FIELDS)
+
+        if product == None:
+            return None
+
+        with self.lock:
+            if generation != self.generation:
+                return product
+
+            self.entries[product_id] = (product, now + self.ttl)
+            self.entries.move_to_end(product_id)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+        return product
+
+    def check_catalog(self, now):
+
+        # Drops every entry if the catalog has changed since they were
+        # loaded (by this process or another one)
+
+        with self.lock:
+            if now < self.next_check:
+                return
+
+            self.next_check = now + self.check_interval
+
+        catalog_generation = search_cache.read_generation(self.meta)
+
+        with self.lock:
+            if catalog_generation != self.catalog_generation:
+                self.catalog_generation = catalog_generation
+                self.generation += 1
+                self.entries.clear()
+
+    def invalidate(self, product_id):
+        with self.lock:
+            self.generation += 1
+            self.entries.pop(product_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
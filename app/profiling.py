@@ -0,0 +1,264 @@
+# On-demand profiling of requests.
+#
+# Profiling is off unless PROFILE_RATE or PROFILE_TOKEN is set. A request is
+# profiled when:
+#
+#   - it is picked at random, with probability PROFILE_RATE (0.0 to 1.0), or
+#   - it carries the header 'X-Profile: <PROFILE_TOKEN>'; the response then
+#     carries the name of the profile file in its own 'X-Profile' header.
+#
+# Only the routes listed in PROFILE_ROUTES (comma separated, e.g.
+# '/product-search,/user/checkout') are profiled, or every route if it is empty.
+#
+# PROFILE_MODE chooses the profiler:
+#
+#   - 'cprofile' (default): deterministic profile of every function call,
+#     written as a .pstats file (python3 -m pstats <file>, snakeviz, ...)
+#   - 'sample': the stack of the request's thread is sampled about every
+#     PROFILE_INTERVAL seconds (the sampler needs the GIL), written as collapsed stacks in a .collapsed
+#     file (one 'frame;frame;... count' line per stack), ready for
+#     flamegraph.pl or speedscope. Its overhead does not depend on the
+#     number of calls, so it suits requests that make many small calls.
+#
+# The profiles are written to PROFILE_DIR, named after the time, the route,
+# the duration of the request and the process. Profiles of requests faster
+# than PROFILE_MIN_DURATION seconds are dropped, and once the files in
+# PROFILE_DIR add up to more than PROFILE_MAX_BYTES the oldest are removed.
+#
+# A process profiles one request at a time (cProfile cannot run twice at
+# once); requests picked while another one is profiled are served normally.
+# With the gevent worker class, 'sample' mode cannot see the greenlet of
+# the request, so use 'cprofile' there.
+
+import cProfile
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+
+
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', 0))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_ROUTES = [route for route in os.environ.get('PROFILE_ROUTES', '').split(',') if route != '']
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile')  # 'cprofile' or 'sample'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', 0.001))  # seconds
+PROFILE_MIN_DURATION = float(os.environ.get('PROFILE_MIN_DURATION', 0))  # seconds
+PROFILE_MAX_BYTES = int(os.environ.get('PROFILE_MAX_BYTES', 100 * 1024 * 1024))
+
+
+class CallProfiler:
+
+    # cProfile, of the thread that starts it
+
+    extension = '.pstats'
+
+    def __init__(self, interval):
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+
+    def write(self, path):
+        self.profiler.dump_stats(path)
+
+
+class SamplingProfiler:
+
+    # Samples the stack of the thread that starts it, from another thread
+
+    extension = '.collapsed'
+
+    def __init__(self, interval):
+        self.interval = interval
+
+        # 'outermost;...;innermost' frame -> number of samples
+        self.stacks = {}
+
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        target = threading.get_ident()
+
+        def run():
+            while not self.stopped.wait(self.interval):
+                frame = sys._current_frames().get(target)
+                if frame == None:
+                    break
+                stack = collapse(frame)
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+        self.sampler = threading.Thread(target=run, name='profile-sampler', daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def write(self, path):
+        with open(path, 'w') as output:
+            for stack, count in sorted(self.stacks.items()):
+                output.write('%s %d\n' % (stack, count))
+
+
+def collapse(frame):
+
+    frames = []
+
+    while frame != None:
+        code = frame.f_code
+        frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                      code.co_firstlineno))
+        frame = frame.f_back
+
+    # (the format of py-spy: the count follows the last space of the line)
+    return ';'.join(reversed(frames))
+
+
+PROFILERS = {'cprofile': CallProfiler, 'sample': SamplingProfiler}
+
+
+class RequestProfiler:
+
+    def __init__(self, rate=PROFILE_RATE, token=PROFILE_TOKEN, routes=PROFILE_ROUTES,
+                 mode=PROFILE_MODE, directory=PROFILE_DIR, interval=PROFILE_INTERVAL,
+                 min_duration=PROFILE_MIN_DURATION, max_bytes=PROFILE_MAX_BYTES):
+
+        if mode not in PROFILERS:
+            raise ValueError('Unknown PROFILE_MODE: ' + mode)
+
+        self.rate = rate
+        self.token = token
+        self.routes = set(routes)
+        self.profiler_class = PROFILERS[mode]
+        self.directory = directory
+        self.interval = interval
+        self.min_duration = min_duration
+        self.max_bytes = max_bytes
+
+        # Held while a request is profiled
+        self.busy = threading.Lock()
+
+        # Number of profiles written by this process, to name them
+        self.written = 0
+
+    def enabled(self):
+        return self.rate > 0 or self.token != ''
+
+    def is_triggered(self, header):
+        # (compared as bytes: compare_digest refuses str with non-ASCII characters)
+        return (self.token != '' and header != None and
+                hmac.compare_digest(header.encode(), self.token.encode()))
+
+    # Returns a started profiler if the request is to be profiled, otherwise None
+    def start(self, route, header):
+
+        if len(self.routes) > 0 and route not in self.routes:
+            return None
+
+        triggered = self.is_triggered(header)
+
+        if not triggered and (self.rate <= 0 or random.random() >= self.rate):
+            return None
+
+        if not self.busy.acquire(blocking=False):
+            return None
+
+        profiler = self.profiler_class(self.interval)
+        profiler.started = time.perf_counter()
+        profiler.start()
+
+        return profiler
+
+    # Stops the profiler, and returns the name of the profile file
+    # (or None if the request was too fast to keep its profile)
+    def stop(self, profiler, route):
+
+        try:
+            profiler.stop()
+            duration = time.perf_counter() - profiler.started
+
+            if duration < self.min_duration:
+                return None
+
+            self.written += 1
+
+            name = '%s-%s-%dms-%d-%d%s' % (
+                time.strftime('%Y%m%dT%H%M%S'),
+                route.strip('/').replace('/', '_') or 'root',
+                duration * 1000,
+                os.getpid(),
+                self.written,
+                profiler.extension)
+
+            os.makedirs(self.directory, exist_ok=True)
+            profiler.write(os.path.join(self.directory, name))
+
+            self.enforce_size_cap()
+
+            return name
+        finally:
+            self.busy.release()
+
+    def enforce_size_cap(self):
+
+        # Removes the oldest profiles, until the directory fits in max_bytes
+
+        files = []
+        total = 0
+
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(('.pstats', '.collapsed')):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+                total += stat.st_size
+
+        files.sort()
+
+        while total > self.max_bytes and len(files) > 0:
+            mtime, path, size = files.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# Flask ...
+
+def init_app(app, profiler):
+
+    # Profiles the route functions of the Flask application
+
+    from flask import request, g
+
+    if not profiler.enabled():
+        return
+
+    @app.before_request
+    def start_profile():
+        if request.url_rule != None:
+            g.profile = profiler.start(request.url_rule.rule,
+                                       request.headers.get('X-Profile'))
+
+    @app.after_request
+    def stop_profile(response):
+        # (a streamed response is generated after this,
+        #  so its profile only covers the route function)
+        if g.get('profile') != None:
+            name = profiler.stop(g.pop('profile'), request.url_rule.rule)
+            if name != None and profiler.is_triggered(request.headers.get('X-Profile')):
+                response.headers['X-Profile'] = name
+        return response
+
+    @app.teardown_request
+    def abort_profile(error):
+        # The route function raised an exception: after_request was not called
+        if g.get('profile') != None:
+            profiler.stop(g.pop('profile'), request.url_rule.rule)
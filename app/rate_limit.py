@@ -0,0 +1,278 @@
+# Rate limiting and load shedding.
+#
+# Rate limiting (RATE_LIMIT=1, off by default): every client has a token
+# bucket, holding up to 'burst' tokens and refilled with 'rate' tokens per
+# second; a request takes a token, and a request finding the bucket empty
+# is answered with 429 Too Many Requests and a Retry-After header (the
+# seconds until the next token), without reaching the database:
+#
+#   - the requests of the authorized endpoints, per session (the
+#     Authorization header, once is_authorized has found the session):
+#     RATE_LIMIT_RATE per second, bursts of RATE_LIMIT_BURST
+#   - /signup and /login, per client IP address:
+#     RATE_LIMIT_GUEST_RATE per second, bursts of RATE_LIMIT_GUEST_BURST
+#
+# The buckets are kept (RATE_LIMIT_BACKEND):
+#
+#   - 'memory' (default): in the memory of the process, up to
+#     RATE_LIMIT_MAX_KEYS buckets (the least recently used are dropped
+#     first, which only refills them). Each worker limits on its own, so
+#     with N workers a client may get up to N times the rate.
+#   - 'mongo': in the 'RateLimits' collection, shared by all the workers.
+#     A request takes its token with a single update of its bucket (an
+#     update pipeline, timed by the clock of the database server), so the
+#     limit holds whatever worker serves the request, at the cost of one
+#     round trip. A bucket is removed by a TTL index once it would be full
+#     again. If the database cannot be reached the request is let through.
+#
+# Load shedding (MAX_IN_FLIGHT, 0 = off): a process serving MAX_IN_FLIGHT
+# requests already answers any further request at once with 503 Service
+# Unavailable and Retry-After: SHED_RETRY_AFTER, instead of queueing it
+# behind the others, so that a spike makes a few requests fail fast
+# rather than all of them slow. With the gevent worker a process accepts
+# up to WEB_CONNECTIONS requests at once (see gunicorn.conf.py), which is
+# where this bound matters.
+#
+# The throttled and shed requests are counted, and exported at /metrics.
+
+from collections import OrderedDict
+
+from pymongo import ReturnDocument, ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+import math
+import os
+import threading
+import time
+
+
+RATE_LIMIT = os.environ.get('RATE_LIMIT', '0') == '1'
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')  # 'memory' or 'mongo'
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', 10))  # requests per second
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 20))
+RATE_LIMIT_GUEST_RATE = float(os.environ.get('RATE_LIMIT_GUEST_RATE', 1))  # requests per second
+RATE_LIMIT_GUEST_BURST = int(os.environ.get('RATE_LIMIT_GUEST_BURST', 10))
+RATE_LIMIT_MAX_KEYS = int(os.environ.get('RATE_LIMIT_MAX_KEYS', 100000))
+
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 0))  # requests per process, 0 = no limit
+SHED_RETRY_AFTER = int(os.environ.get('SHED_RETRY_AFTER', 1))  # seconds
+
+
+def retry_after_header(seconds):
+    # Retry-After is a whole number of seconds, at least 1
+    return str(max(1, math.ceil(seconds)))
+
+
+# Token Buckets ...
+#
+# take(key, rate, burst) takes a token from the bucket of key, and returns
+# 0 if it did, or the seconds until the bucket holds a token again.
+
+class MemoryBuckets:
+
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+
+        # key -> [tokens, time of the last update],
+        # ordered from the least to the most recently used bucket
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+
+            if bucket == None:
+                bucket = [burst, now]
+                self.buckets[key] = bucket
+
+                while len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+
+            bucket[0] = tokens
+
+            return (1 - tokens) / rate
+
+
+class MongoBuckets:
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def take(self, key, rate, burst):
+
+        # The bucket is refilled for the milliseconds since its last update,
+        # and a token is taken if there is one, in a single update
+        elapsed = {'$subtract': ['$$NOW', {'$ifNull': ['$updated', '$$NOW']}]}
+
+        refill = [
+            {'$set': {'tokens': {'$min': [burst, {'$add': [
+                          {'$ifNull': ['$tokens', burst]},
+                          {'$multiply': [elapsed, rate / 1000.0]}]}]},
+                      'updated': '$$NOW',
+                      # (when the bucket would be full again)
+                      'expiresAt': {'$add': ['$$NOW', int(burst / rate * 1000)]}}},
+            {'$set': {'taken': {'$gte': ['$tokens', 1]}}},
+            {'$set': {'tokens': {'$cond': ['$taken', {'$subtract': ['$tokens', 1]}, '$tokens']}}}
+        ]
+
+        try:
+            bucket = self.collection.find_one_and_update({'_id': key}, refill, upsert=True,
+                                                         return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # (the first requests of a client, creating the bucket concurrently)
+            bucket = self.collection.find_one_and_update({'_id': key}, refill,
+                                                         return_document=ReturnDocument.AFTER)
+
+        if bucket['taken']:
+            return 0
+
+        return (1 - bucket['tokens']) / rate
+
+
+class RateLimiter:
+
+    def __init__(self, buckets,
+                 rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST,
+                 guest_rate=RATE_LIMIT_GUEST_RATE, guest_burst=RATE_LIMIT_GUEST_BURST):
+        self.buckets = buckets
+        self.rate = rate
+        self.burst = burst
+        self.guest_rate = guest_rate
+        self.guest_burst = guest_burst
+
+        self.lock = threading.Lock()
+
+        # 'session' or 'client' -> requests throttled
+        self.throttled = {'session': 0, 'client': 0}
+        self.errors = 0  # requests let through, the buckets being unavailable
+
+    def check(self, kind, key):
+
+        # Returns 0 if the request of the session (kind 'session', key: the
+        # session id) or of the client ('client', key: its IP address) may be
+        # served, or the seconds it should wait before trying again
+
+        if kind == 'session':
+            rate, burst = self.rate, self.burst
+        else:
+            rate, burst = self.guest_rate, self.guest_burst
+
+        try:
+            wait = self.buckets.take(kind + ':' + key, rate, burst)
+        except PyMongoError:
+            with self.lock:
+                self.errors += 1
+            return 0
+
+        if wait > 0:
+            with self.lock:
+                self.throttled[kind] += 1
+
+        return wait
+
+    def stats(self):
+        with self.lock:
+            return {
+                'throttled': dict(self.throttled),
+                'errors': self.errors
+            }
+
+
+def create_limiter(db, backend=RATE_LIMIT_BACKEND):
+
+    # None: no rate limiting
+
+    if not RATE_LIMIT:
+        return None
+
+    if backend == 'memory':
+        return RateLimiter(MemoryBuckets())
+
+    if backend == 'mongo':
+        return RateLimiter(MongoBuckets(db['RateLimits']))
+
+    raise ValueError('Unknown RATE_LIMIT_BACKEND: ' + backend)
+
+
+def create_rate_limit_indexes(db):
+
+    # MongoDB removes a bucket once its expiresAt has passed
+    # (it would be full again by then)
+    db['RateLimits'].create_index([('expiresAt', ASCENDING)],
+                                  name='expires_ttl', expireAfterSeconds=0)
+
+
+# Load Shedding ...
+
+class AdmissionControl:
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+
+        self.lock = threading.Lock()
+
+        self.in_flight = 0
+        self.shed = 0  # requests answered with 503
+
+    def enter(self):
+
+        # Returns False if the request must be shed
+        with self.lock:
+            if self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                return False
+
+            self.in_flight += 1
+
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'shed': self.shed
+            }
+
+
+def init_app(app, admission, shed_response):
+
+    # Sheds the requests beyond the limit of admission, with the response
+    # made by shed_response() (nothing is done without a limit)
+
+    if admission.max_in_flight <= 0:
+        return
+
+    from flask import g
+
+    @app.before_request
+    def admit():
+        if not admission.enter():
+            response = shed_response()
+            response.headers['Retry-After'] = retry_after_header(SHED_RETRY_AFTER)
+            return response
+
+        g.admitted = True
+
+    @app.teardown_request
+    def release(exception):
+        # (a streamed response may still be sending its body by then)
+        if g.pop('admitted', False):
+            admission.leave()
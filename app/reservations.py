@@ -0,0 +1,357 @@
+# Stock reservations.
+#
+# With STOCK_RESERVATIONS=1, add-to-cart holds the quantity it adds for the
+# cart, so that the carts can never hold more than the stock, and
+# checkout only fails when a hold has expired and the stock has been taken.
+#
+# Every product carries a 'reserved' counter: the quantity held by all the
+# carts. A product is available while stock - reserved is at least the
+# quantity asked for, and reserve() checks and increments the counter in a
+# single update of the product ($expr guard + $inc), so the check is O(1)
+# and atomic, whatever the number of carts holding the product.
+#
+# Each hold is a document of the 'Reservations' collection:
+#
+#     {'session': ..., 'product': ObjectId, 'email': ..., 'quantity': 3,
+#      'expires': datetime}
+#
+# one per cart and product. The holds belong to the cart ('session'): to
+# the session the cart is kept in, or, with a cart store (see cart_store.py),
+# to the user's email, since the cart then outlives the session and is
+# found again by the next log-in, holds included. A hold expires
+# RESERVATION_TTL seconds (default: the session TTL) after the last
+# add-to-cart of the cart, so it does not outlive an inactive cart; expired
+# holds are released by a background thread every RESERVATION_SWEEP_INTERVAL
+# seconds (released: the hold is deleted and its quantity subtracted from
+# the counter). remove-from-cart and delete-account release the holds at once.
+#
+# Checkout first claims the holds of the cart (so that the sweeper
+# leaves them alone), then purchases every line with the held quantity
+# counted as available (see purchase_update in common.py), subtracting
+# it from both the stock and the counter; the holds of the purchased lines
+# are deleted, the others stay with the cart.
+#
+# The hold is written after the counter, so a crash in between can leave
+# the counter too high. 'python3 reservations.py reconcile' recomputes the
+# counters from the holds.
+
+from datetime import timedelta
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from bson.objectid import ObjectId
+
+import os
+import sys
+import threading
+import time
+
+import session_store
+
+
+STOCK_RESERVATIONS = os.environ.get('STOCK_RESERVATIONS', '0') == '1'
+RESERVATION_TTL = int(os.environ.get('RESERVATION_TTL', session_store.SESSION_TTL))  # seconds
+RESERVATION_SWEEP_INTERVAL = int(os.environ.get('RESERVATION_SWEEP_INTERVAL', 30))  # seconds
+
+# A claimed hold is only swept this long after it has expired
+# (its checkout must have failed before settling it)
+CLAIM_GRACE = timedelta(minutes=5)
+
+
+def available_filter(product_id, quantity, held=0):
+
+    # Matches the product if quantity is available to a cart holding 'held' of it
+    return {
+        '_id': product_id,
+        'stock': {'$gte': quantity},
+        '$expr': {'$gte': [
+            {'$subtract': ['$stock', {'$ifNull': ['$reserved', 0]}]},
+            quantity - held
+        ]}
+    }
+
+
+class ReservationLedger:
+
+    def __init__(self, products, reservations, ttl=RESERVATION_TTL):
+        self.products = products
+        self.reservations = reservations
+        self.ttl = timedelta(seconds=ttl)
+
+        self.lock = threading.Lock()
+
+        self.reserved = 0  # holds made or increased
+        self.rejected = 0  # holds refused, for lack of stock
+        self.released = 0  # holds released by the carts
+        self.expired = 0   # holds released by the sweeper
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def reserve(self, cart_id, email, product_id, quantity):
+
+        # Holds quantity more of the product for the cart;
+        # returns False if it is not available
+
+        if self.products.update_one(available_filter(product_id, quantity),
+                                    {'$inc': {'reserved': quantity}}).modified_count == 0:
+            self.count('rejected')
+            return False
+
+        hold = {'session': cart_id, 'product': product_id}
+        change = {'$inc': {'quantity': quantity},
+                  '$set': {'email': email, 'expires': session_store.utcnow() + self.ttl}}
+
+        try:
+            try:
+                self.reservations.update_one(hold, change, upsert=True)
+            except DuplicateKeyError:
+                # (a concurrent add-to-cart of the same cart created it)
+                self.reservations.update_one(hold, change)
+        except Exception:
+            self.products.update_one({'_id': product_id}, {'$inc': {'reserved': - quantity}})
+            raise
+
+        # The holds of the cart expire together
+        self.reservations.update_many({'session': cart_id},
+                                      {'$set': {'expires': change['$set']['expires']}})
+
+        self.count('reserved')
+
+        return True
+
+    def reserve_many(self, cart_id, email, quantities):
+
+        # Holds quantity more of every product ({product_id: quantity}) for
+        # the cart, with a guarded update of each counter. All or nothing:
+        # returns the first product found not available (a set), and then
+        # holds none of them.
+
+        items = list(quantities.items())
+
+        if len(items) == 0:
+            return set()
+
+        # (one by one, as in checkout, to know which of them did not match,
+        #  see common.py)
+        held = []
+        failed = set()
+
+        for product_id, quantity in items:
+            if self.products.update_one(available_filter(product_id, quantity),
+                                        {'$inc': {'reserved': quantity}}).matched_count == 0:
+                failed.add(product_id)
+                break
+
+            held.append((product_id, quantity))
+
+        if len(failed) > 0:
+            if len(held) > 0:
+                self.products.bulk_write([UpdateOne({'_id': product_id},
+                                                    {'$inc': {'reserved': - quantity}})
+                                          for product_id, quantity in held], ordered=False)
+
+            self.count('rejected')
+
+            return failed
+
+        expires = session_store.utcnow() + self.ttl
+
+        def hold(product_id, quantity, upsert):
+            return UpdateOne({'session': cart_id, 'product': product_id},
+                             {'$inc': {'quantity': quantity},
+                              '$set': {'email': email, 'expires': expires}},
+                             upsert=upsert)
+
+        try:
+            self.reservations.bulk_write([hold(product_id, quantity, True)
+                                          for product_id, quantity in items], ordered=False)
+        except BulkWriteError as error:
+            # (holds created meanwhile by a concurrent request of the cart
+            #  fail with a duplicate key, and are updated instead)
+            if any(write_error['code'] != 11000 for write_error in error.details['writeErrors']):
+                raise
+
+            self.reservations.bulk_write([hold(*items[write_error['index']], False)
+                                          for write_error in error.details['writeErrors']],
+                                         ordered=False)
+
+        self.reservations.update_many({'session': cart_id}, {'$set': {'expires': expires}})
+
+        self.count('reserved')
+
+        return set()
+
+    def reduce(self, cart_id, product_id, quantity):
+
+        # Releases quantity of the hold of the cart on the product
+        # (the whole hold, if it holds less)
+
+        hold = self.reservations.find_one_and_update(
+            {'session': cart_id, 'product': product_id,
+             'quantity': {'$gt': quantity}, 'claimed': {'$exists': False}},
+            {'$inc': {'quantity': - quantity}})
+
+        if hold == None:
+            self.release(cart_id, product_id)
+            return
+
+        self.products.update_one({'_id': product_id}, {'$inc': {'reserved': - quantity}})
+        self.count('released')
+
+    def release(self, cart_id, product_id):
+        # (a hold claimed by a checkout in progress is left to the checkout)
+        self.release_holds({'session': cart_id, 'product': product_id,
+                            'claimed': {'$exists': False}}, 'released')
+
+    def release_owner(self, email):
+        # Releases every hold of the user (e.g. when the account is deleted)
+        self.release_holds({'email': email}, 'released')
+
+    def release_holds(self, query, counter):
+
+        # Each hold is deleted before its quantity is subtracted,
+        # so that a hold is never released twice
+
+        for hold in self.reservations.find(query, {'_id': 1}):
+            hold = self.reservations.find_one_and_delete(dict(query, _id=hold['_id']))
+
+            if hold == None:
+                continue
+
+            self.products.update_one({'_id': hold['product']},
+                                     {'$inc': {'reserved': - hold['quantity']}})
+            self.count(counter)
+
+    # Checkout ...
+
+    def claim(self, cart_id):
+
+        # Claims the holds of the cart, and returns the token of the
+        # claim and the held quantities {product_id (str): quantity}
+
+        token = ObjectId()
+
+        self.reservations.update_many({'session': cart_id, 'claimed': {'$exists': False}},
+                                      {'$set': {'claimed': token}})
+
+        held = {str(hold['product']): hold['quantity']
+                for hold in self.reservations.find({'claimed': token},
+                                                   {'product': 1, 'quantity': 1})}
+
+        return token, held
+
+    def settle(self, token, purchased):
+
+        # The holds of the purchased products (str _ids) have been subtracted
+        # by the purchase; the others are handed back to the cart
+
+        self.reservations.delete_many({'claimed': token,
+                                       'product': {'$in': [ObjectId(product_id)
+                                                           for product_id in purchased]}})
+        self.reservations.update_many({'claimed': token}, {'$unset': {'claimed': ''}})
+
+    # Expiry ...
+
+    def sweep(self):
+
+        now = session_store.utcnow()
+
+        self.release_holds({'expires': {'$lt': now}, 'claimed': {'$exists': False}}, 'expired')
+        self.release_holds({'expires': {'$lt': now - CLAIM_GRACE}}, 'expired')
+
+    def start_sweeper(self, interval=RESERVATION_SWEEP_INTERVAL):
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sweep()
+                except Exception:
+                    # (e.g. the database is briefly unavailable)
+                    pass
+
+        sweeper = threading.Thread(target=run, name='reservation-sweeper', daemon=True)
+        sweeper.start()
+
+        return sweeper
+
+    def reconcile(self):
+
+        # Sets the counter of every product to the sum of its holds
+        # (not to be run while carts are changing)
+
+        totals = {total['_id']: total['quantity']
+                  for total in self.reservations.aggregate([
+                      {'$group': {'_id': '$product', 'quantity': {'$sum': '$quantity'}}}])}
+
+        corrected = 0
+
+        for product in self.products.find({'reserved': {'$exists': True}}, {'reserved': 1}):
+            quantity = totals.pop(product['_id'], 0)
+
+            if product['reserved'] != quantity:
+                self.products.update_one({'_id': product['_id']},
+                                         {'$set': {'reserved': quantity}})
+                corrected += 1
+
+        # Held products without a counter
+        for product_id, quantity in totals.items():
+            corrected += self.products.update_one({'_id': product_id},
+                                                  {'$set': {'reserved': quantity}}).modified_count
+
+        return corrected
+
+    def stats(self):
+        with self.lock:
+            return {
+                'reserved': self.reserved,
+                'rejected': self.rejected,
+                'released': self.released,
+                'expired': self.expired
+            }
+
+
+def create_reservation_indexes(db):
+
+    reservations = db['Reservations']
+
+    # One hold per cart and product
+    reservations.create_index([('session', ASCENDING), ('product', ASCENDING)],
+                              name='session_product', unique=True)
+
+    # For the sweeper, and to release the holds of a user
+    reservations.create_index([('expires', ASCENDING)], name='expires')
+    reservations.create_index([('email', ASCENDING)], name='email')
+    reservations.create_index([('claimed', ASCENDING)], name='claimed', sparse=True)
+
+
+# Command Line Interface ...
+
+def main(argv):
+
+    if len(argv) != 2 or argv[1] not in ['reconcile', 'sweep']:
+        print('usage: python3 reservations.py reconcile|sweep')
+        return 2
+
+    # (imported here: common.py imports this module)
+    from common import mongo_client
+
+    client = mongo_client()
+    db = client['DSPharmacy']
+
+    ledger = ReservationLedger(db['Products'], db['Reservations'])
+
+    if argv[1] == 'reconcile':
+        print('Corrected %d products' % ledger.reconcile())
+    else:
+        ledger.sweep()
+        print('Released %d expired holds' % ledger.expired)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
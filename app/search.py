@@ -0,0 +1,151 @@
+# Product search.
+#
+# Every product document carries a 'searchTerms' array with:
+#
+#   - the trigrams (3-character substrings) of its name,     as 'n:<trigram>'
+#   - the trigrams of its category,                          as 'c:<trigram>'
+#   - the words of its name and description,                 as 'w:<word>'
+#
+# The array is covered by a multikey index, so a substring search only
+# has to look at the products that contain every trigram of the search
+# term, instead of running an unanchored $regex over the whole collection.
+# The candidates are then checked against the exact (escaped) substring,
+# so the results are the same as a plain substring search.
+#
+# The old behaviour, where the search term itself is used as a regular
+# expression, is still available by setting SEARCH_MODE=regex.
+
+from pymongo import ASCENDING, UpdateOne
+
+import os
+import re
+
+
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'trigram')  # 'trigram' or 'regex'
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+# Tokenization ...
+
+def trigrams(text):
+    text = text.lower()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def words(text):
+    return set(WORD_PATTERN.findall(text.lower()))
+
+
+def search_terms(product):
+
+    terms = set()
+
+    terms.update('n:' + trigram for trigram in trigrams(product.get('name', '')))
+    terms.update('c:' + trigram for trigram in trigrams(product.get('category', '')))
+
+    terms.update('w:' + word for word in words(product.get('name', '')))
+    terms.update('w:' + word for word in words(product.get('description', '')))
+
+    return sorted(terms)
+
+
+# Queries ...
+
+def substring_filter(field, prefix, term):
+
+    term = term.lower()
+
+    if SEARCH_MODE == 'regex':
+        return {field: {'$regex': term}}
+
+    query = {field: {'$regex': re.escape(term)}}
+
+    # Terms shorter than 3 characters have no trigrams,
+    # so they can only be matched by the regex itself
+    grams = trigrams(term)
+    if len(grams) > 0:
+        query['searchTerms'] = {'$all': [prefix + gram for gram in sorted(grams)]}
+
+    return query
+
+
+def name_filter(name):
+    return substring_filter('name', 'n:', name)
+
+
+def category_filter(category):
+    return substring_filter('category', 'c:', category)
+
+
+def text_filter(text):
+
+    # Every word of the text must appear
+    # in the name or the description of the product
+    tokens = words(text)
+
+    if len(tokens) == 0:
+        return None
+
+    return {'searchTerms': {'$all': ['w:' + word for word in sorted(tokens)]}}
+
+
+# Index Maintenance ...
+
+def refresh_search_terms(products, product_id):
+
+    # Recompute the terms of a product after its
+    # name, category or description have been changed
+
+    product = products.find_one({'_id': product_id},
+                                {'name': 1, 'category': 1, 'description': 1})
+
+    if product == None:
+        return
+
+    products.update_one({'_id': product_id},
+                        {'$set': {'searchTerms': search_terms(product)}})
+
+
+def refresh_search_terms_many(products, product_ids):
+
+    # refresh_search_terms, for many products at once
+    # (one read and one bulk write)
+
+    if len(product_ids) == 0:
+        return
+
+    cursor = products.find({'_id': {'$in': list(product_ids)}},
+                           {'name': 1, 'category': 1, 'description': 1})
+
+    batch = [UpdateOne({'_id': product['_id']},
+                       {'$set': {'searchTerms': search_terms(product)}})
+             for product in cursor]
+
+    if len(batch) > 0:
+        products.bulk_write(batch, ordered=False)
+
+
+def create_search_index(db, batch_size=500):
+
+    products = db['Products']
+
+    products.create_index([('searchTerms', ASCENDING)], name='search_terms')
+
+    # Backfill the terms of the products that were created
+    # before the search index existed, in batches
+
+    batch = []
+    cursor = products.find({'searchTerms': {'$exists': False}},
+                           {'name': 1, 'category': 1, 'description': 1})
+
+    for product in cursor:
+        batch.append(UpdateOne({'_id': product['_id']},
+                               {'$set': {'searchTerms': search_terms(product)}}))
+
+        if len(batch) == batch_size:
+            products.bulk_write(batch, ordered=False)
+            batch = []
+
+    if len(batch) > 0:
+        products.bulk_write(batch, ordered=False)
@@ -0,0 +1,170 @@
+# Cache of product-search responses.
+#
+# Most searches are the same few queries (the categories, mostly), so the
+# body of a search response is kept, under the normalized query (see
+# search_key), in an in-process cache of up to SEARCH_CACHE_SIZE responses
+# (the least recently used is evicted first). Responses larger than
+# SEARCH_CACHE_MAX_BODY bytes are not kept.
+#
+# Every response is stored with the generation of the catalog it was made
+# from. The generation is a counter in the 'Meta' collection, incremented
+# (bump) every time a product is created, updated or deleted, by any
+# process; a search first reads the current generation (a single read by
+# _id), and only uses a cached response of that generation. So a change of
+# the catalog made by one worker is seen at once by the caches of all the
+# others, and a stale response is never returned.
+#
+# The stock of the products is not part of a search response, so the
+# purchases of checkout do not change the generation.
+#
+# SEARCH_CACHE_SIZE=0 disables the cache.
+
+from collections import OrderedDict
+
+import os
+import threading
+
+import search
+
+
+SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE', 256))
+SEARCH_CACHE_MAX_BODY = int(os.environ.get('SEARCH_CACHE_MAX_BODY', 256 * 1024))  # bytes
+
+# The document of the 'Meta' collection that holds the catalog generation
+CATALOG_GENERATION = {'_id': 'catalog'}
+BUMP_GENERATION = {'$inc': {'generation': 1}}
+
+
+def bump_generation(meta):
+
+    # To be called after any change of the products' name, category,
+    # description or price (meta is the 'Meta' collection)
+    meta.update_one(CATALOG_GENERATION, BUMP_GENERATION, upsert=True)
+
+
+def read_generation(meta):
+
+    document = meta.find_one(CATALOG_GENERATION, {'generation': 1})
+
+    if document == None:
+        return 0
+
+    return document['generation']
+
+
+def search_key(data):
+
+    # The key of a (valid) product-search body, or None if it should not be
+    # cached. Queries that make the same database query have the same key:
+    # names and categories are matched in lowercase, words in any order.
+
+    if '_id' in data:
+        query = ('_id', data['_id'])
+    elif 'name' in data:
+        query = ('name', data['name'])
+    elif 'category' in data:
+        query = ('category', data['category'])
+    else:
+        query = ('text', data['text'])
+
+    if not isinstance(query[1], str):
+        return None
+
+    if query[0] in ('name', 'category'):
+        query = (query[0], query[1].lower())
+    elif query[0] == 'text':
+        query = ('text', ' '.join(sorted(search.words(query[1]))))
+
+    return query + (data.get('limit'), data.get('after'))
+
+
+class SearchCache:
+
+    def __init__(self, meta, max_entries=SEARCH_CACHE_SIZE, max_body=SEARCH_CACHE_MAX_BODY):
+        self.meta = meta
+        self.max_entries = max_entries
+        self.max_body = max_body
+
+        # key -> (generation, status, body, next_cursor),
+        # ordered from the least to the most recently used response
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0  # misses because the catalog has changed
+        self.evictions = 0
+
+    def enabled(self):
+        return self.max_entries > 0
+
+    def generation(self):
+        return read_generation(self.meta)
+
+    def bump(self):
+        bump_generation(self.meta)
+
+    # Returns (status, body, next_cursor) of the response cached under key
+    # for this generation of the catalog, or None
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry == None:
+                self.misses += 1
+                return None
+
+            if entry[0] != generation:
+                del self.entries[key]
+                self.misses += 1
+                self.stale += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1:]
+
+    def put(self, key, generation, status, body=None, next_cursor=None):
+
+        if body != None and len(body) > self.max_body:
+            return
+
+        with self.lock:
+            self.entries[key] = (generation, status, body, next_cursor)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def caching(self, key, generation, pieces):
+
+        # Passes the pieces of a streamed response through, and caches
+        # the whole body once it is complete (unless it is too large)
+
+        kept = []
+        size = 0
+
+        for piece in pieces:
+            if kept != None:
+                size += len(piece)
+                if size > self.max_body:
+                    kept = None
+                else:
+                    kept.append(piece)
+
+            yield piece
+
+        if kept != None:
+            self.put(key, generation, 200, ''.join(kept))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'evictions': self.evictions
+            }
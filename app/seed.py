@@ -0,0 +1,153 @@
+# Seeding of the Users collection.
+#
+# Loads accounts into Users from files, either a JSON array (.json, in
+# MongoDB extended JSON, like admin.json) or NDJSON (one account per line):
+#
+#   - a customer is an object like the body of signup (name, email,
+#     password, ssn), and is stored as signup stores it
+#   - an administrator has "category": "administrator", a username and
+#     a password, and is stored as it is (e.g. with a fixed _id)
+#
+# The accounts are inserted in batches of SEED_BATCH_SIZE, one
+# insert_many(ordered=False) per batch. An account whose email, ssn or
+# username is already taken is rejected by the unique indexes of Users (see
+# indexes.py), without stopping the rest of the batch, so seeding the same
+# files again only reports them as conflicts. The pending index migrations
+# are applied first, so that the unique indexes exist.
+#
+#     python3 seed.py admin.json customers.ndjson
+#
+# prints the result of every file, like catalog_io.py
+# ('line' is the position of the account in a JSON array):
+#
+#     {"applied": 9998, "errors": [{"line": 17, "error": "Conflict"}]}
+#
+# The 'seed' service of docker-compose.yml runs it with seed/admin.json.
+
+from pymongo.errors import BulkWriteError
+
+from bson import json_util
+
+import sys
+
+from serialization import dumps
+from common import mongo_client
+
+import catalog_io
+import indexes
+import validation
+
+
+SEED_BATCH_SIZE = 1000
+
+
+def is_account_valid(data):
+
+    if type(data) is not dict:
+        return False
+
+    if data.get('category') == 'administrator':
+        return isinstance(data.get('username'), str) and 'password' in data
+
+    return validation.SIGNUP(data)
+
+
+def new_user(data):
+
+    # The user document of a (valid) account
+    if data.get('category') == 'administrator':
+        return dict(data)
+
+    return {
+        'ssn': data['ssn'],
+        'name': data['name'],
+        'email': data['email'],
+        'password': data['password'],
+        'category': 'user'
+    }
+
+
+def parse_array(file, result):
+
+    # Yields (position, account) of every valid account of a JSON array
+
+    try:
+        accounts = json_util.loads(file.read())
+    except Exception:
+        result.error(1, 400)
+        return
+
+    if not isinstance(accounts, list):
+        result.error(1, 422)
+        return
+
+    for number, data in enumerate(accounts, 1):
+        if not is_account_valid(data):
+            result.error(number, 422)
+            continue
+
+        yield number, data
+
+
+def seed_users(users, accounts, result, batch_size=SEED_BATCH_SIZE):
+
+    # Inserts the (number, data) accounts, recording the rejected ones in result
+
+    for batch in catalog_io.batches(accounts, batch_size):
+        numbers = [number for number, data in batch]
+        documents = [new_user(data) for number, data in batch]
+
+        failed = set()
+
+        try:
+            users.insert_many(documents, ordered=False)
+        except BulkWriteError as error:
+            failed = catalog_io.write_errors(error, numbers, result)
+
+        result.applied += len(documents) - len(failed)
+
+    return result.as_dict()
+
+
+def seed_file(users, path, batch_size=SEED_BATCH_SIZE):
+
+    result = catalog_io.ImportResult()
+
+    with open(path, 'rb') as file:
+        if path.endswith('.json'):
+            accounts = parse_array(file, result)
+        else:
+            accounts = catalog_io.parse_lines(file, is_account_valid, result)
+
+        return seed_users(users, accounts, result, batch_size)
+
+
+# Command Line Interface ...
+
+def main(argv):
+
+    if len(argv) < 2:
+        print('usage: python3 seed.py file.json|file.ndjson ...')
+        return 2
+
+    client = mongo_client()
+    db = client['DSPharmacy']
+
+    indexes.migrate(db)
+
+    status = 0
+
+    for path in argv[1:]:
+        result = seed_file(db['Users'], path)
+
+        print(path, dumps(result))
+
+        # (accounts already present are expected when seeding again)
+        if any(error['error'] != 'Conflict' for error in result['errors']):
+            status = 1
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
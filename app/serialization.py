@@ -0,0 +1,97 @@
+# JSON encoding and decoding of requests and responses.
+#
+# JSON_BACKEND chooses the codec:
+#
+#   - 'auto' (default): request bodies are decoded with orjson when it is
+#     installed (pip install orjson), which parses several times faster
+#     than the json module; responses are encoded with the json module,
+#     so they stay byte for byte the same.
+#   - 'json': the json module only.
+#   - 'orjson': orjson for the responses too. It is the fastest, but its
+#     output is compact ('{"a":1}' instead of '{"a": 1}') and UTF-8 instead
+#     of \u escapes, so the bytes of the responses change (not their value).
+#
+# The bodies of the constant responses ('OK', 'Unauthorized', ...)
+# are encoded once, in STATUS_BODIES.
+
+import json
+import os
+
+
+JSON_BACKEND = os.environ.get('JSON_BACKEND', 'auto')  # 'auto', 'json' or 'orjson'
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if JSON_BACKEND not in ('auto', 'json', 'orjson'):
+    raise ValueError('Unknown JSON_BACKEND: ' + JSON_BACKEND)
+
+if JSON_BACKEND == 'orjson' and orjson == None:
+    raise ValueError('JSON_BACKEND is orjson, but orjson is not installed')
+
+
+# Decoding ...
+
+def json_loads(data):
+    return json.loads(data)
+
+
+def orjson_loads(data):
+
+    # orjson rejects a few inputs that the json module accepts
+    # (NaN and Infinity, integers of more than 64 bits): those
+    # are decoded again by the json module, to keep its behaviour
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+
+if orjson != None and JSON_BACKEND != 'json':
+    loads = orjson_loads
+else:
+    loads = json_loads
+
+
+# Encoding ...
+
+def orjson_dumps(value):
+    return orjson.dumps(value).decode()
+
+
+if JSON_BACKEND == 'orjson':
+    dumps = orjson_dumps
+    ITEM_SEPARATOR = ','
+else:
+    # (the encoder that json.dumps() uses with its default arguments)
+    dumps = json.JSONEncoder().encode
+    ITEM_SEPARATOR = ', '
+
+
+def dumps_items(items):
+
+    # The items of a list, encoded like in dumps(items) but without the
+    # brackets, so that a long array can be encoded a batch of items at
+    # a time: '[' + dumps_items(a) + ITEM_SEPARATOR + dumps_items(b) + ']'
+    # is dumps(a + b)
+    return dumps(items)[1:-1]
+
+
+# Constant Responses ...
+
+STATUS_TEXTS = {
+    200: 'OK',
+    400: 'Bad Request',
+    401: 'Unauthorized',
+    403: 'Forbidden',
+    404: 'Not Found',
+    409: 'Conflict',
+    422: 'Unprocessable Entity',
+    429: 'Too Many Requests',
+    500: 'Internal Server Error',
+    503: 'Service Unavailable'
+}
+
+STATUS_BODIES = {status: text.encode() for status, text in STATUS_TEXTS.items()}
@@ -0,0 +1,342 @@
+# Session stores.
+#
+# A session store keeps the content of each session (the dictionary made
+# by generate_session) under its session id, together with the handle
+# (email or username) of the session's owner and the time it expires.
+#
+# Sessions expire after SESSION_TTL seconds of inactivity: every time a
+# session is used its expiry is moved forward (sliding expiry).
+#
+# There are two stores:
+#
+#   - MemorySessionStore: sessions are kept in the memory of the process,
+#     with a bounded number of sessions (the least recently used session
+#     is evicted first) and a background thread removing expired sessions.
+#
+#   - MongoSessionStore: sessions are kept in the 'Sessions' collection,
+#     so they are shared by all the processes of the web service.
+#     Expired sessions are removed by MongoDB itself, with a TTL index.
+#
+# SESSION_BACKEND=memory|mongo chooses the store used by the web service.
+#
+# The ASGI application (asgi.py) uses the same stores through the
+# coroutine interface of AsyncSessionStore; its MongoDB store keeps
+# the sessions in the same format, so both applications share them.
+
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING
+
+import os
+import threading
+import time
+
+
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory')
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 3600))  # seconds
+SESSION_MAX_ENTRIES = int(os.environ.get('SESSION_MAX_ENTRIES', 100000))
+SESSION_SWEEP_INTERVAL = int(os.environ.get('SESSION_SWEEP_INTERVAL', 60))  # seconds
+
+
+class SessionStore:
+
+    def create(self, session_id, content, handle):
+        raise NotImplementedError
+
+    # Returns the content of the session (and extends its expiry),
+    # or None if there is no such session or it has expired
+    def get(self, session_id):
+        raise NotImplementedError
+
+    # Stores the content of a session again, after it has been changed
+    def save(self, session_id, content):
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    # Deletes all the sessions of a user
+    def revoke(self, handle):
+        raise NotImplementedError
+
+    # Removes the expired sessions
+    def sweep(self):
+        pass
+
+    def start_sweeper(self, interval=SESSION_SWEEP_INTERVAL):
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+
+        sweeper = threading.Thread(target=run, name='session-sweeper', daemon=True)
+        sweeper.start()
+
+        return sweeper
+
+
+# In-Process Store ...
+
+class MemorySessionStore(SessionStore):
+
+    def __init__(self, ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        # session_id -> [content, handle, expires],
+        # ordered from the least to the most recently used session
+        self.sessions = OrderedDict()
+
+        # handle -> set of session_ids, to revoke all sessions of a user at once
+        self.handles = {}
+
+        self.lock = threading.Lock()
+
+    def create(self, session_id, content, handle):
+        with self.lock:
+            self.sessions[session_id] = [content, handle, time.time() + self.ttl]
+            self.handles.setdefault(handle, set()).add(session_id)
+
+            while len(self.sessions) > self.max_entries:
+                self._remove(next(iter(self.sessions)))
+
+    def get(self, session_id):
+        with self.lock:
+            entry = self.sessions.get(session_id)
+
+            if entry == None:
+                return None
+
+            now = time.time()
+
+            if entry[2] <= now:
+                self._remove(session_id)
+                return None
+
+            entry[2] = now + self.ttl
+            self.sessions.move_to_end(session_id)
+
+            return entry[0]
+
+    def save(self, session_id, content):
+        # The content returned by get() is the stored dictionary itself,
+        # so its changes are already in the store
+        pass
+
+    def delete(self, session_id):
+        with self.lock:
+            if session_id in self.sessions:
+                self._remove(session_id)
+
+    def revoke(self, handle):
+        with self.lock:
+            for session_id in list(self.handles.get(handle, ())):
+                self._remove(session_id)
+
+    def sweep(self):
+        now = time.time()
+
+        with self.lock:
+            expired = [session_id
+                       for session_id, entry in self.sessions.items()
+                       if entry[2] <= now]
+
+            for session_id in expired:
+                self._remove(session_id)
+
+    def _remove(self, session_id):
+        handle = self.sessions.pop(session_id)[1]
+
+        owned = self.handles.get(handle)
+        owned.discard(session_id)
+        if len(owned) == 0:
+            del self.handles[handle]
+
+
+# Shared (MongoDB) Store ...
+
+class MongoSessionStore(SessionStore):
+
+    def __init__(self, collection, ttl=SESSION_TTL):
+        self.collection = collection
+        self.ttl = timedelta(seconds=ttl)
+
+        # The expiry is only moved forward once this much of the TTL has
+        # passed, so that not every request has to write to the database
+        self.refresh = self.ttl / 10
+
+    def create(self, session_id, content, handle):
+        self.collection.insert_one({
+            '_id': session_id,
+            'handle': handle,
+            'content': content,
+            'expiresAt': utcnow() + self.ttl
+        })
+
+    def get(self, session_id):
+        now = utcnow()
+
+        session = self.collection.find_one({'_id': session_id,
+                                            'expiresAt': {'$gt': now}})
+
+        if session == None:
+            return None
+
+        # (MongoDB returns naive datetimes, in UTC)
+        expires = session['expiresAt'].replace(tzinfo=timezone.utc)
+
+        if expires - now < self.ttl - self.refresh:
+            self.collection.update_one({'_id': session_id},
+                                       {'$set': {'expiresAt': now + self.ttl}})
+
+        return session['content']
+
+    def save(self, session_id, content):
+        self.collection.update_one({'_id': session_id},
+                                   {'$set': {'content': content}})
+
+    def delete(self, session_id):
+        self.collection.delete_one({'_id': session_id})
+
+    def revoke(self, handle):
+        self.collection.delete_many({'handle': handle})
+
+    # (no sweep: expired sessions are removed by the TTL index,
+    #  and get() ignores the ones that have not been removed yet)
+
+
+# Asynchronous Stores (for asgi.py) ...
+
+class AsyncSessionStore:
+
+    # Same methods as SessionStore, as coroutines
+
+    async def create(self, session_id, content, handle):
+        raise NotImplementedError
+
+    async def get(self, session_id):
+        raise NotImplementedError
+
+    async def save(self, session_id, content):
+        raise NotImplementedError
+
+    async def delete(self, session_id):
+        raise NotImplementedError
+
+    async def revoke(self, handle):
+        raise NotImplementedError
+
+
+class AsyncMemorySessionStore(AsyncSessionStore):
+
+    # The in-process store never waits on I/O,
+    # so its methods are simply called from the coroutines
+
+    def __init__(self, store):
+        self.store = store
+
+    async def create(self, session_id, content, handle):
+        self.store.create(session_id, content, handle)
+
+    async def get(self, session_id):
+        return self.store.get(session_id)
+
+    async def save(self, session_id, content):
+        self.store.save(session_id, content)
+
+    async def delete(self, session_id):
+        self.store.delete(session_id)
+
+    async def revoke(self, handle):
+        self.store.revoke(handle)
+
+
+class AsyncMongoSessionStore(AsyncSessionStore):
+
+    # MongoSessionStore, on an asynchronous collection (pymongo.AsyncMongoClient)
+
+    def __init__(self, collection, ttl=SESSION_TTL):
+        self.collection = collection
+        self.ttl = timedelta(seconds=ttl)
+        self.refresh = self.ttl / 10
+
+    async def create(self, session_id, content, handle):
+        await self.collection.insert_one({
+            '_id': session_id,
+            'handle': handle,
+            'content': content,
+            'expiresAt': utcnow() + self.ttl
+        })
+
+    async def get(self, session_id):
+        now = utcnow()
+
+        session = await self.collection.find_one({'_id': session_id,
+                                                  'expiresAt': {'$gt': now}})
+
+        if session == None:
+            return None
+
+        expires = session['expiresAt'].replace(tzinfo=timezone.utc)
+
+        if expires - now < self.ttl - self.refresh:
+            await self.collection.update_one({'_id': session_id},
+                                             {'$set': {'expiresAt': now + self.ttl}})
+
+        return session['content']
+
+    async def save(self, session_id, content):
+        await self.collection.update_one({'_id': session_id},
+                                         {'$set': {'content': content}})
+
+    async def delete(self, session_id):
+        await self.collection.delete_one({'_id': session_id})
+
+    async def revoke(self, handle):
+        await self.collection.delete_many({'handle': handle})
+
+
+def utcnow():
+    return datetime.now(timezone.utc)
+
+
+def create_session_indexes(db):
+
+    sessions = db['Sessions']
+
+    # MongoDB removes a session once its expiresAt has passed
+    sessions.create_index([('expiresAt', ASCENDING)],
+                          name='expires_ttl', expireAfterSeconds=0)
+
+    # To revoke all the sessions of a user
+    sessions.create_index([('handle', ASCENDING)], name='handle')
+
+
+def create_store(db, backend=SESSION_BACKEND):
+
+    if backend == 'mongo':
+        return MongoSessionStore(db['Sessions'])
+
+    if backend == 'memory':
+        store = MemorySessionStore()
+        store.start_sweeper()
+        return store
+
+    raise ValueError('Unknown SESSION_BACKEND: ' + backend)
+
+
+def create_async_store(db, backend=SESSION_BACKEND):
+
+    # db is a database of a pymongo.AsyncMongoClient
+
+    if backend == 'mongo':
+        return AsyncMongoSessionStore(db['Sessions'])
+
+    if backend == 'memory':
+        store = MemorySessionStore()
+        store.start_sweeper()
+        return AsyncMemorySessionStore(store)
+
+    raise ValueError('Unknown SESSION_BACKEND: ' + backend)
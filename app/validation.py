@@ -0,0 +1,137 @@
+# Request body schemas.
+#
+# The body of a request is described by a schema: a dictionary from each of
+# its fields to a Field (is the field required, what types may its value
+# have, its minimum value, and any other check of the value).
+#
+# compile_schema() turns a schema into a validator function, once, when this
+# module is imported: the checks of every field are written out as the source
+# of a single function, so validating a body costs no more than the chains
+# of "'x' not in data or not isinstance(...)" they replace.
+#
+# A validator returns True if the (decoded JSON) body satisfies the schema.
+
+from common import is_ssn_valid, is_credit_valid
+
+
+class Field:
+
+    def __init__(self, required=True, types=None, minimum=None, check=None):
+        self.required = required
+        self.types = types      # the value must be an instance of these types
+        self.minimum = minimum  # the value must not be less than this
+        self.check = check      # check(value) must be true
+
+
+def compile_schema(name, schema):
+
+    function_name = 'validate_' + name.replace('-', '_')
+
+    lines = ['def %s(data):' % function_name,
+             '    if type(data) is not dict:',
+             '        return False']
+
+    # The types and checks are given to the function as globals
+    namespace = {}
+
+    for index, (key, field) in enumerate(schema.items()):
+
+        conditions = []
+
+        if field.types != None:
+            namespace['types_%d' % index] = field.types
+            conditions.append('not isinstance(value, types_%d)' % index)
+
+        if field.minimum != None:
+            conditions.append('value < %r' % field.minimum)
+
+        if field.check != None:
+            namespace['check_%d' % index] = field.check
+            conditions.append('not check_%d(value)' % index)
+
+        if field.required:
+            lines.append('    if %r not in data:' % key)
+            lines.append('        return False')
+            indent = '    '
+        elif len(conditions) > 0:
+            lines.append('    if %r in data:' % key)
+            indent = '        '
+        else:
+            continue
+
+        if len(conditions) > 0:
+            lines.append(indent + 'value = data[%r]' % key)
+            lines.append(indent + 'if ' + ' or '.join(conditions) + ':')
+            lines.append(indent + '    return False')
+
+    lines.append('    return True')
+
+    source = '\n'.join(lines) + '\n'
+
+    exec(compile(source, '<schema %s>' % name, 'exec'), namespace)
+
+    validator = namespace[function_name]
+    validator.source = source
+
+    return validator
+
+
+# Schemas ...
+
+SIGNUP = compile_schema('signup', {
+    'name': Field(),
+    'email': Field(),
+    'password': Field(),
+    'ssn': Field(check=is_ssn_valid)
+})
+
+CREATE_PRODUCT = compile_schema('create-product', {
+    'name': Field(types=str),
+    'category': Field(types=str),
+    'description': Field(),
+    'stock': Field(types=int, minimum=0),
+    'price': Field(types=(int, float), minimum=0.0)
+})
+
+UPDATE_PRODUCT = compile_schema('update-product', {
+    '_id': Field(),
+    'stock': Field(required=False, types=int, minimum=0),
+    'price': Field(required=False, types=(int, float), minimum=0)
+})
+
+DELETE_PRODUCT = compile_schema('delete-product', {
+    '_id': Field()
+})
+
+ADD_TO_CART = compile_schema('add-to-cart', {
+    '_id': Field(),
+    'quantity': Field(types=int, minimum=1)
+})
+
+# update-cart: each list holds at most MAX_CART_CHANGES changes
+MAX_CART_CHANGES = 100
+
+
+def is_change_list_valid(changes):
+    return len(changes) <= MAX_CART_CHANGES
+
+
+UPDATE_CART = compile_schema('update-cart', {
+    'remove': Field(required=False, types=list, check=is_change_list_valid),
+    'set': Field(required=False, types=list, check=is_change_list_valid),
+    'add': Field(required=False, types=list, check=is_change_list_valid)
+})
+
+SET_CART_QUANTITY = compile_schema('set-cart-quantity', {
+    '_id': Field(types=str),
+    'quantity': Field(types=int, minimum=0)
+})
+
+ADD_CART_QUANTITY = compile_schema('add-cart-quantity', {
+    '_id': Field(types=str),
+    'quantity': Field(types=int, minimum=1)
+})
+
+CHECKOUT = compile_schema('checkout', {
+    'credit': Field(check=is_credit_valid)
+})
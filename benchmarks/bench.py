@@ -0,0 +1,587 @@
+# Endpoint benchmarks for the Digital Pharmacy web service.
+#
+# Seeds a database with N users and M products, then drives a weighted mix
+# of requests (signup, login, product-search, add-to-cart, view-cart and
+# checkout) through the web service, from several concurrent clients,
+# and reports the throughput and the p50/p95/p99 latency of each route.
+#
+# Everything runs on one machine, without network access:
+#
+#   --mongo mongomock   an in-memory stand-in for MongoDB (pip install mongomock)
+#   --mongo spawn       a throw-away mongod (must be on the PATH), in a temporary directory
+#   --mongo external    the MongoDB of MONGO_HOSTNAME / MONGO_PORT (its DSPharmacy
+#                       database is dropped first, so --drop-database must confirm it)
+#
+#   --target client     requests go through the Flask test client (no HTTP at all)
+#   --target http       requests go over HTTP, to the application served in this
+#                       process (--app wsgi|asgi) or to a running server (--url,
+#                       with --mongo external: the MongoDB of the server is seeded)
+#
+# Results can be saved as JSON (--output) and compared with a previous run (--baseline):
+#
+#     python3 benchmarks/bench.py --output before.json
+#     ... change something ...
+#     python3 benchmarks/bench.py --baseline before.json
+
+import argparse
+import atexit
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+CATEGORIES = ['vitamin', 'analgesic', 'antibiotic', 'antiseptic', 'cosmetic', 'supplement']
+WORDS = ['aspirin', 'depon', 'zinc', 'magnesium', 'iron', 'calcium', 'omega',
+         'paracetamol', 'ibuprofen', 'amoxicillin', 'betadine', 'cream', 'spray']
+
+DEFAULT_MIX = 'search=40,add-to-cart=25,view-cart=10,login=10,checkout=10,signup=5'
+
+CREDIT = 1234567812345678
+PASSWORD = 'bench'
+
+
+# Database ...
+
+def use_mongomock():
+
+    # mongomock implements the pymongo API in memory, except for the
+    # bulk_write of current pymongo versions, which is emulated here
+    # with the single-document operations.
+    # (mongomock also modifies the projection of find() while it is
+    # being used, which breaks projections shared by concurrent requests,
+    # so it is given a copy of the projection instead)
+
+    import mongomock
+    import pymongo
+    from pymongo import UpdateOne, InsertOne, DeleteOne
+    from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+    class BulkWriteResult:
+        def __init__(self, upserted_ids):
+            self.upserted_ids = upserted_ids
+            self.acknowledged = True
+
+    def bulk_write(collection, requests, ordered=True, **kwargs):
+        write_errors = []
+        upserted = []
+
+        for index, operation in enumerate(requests):
+            try:
+                if isinstance(operation, InsertOne):
+                    collection.insert_one(operation._doc)
+                elif isinstance(operation, UpdateOne):
+                    result = collection.update_one(operation._filter, operation._doc,
+                                                   upsert=operation._upsert)
+                    if result.upserted_id != None:
+                        upserted.append({'index': index, '_id': result.upserted_id})
+                elif isinstance(operation, DeleteOne):
+                    collection.delete_one(operation._filter)
+                else:
+                    raise NotImplementedError(type(operation).__name__)
+            except DuplicateKeyError as error:
+                write_errors.append({'index': index, 'code': 11000, 'errmsg': str(error)})
+                if ordered:
+                    break
+
+        if len(write_errors) > 0:
+            raise BulkWriteError({'writeErrors': write_errors, 'upserted': upserted,
+                                  'writeConcernErrors': []})
+
+        return BulkWriteResult({upsert['index']: upsert['_id'] for upsert in upserted})
+
+    copy_only_fields = mongomock.collection.Collection._copy_only_fields
+
+    def copy_only_fields_of_copy(collection, document, fields, container):
+        if isinstance(fields, dict):
+            fields = dict(fields)
+        return copy_only_fields(collection, document, fields, container)
+
+    mongomock.collection.Collection.bulk_write = bulk_write
+    mongomock.collection.Collection._copy_only_fields = copy_only_fields_of_copy
+    pymongo.MongoClient = mongomock.MongoClient
+
+
+def free_port():
+    with socket.socket() as listener:
+        listener.bind(('127.0.0.1', 0))
+        return listener.getsockname()[1]
+
+
+def spawn_mongod():
+
+    mongod = shutil.which('mongod')
+    if mongod == None:
+        sys.exit('--mongo spawn: mongod was not found on the PATH')
+
+    directory = tempfile.mkdtemp(prefix='bench-mongod-')
+    port = free_port()
+
+    process = subprocess.Popen([mongod, '--dbpath', directory, '--port', str(port),
+                                '--bind_ip', '127.0.0.1', '--quiet'],
+                               stdout=subprocess.DEVNULL)
+
+    def stop():
+        process.terminate()
+        process.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    atexit.register(stop)
+
+    # Wait until mongod accepts connections
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    else:
+        sys.exit('--mongo spawn: mongod did not start')
+
+    os.environ['MONGO_HOSTNAME'] = '127.0.0.1'
+    os.environ['MONGO_PORT'] = str(port)
+
+
+def ssn_of(number):
+    # A valid, unique SSN (DDMMYYNNNNN) for each number,
+    # born on the 10th of January of a year between 1950 and 1999
+    return int('1001%02d%05d' % (50 + number // 100000 % 50, number % 100000))
+
+
+def seed(db, user_count, product_count, rng):
+
+    # The users and products are written directly to the database,
+    # in batches, instead of through the endpoints
+
+    import search
+
+    batch = []
+    for number in range(user_count):
+        batch.append({
+            'ssn': ssn_of(number),
+            'name': 'user %d' % number,
+            'email': 'user%d@bench' % number,
+            'password': PASSWORD,
+            'category': 'user'
+        })
+        if len(batch) == 1000:
+            db['Users'].insert_many(batch)
+            batch = []
+    if len(batch) > 0:
+        db['Users'].insert_many(batch)
+
+    product_ids = []
+
+    batch = []
+    for number in range(product_count):
+        product = {
+            'name': '%s %d' % (rng.choice(WORDS), number),
+            'category': rng.choice(CATEGORIES),
+            'price': round(rng.uniform(1, 50), 2),
+            'stock': 10 ** 9,
+            'description': '%s for %s' % (rng.choice(WORDS), rng.choice(WORDS))
+        }
+        product['searchTerms'] = search.search_terms(product)
+        batch.append(product)
+        if len(batch) == 1000:
+            product_ids.extend(db['Products'].insert_many(batch).inserted_ids)
+            batch = []
+    if len(batch) > 0:
+        product_ids.extend(db['Products'].insert_many(batch).inserted_ids)
+
+    return [str(product_id) for product_id in product_ids]
+
+
+# Transports ...
+
+class ClientTransport:
+
+    # Requests through the Flask test client, one client per thread
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, body, auth):
+        headers = {'Authorization': auth} if auth else {}
+        response = self.client.open(path, method=method, headers=headers,
+                                    data=json.dumps(body) if body != None else b'')
+        return response.status_code, response.get_data()
+
+
+class HttpTransport:
+
+    # Requests over a keep-alive HTTP connection, one connection per thread
+
+    def __init__(self, host, port):
+        self.connection = http.client.HTTPConnection(host, port)
+
+    def request(self, method, path, body, auth):
+        headers = {'Content-Type': 'application/json'}
+        if auth:
+            headers['Authorization'] = auth
+        self.connection.request(method, path,
+                                body=json.dumps(body) if body != None else b'',
+                                headers=headers)
+        response = self.connection.getresponse()
+        return response.status, response.read()
+
+
+def serve_wsgi(app):
+    from werkzeug.serving import make_server
+    import logging
+
+    # (no access log line for every request)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return '127.0.0.1', server.server_port
+
+
+def serve_asgi(app):
+    import uvicorn
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port,
+                                           log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    return '127.0.0.1', port
+
+
+# Workload ...
+
+class Workload:
+
+    def __init__(self, user_count, product_ids, rng):
+        self.user_count = user_count
+        self.product_ids = product_ids
+        self.rng = rng
+
+        self.signups = 0
+        self.lock = threading.Lock()
+
+    def next_signup(self):
+        with self.lock:
+            self.signups += 1
+            return self.user_count + self.signups
+
+    # Each operation returns (route, method, path, body)
+
+    def signup(self, auth):
+        number = self.next_signup()
+        return ('signup', 'POST', '/signup', {
+            'name': 'user %d' % number,
+            'email': 'user%d@bench' % number,
+            'password': PASSWORD,
+            'ssn': ssn_of(number)
+        })
+
+    def login(self, auth):
+        number = self.rng.randrange(self.user_count)
+        return ('login', 'POST', '/login',
+                {'email': 'user%d@bench' % number, 'password': PASSWORD})
+
+    def search(self, auth):
+        if self.rng.random() < 0.5:
+            body = {'category': self.rng.choice(CATEGORIES)}
+        else:
+            body = {'name': self.rng.choice(WORDS)[:4]}
+        return ('product-search', 'POST', '/product-search', body)
+
+    def add_to_cart(self, auth):
+        return ('add-to-cart', 'POST', '/user/add-to-cart',
+                {'_id': self.rng.choice(self.product_ids), 'quantity': 1})
+
+    def view_cart(self, auth):
+        return ('view-cart', 'POST', '/user/view-cart', None)
+
+    def checkout(self, auth):
+        return ('checkout', 'POST', '/user/checkout', {'credit': CREDIT})
+
+
+OPERATIONS = {
+    'signup': Workload.signup,
+    'login': Workload.login,
+    'search': Workload.search,
+    'add-to-cart': Workload.add_to_cart,
+    'view-cart': Workload.view_cart,
+    'checkout': Workload.checkout
+}
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            sys.exit('Unknown operation in --mix: ' + name)
+        weights[name] = float(weight)
+    return weights
+
+
+def run(transport_factory, workload, weights, request_count, concurrency, seed_value):
+
+    names = list(weights)
+    name_weights = [weights[name] for name in names]
+
+    latencies = {}   # route -> [seconds]
+    statuses = {}    # route -> {status: count}
+    errors = []
+
+    remaining = [request_count]
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed_value * 1000 + index)
+        transport = transport_factory()
+
+        # Every client logs in as its own user first (not measured)
+        status, body = transport.request('POST', '/login', {
+            'email': 'user%d@bench' % (index % workload.user_count),
+            'password': PASSWORD
+        }, None)
+        auth = json.loads(body)['Authorization']
+
+        measured = {}
+        counted = {}
+
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    break
+                remaining[0] -= 1
+
+            name = rng.choices(names, name_weights)[0]
+            route, method, path, body = OPERATIONS[name](workload, auth)
+
+            # (signup and login are made as a guest)
+            if route in ('signup', 'login'):
+                headers_auth = None
+            else:
+                headers_auth = auth
+
+            start = time.perf_counter()
+            try:
+                status, _ = transport.request(method, path, body, headers_auth)
+            except Exception as error:
+                status = 'error'
+                errors.append(repr(error))
+            elapsed = time.perf_counter() - start
+
+            measured.setdefault(route, []).append(elapsed)
+            counted.setdefault(route, {})
+            counted[route][status] = counted[route].get(status, 0) + 1
+
+        with lock:
+            for route, values in measured.items():
+                latencies.setdefault(route, []).extend(values)
+            for route, counts in counted.items():
+                for status, count in counts.items():
+                    statuses.setdefault(route, {})
+                    statuses[route][status] = statuses[route].get(status, 0) + count
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return latencies, statuses, errors, elapsed
+
+
+# Report ...
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of sorted values
+    index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies, statuses, elapsed):
+
+    routes = {}
+
+    for route in sorted(latencies):
+        values = sorted(latencies[route])
+        routes[route] = {
+            'count': len(values),
+            'throughput': len(values) / elapsed,
+            'mean_ms': 1000 * sum(values) / len(values),
+            'p50_ms': 1000 * percentile(values, 0.50),
+            'p95_ms': 1000 * percentile(values, 0.95),
+            'p99_ms': 1000 * percentile(values, 0.99),
+            'statuses': {str(status): count for status, count in statuses[route].items()}
+        }
+
+    total = sum(route['count'] for route in routes.values())
+
+    return {
+        'elapsed_s': elapsed,
+        'requests': total,
+        'throughput': total / elapsed,
+        'routes': routes
+    }
+
+
+def change(new, old):
+    if old == 0:
+        return ''
+    return '%+.1f%%' % (100.0 * (new - old) / old)
+
+
+def print_report(summary, baseline=None):
+
+    header = '%-16s %8s %10s %9s %9s %9s %9s  %s' % (
+        'route', 'count', 'req/s', 'mean ms', 'p50 ms', 'p95 ms', 'p99 ms', 'statuses')
+    print(header)
+    print('-' * len(header))
+
+    for route, stats in summary['routes'].items():
+        print('%-16s %8d %10.1f %9.2f %9.2f %9.2f %9.2f  %s' % (
+            route, stats['count'], stats['throughput'], stats['mean_ms'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            ' '.join('%s:%d' % item for item in sorted(stats['statuses'].items()))))
+
+        if baseline != None and route in baseline['routes']:
+            old = baseline['routes'][route]
+            print('%-16s %8s %10s %9s %9s %9s %9s' % (
+                '  vs baseline', '',
+                change(stats['throughput'], old['throughput']),
+                change(stats['mean_ms'], old['mean_ms']),
+                change(stats['p50_ms'], old['p50_ms']),
+                change(stats['p95_ms'], old['p95_ms']),
+                change(stats['p99_ms'], old['p99_ms'])))
+
+    print()
+    print('%d requests in %.2f s: %.1f req/s' % (
+        summary['requests'], summary['elapsed_s'], summary['throughput']), end='')
+
+    if baseline != None:
+        print(' (%s vs baseline)' % change(summary['throughput'], baseline['throughput']), end='')
+
+    print()
+
+
+# Main ...
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Endpoint benchmarks for the Digital Pharmacy web service.')
+    parser.add_argument('--mongo', choices=['mongomock', 'spawn', 'external'], default='mongomock')
+    parser.add_argument('--target', choices=['client', 'http'], default='client')
+    parser.add_argument('--app', choices=['wsgi', 'asgi'], default='wsgi',
+                        help='application served for --target http')
+    parser.add_argument('--url', help='benchmark a running server instead (--target http), '
+                                      'whose MongoDB is given by --mongo external')
+    parser.add_argument('--drop-database', action='store_true',
+                        help='confirm that the DSPharmacy database of --mongo external is dropped')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='operation=weight,... (default: %s)' % DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='compare with the JSON results of a previous run')
+    args = parser.parse_args()
+
+    if args.url == None and args.target == 'http' and args.app == 'asgi' and args.mongo == 'mongomock':
+        sys.exit('The ASGI application needs a real MongoDB (--mongo spawn or external)')
+
+    # A running server only sees the users and products seeded into its own database
+    if args.url != None and args.mongo != 'external':
+        sys.exit('--url needs the MongoDB of the server (--mongo external, '
+                 'with its MONGO_HOSTNAME / MONGO_PORT)')
+
+    if args.mongo == 'external' and not args.drop_database:
+        sys.exit('--mongo external drops the DSPharmacy database of MONGO_HOSTNAME / MONGO_PORT '
+                 'first: confirm with --drop-database')
+
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+
+    if args.mongo == 'mongomock':
+        use_mongomock()
+    elif args.mongo == 'spawn':
+        spawn_mongod()
+
+    sys.path.insert(0, APP_DIRECTORY)
+
+    if args.url != None:
+        # The database of the running server is seeded directly
+        from common import mongo_client
+        client = mongo_client()
+        db = client['DSPharmacy']
+    else:
+        import app as application
+        db = application.db
+
+    # Start from an empty database: everything a previous run left behind
+    # (carts, reservations, stored responses, ...) is dropped, then the
+    # index migrations are applied again
+    import indexes
+
+    db.client.drop_database('DSPharmacy')
+    indexes.migrate(db)
+
+    product_ids = seed(db, args.users, args.products, rng)
+    workload = Workload(args.users, product_ids, rng)
+
+    if args.url != None:
+        address = urllib.parse.urlparse(args.url)
+        host, port = address.hostname, address.port or 80
+        transport_factory = lambda: HttpTransport(host, port)
+    elif args.target == 'http':
+        if args.app == 'asgi':
+            import asgi
+            host, port = serve_asgi(asgi.app)
+        else:
+            host, port = serve_wsgi(application.app)
+        transport_factory = lambda: HttpTransport(host, port)
+    else:
+        transport_factory = lambda: ClientTransport(application.app)
+
+    latencies, statuses, errors, elapsed = run(transport_factory, workload, weights,
+                                               args.requests, args.concurrency, args.seed)
+
+    summary = summarize(latencies, statuses, elapsed)
+    summary['config'] = {key: value for key, value in vars(args).items()
+                         if key not in ('output', 'baseline')}
+
+    baseline = None
+    if args.baseline != None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print_report(summary, baseline)
+
+    if len(errors) > 0:
+        print('%d requests failed, e.g. %s' % (len(errors), errors[0]))
+
+    if args.output != None:
+        with open(args.output, 'w') as output_file:
+            json.dump(summary, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
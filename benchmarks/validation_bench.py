@@ -0,0 +1,130 @@
+# Request validation benchmark.
+#
+# Compares the compiled schemas of app/validation.py with the inline checks
+# that the routes used before them (copied below), on a valid body and on
+# invalid bodies, and reports the time of one validation of each.
+#
+#     python3 benchmarks/validation_bench.py [--number N]
+
+import argparse
+import os
+import sys
+import timeit
+
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app')
+
+sys.path.insert(0, APP_DIRECTORY)
+
+import validation  # noqa: E402
+from common import is_ssn_valid, is_credit_valid  # noqa: E402
+
+
+# The Inline Checks (as in the routes of app.py before validation.py) ...
+
+def inline_signup(data):
+    return not (data == None or
+                'name' not in data or
+                'email' not in data or
+                'password' not in data or
+                'ssn' not in data or
+                not is_ssn_valid(data['ssn']))
+
+
+def inline_create_product(data):
+    return not (data == None or
+                'name' not in data or
+                'category' not in data or
+                'description' not in data or
+                'stock' not in data or
+                not isinstance(data['stock'], int) or
+                data['stock'] < 0 or
+                'price' not in data or
+                not isinstance(data['price'], (int, float)) or
+                data['price'] < 0.0)
+
+
+def inline_update_product(data):
+    return not (data == None or
+                '_id' not in data or
+                'stock' in data and
+                (not isinstance(data['stock'], int) or data['stock'] < 0) or
+                'price' in data and
+                (not isinstance(data['price'], (int, float)) or data['price'] < 0))
+
+
+def inline_add_to_cart(data):
+    return not (data == None or
+                '_id' not in data or
+                'quantity' not in data or
+                (not isinstance(data['quantity'], int) or data['quantity'] < 1))
+
+
+def inline_checkout(data):
+    return not (data == None or
+                'credit' not in data or (not is_credit_valid(data['credit'])))
+
+
+# Cases: (name, inline check, compiled schema, [(description, body)]) ...
+
+PRODUCT = {'name': 'depon', 'category': 'analgesic', 'description': 'tablets',
+           'stock': 10, 'price': 3.5}
+
+CASES = [
+    ('signup', inline_signup, validation.SIGNUP, [
+        ('valid', {'name': 'a', 'email': 'a@b', 'password': 'p', 'ssn': 10109012345}),
+        ('missing field', {'name': 'a', 'email': 'a@b', 'ssn': 10109012345}),
+        ('invalid ssn', {'name': 'a', 'email': 'a@b', 'password': 'p', 'ssn': 99999912345})
+    ]),
+    ('create-product', inline_create_product, validation.CREATE_PRODUCT, [
+        ('valid', PRODUCT),
+        ('missing field', {key: value for key, value in PRODUCT.items() if key != 'name'}),
+        ('negative price', dict(PRODUCT, price=-1))
+    ]),
+    ('update-product', inline_update_product, validation.UPDATE_PRODUCT, [
+        ('valid', {'_id': '0' * 24, 'price': 4.0, 'stock': 5}),
+        ('missing _id', {'price': 4.0}),
+        ('invalid stock', {'_id': '0' * 24, 'stock': 'many'})
+    ]),
+    ('add-to-cart', inline_add_to_cart, validation.ADD_TO_CART, [
+        ('valid', {'_id': '0' * 24, 'quantity': 2}),
+        ('zero quantity', {'_id': '0' * 24, 'quantity': 0})
+    ]),
+    ('checkout', inline_checkout, validation.CHECKOUT, [
+        ('valid', {'credit': 1234567812345678}),
+        ('invalid credit', {'credit': 1234})
+    ])
+]
+
+
+def measure(function, body, number):
+    return min(timeit.repeat(lambda: function(body), number=number, repeat=5)) / number
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Compare the compiled request schemas with the inline checks.')
+    parser.add_argument('--number', type=int, default=200000,
+                        help='validations per measurement')
+    arguments = parser.parse_args()
+
+    print('%-16s %-16s %12s %12s %8s' % ('schema', 'body', 'inline ns', 'compiled ns', 'change'))
+
+    for name, inline, compiled, bodies in CASES:
+        for description, body in bodies:
+
+            # Both must accept and reject the same bodies
+            if inline(body) != compiled(body):
+                raise AssertionError('%s disagrees on %s' % (name, description))
+
+            inline_time = measure(inline, body, arguments.number)
+            compiled_time = measure(compiled, body, arguments.number)
+
+            print('%-16s %-16s %12.0f %12.0f %+7.0f%%' % (
+                name, description, inline_time * 1e9, compiled_time * 1e9,
+                (compiled_time / inline_time - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
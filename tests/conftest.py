@@ -0,0 +1,129 @@
+# The tests drive the web service (app.py) with the Flask test client,
+# against the MongoDB server of MONGO_HOSTNAME and MONGO_PORT (e.g. the
+# 'mongodb' service of docker-compose.yml), and are skipped if it cannot
+# be reached. Every test signs up users and creates products of its own,
+# and removes them afterwards.
+#
+#     python3 -m pytest tests
+
+import json
+import os
+import random
+import sys
+import uuid
+
+import pytest
+
+from pymongo.errors import PyMongoError
+
+
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app')
+
+sys.path.insert(0, APP_DIRECTORY)
+
+# The options are read when app.py is imported
+os.environ['CART_BACKEND'] = 'mongo'
+os.environ['STOCK_RESERVATIONS'] = '1'
+
+from common import mongo_client  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def service():
+
+    try:
+        mongo_client(serverSelectionTimeoutMS=2000).admin.command('ping')
+    except PyMongoError:
+        pytest.skip('MongoDB cannot be reached')
+
+    import app
+
+    return app
+
+
+@pytest.fixture
+def call(service):
+
+    client = service.app.test_client()
+
+    # Sends a request with a JSON body, returns the response
+    def request(method, url, body=None, auth=None, headers=None, remote_addr='127.0.0.1'):
+        headers = dict(headers or {})
+
+        if auth != None:
+            headers['Authorization'] = auth
+
+        return client.open(url, method=method,
+                           data=json.dumps(body) if body != None else b'',
+                           headers=headers,
+                           environ_base={'REMOTE_ADDR': remote_addr})
+
+    return request
+
+
+@pytest.fixture
+def login(call):
+
+    # Logs in as the user, returns the session id
+    def log_in(email, password='password'):
+        response = call('POST', '/login', {'email': email, 'password': password})
+        assert response.status_code == 200
+
+        return response.get_json()['Authorization']
+
+    return log_in
+
+
+def ssn():
+
+    # A new SSN (born 10/10/1990), the SSNs of the users being unique
+    return int('101090' + '%05d' % random.randrange(100000))
+
+
+@pytest.fixture
+def user(service, call, login):
+
+    # Signs up a new (adult) user, returns the email
+    emails = []
+
+    def sign_up():
+        email = 'test-' + uuid.uuid4().hex + '@example.com'
+
+        response = call('POST', '/signup', {'name': 'Test', 'email': email,
+                                            'password': 'password', 'ssn': ssn()})
+        assert response.status_code == 200
+
+        emails.append(email)
+
+        return email
+
+    yield sign_up
+
+    for email in emails:
+        call('DELETE', '/user/delete-account', auth=login(email))
+
+
+@pytest.fixture
+def product(service):
+
+    # Creates a new product, returns its id
+    product_ids = []
+
+    def create(stock, category='vitamin', price=2.0):
+        product_id = service.products.insert_one({
+            'name': 'test ' + uuid.uuid4().hex,
+            'category': category,
+            'price': price,
+            'stock': stock,
+            'description': 'test product'
+        }).inserted_id
+
+        product_ids.append(product_id)
+
+        return str(product_id)
+
+    yield create
+
+    if len(product_ids) > 0:
+        service.products.delete_many({'_id': {'$in': product_ids}})
+        service.db['Reservations'].delete_many({'product': {'$in': product_ids}})
@@ -0,0 +1,27 @@
+# Checkout: the lines are purchased if their stock is sufficient.
+
+from bson.objectid import ObjectId
+
+CREDIT = 1234567812345678
+
+
+def test_checkout_of_deleted_product(service, call, login, user, product):
+
+    auth = login(user())
+    product_id = product(stock=3)
+    deleted_id = product(stock=3)
+
+    for _id in [product_id, deleted_id]:
+        response = call('POST', '/user/add-to-cart', {'_id': _id, 'quantity': 1}, auth)
+        assert response.status_code == 200
+
+    service.products.delete_one({'_id': ObjectId(deleted_id)})
+
+    response = call('POST', '/user/checkout', {'credit': CREDIT}, auth)
+    assert response.status_code == 200
+    assert list(response.get_json()['products']) == [product_id]
+    assert 'message' in response.get_json()
+
+    # (nothing was inserted in place of the deleted product)
+    assert service.products.find_one({'_id': ObjectId(deleted_id)}) == None
+    assert service.products.find_one({'_id': ObjectId(product_id)})['stock'] == 2
@@ -0,0 +1,38 @@
+# Idempotency keys of signup: the keys of a guest are its own.
+
+import uuid
+
+from conftest import ssn
+
+
+def signup_body():
+    return {'name': 'Test', 'email': 'test-' + uuid.uuid4().hex + '@example.com',
+            'password': 'password', 'ssn': ssn()}
+
+
+def test_two_guests_same_key(service, call, login):
+
+    key = str(uuid.uuid4())
+    first, second = signup_body(), signup_body()
+
+    try:
+        response = call('POST', '/signup', first, headers={'Idempotency-Key': key},
+                        remote_addr='192.0.2.1')
+        assert response.status_code == 200
+
+        response = call('POST', '/signup', second, headers={'Idempotency-Key': key},
+                        remote_addr='192.0.2.2')
+        assert response.status_code == 200
+        assert 'Idempotent-Replayed' not in response.headers
+
+        # (both were signed up)
+        login(first['email'])
+        login(second['email'])
+
+        # A retry of the first guest gets its stored response
+        response = call('POST', '/signup', first, headers={'Idempotency-Key': key},
+                        remote_addr='192.0.2.1')
+        assert response.status_code == 200
+        assert response.headers['Idempotent-Replayed'] == 'true'
+    finally:
+        service.users.delete_many({'email': {'$in': [first['email'], second['email']]}})
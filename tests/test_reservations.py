@@ -0,0 +1,105 @@
+# Stock reservations with a cart store: the holds belong to the user's
+# cart, and are found again with it after logging in again.
+
+from bson.objectid import ObjectId
+
+CREDIT = 1234567812345678
+
+
+def stock_of(service, product_id):
+    product = service.products.find_one({'_id': ObjectId(product_id)})
+
+    return product['stock'], product.get('reserved', 0)
+
+
+def test_checkout_after_login_again(service, call, login, user, product):
+
+    email = user()
+    product_id = product(stock=3)
+
+    response = call('POST', '/user/add-to-cart', {'_id': product_id, 'quantity': 3}, login(email))
+    assert response.status_code == 200
+    assert stock_of(service, product_id) == (3, 3)
+
+    auth = login(email)
+
+    response = call('POST', '/user/view-cart', auth=auth)
+    assert product_id in response.get_json()['products']
+
+    response = call('POST', '/user/checkout', {'credit': CREDIT}, auth)
+    assert response.status_code == 200
+    assert product_id in response.get_json()['products']
+    assert 'message' not in response.get_json()
+
+    assert stock_of(service, product_id) == (0, 0)
+
+
+def test_remove_after_login_again(service, call, login, user, product):
+
+    email = user()
+    product_id = product(stock=3)
+
+    response = call('POST', '/user/add-to-cart', {'_id': product_id, 'quantity': 2}, login(email))
+    assert response.status_code == 200
+    assert stock_of(service, product_id) == (3, 2)
+
+    auth = login(email)
+
+    response = call('DELETE', '/user/remove-from-cart', {'_id': product_id}, auth)
+    assert response.status_code == 200
+
+    assert stock_of(service, product_id) == (3, 0)
+
+    # (the released stock is available to another user)
+    response = call('POST', '/user/add-to-cart', {'_id': product_id, 'quantity': 3}, login(user()))
+    assert response.status_code == 200
+
+
+def test_checkout_next_to_other_holds(service, call, login, user, product):
+
+    product_id = product(stock=3)
+    buyer, other = login(user()), login(user())
+
+    response = call('POST', '/user/add-to-cart', {'_id': product_id, 'quantity': 2}, buyer)
+    assert response.status_code == 200
+
+    response = call('POST', '/user/add-to-cart', {'_id': product_id, 'quantity': 1}, other)
+    assert response.status_code == 200
+
+    # (the stock is all held)
+    response = call('POST', '/user/add-to-cart', {'_id': product_id, 'quantity': 1}, buyer)
+    assert response.status_code == 409
+
+    response = call('POST', '/user/checkout', {'credit': CREDIT}, buyer)
+    assert response.status_code == 200
+    assert response.get_json()['products'][product_id]['quantity'] == 2
+
+    assert stock_of(service, product_id) == (1, 1)
+
+
+def test_update_cart_grows_holds(service, call, login, user, product):
+
+    auth = login(user())
+    first_id, second_id = product(stock=5), product(stock=2)
+
+    response = call('POST', '/user/add-to-cart', {'_id': first_id, 'quantity': 1}, auth)
+    assert response.status_code == 200
+
+    response = call('POST', '/user/update-cart',
+                    {'set': [{'_id': first_id, 'quantity': 4}],
+                     'add': [{'_id': second_id, 'quantity': 2}]}, auth)
+    assert response.status_code == 200
+    assert response.get_json()['products'][first_id]['quantity'] == 4
+    assert response.get_json()['products'][second_id]['quantity'] == 2
+
+    assert stock_of(service, first_id) == (5, 4)
+    assert stock_of(service, second_id) == (2, 2)
+
+    # All or nothing: the first product is available, the second is not
+    response = call('POST', '/user/update-cart',
+                    {'add': [{'_id': first_id, 'quantity': 1},
+                             {'_id': second_id, 'quantity': 1}]}, auth)
+    assert response.status_code == 409
+
+    assert stock_of(service, first_id) == (5, 4)
+    assert stock_of(service, second_id) == (2, 2)